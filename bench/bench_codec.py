@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+'''
+Benchmark of the per-token JSON work with available JSON codecs.
+
+Each token is one SSE data frame decoded from the LLM provider and one `item.delta` event encoded for the websocket client.
+The result is in tokens per second on a single core; 'json' is the standard library (the baseline).
+
+Usage:
+	python3 bench/bench_codec.py [--tokens 200000]
+'''
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from llmulink.llm.codec import Codecs  # noqa: E402
+
+
+def bench(codec, frame: bytes, tokens: int) -> float:
+	loads = codec.loads
+	dumps = codec.dumps
+	t0 = time.perf_counter()
+	for _ in range(tokens):
+		data = loads(frame)
+		dumps({
+			"type": "item.delta",
+			"key": "message-4a3e3a4f-2f6c-4a8e-9a59-2b8f0f0e1d5c",
+			"delta": data['delta'],
+		})
+	return tokens / (time.perf_counter() - t0)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--tokens', type=int, default=200000)
+	args = parser.parse_args()
+
+	frame = json.dumps({
+		"type": "response.output_text.delta",
+		"item_id": "msg_1",
+		"output_index": 1,
+		"content_index": 0,
+		"delta": " token",
+		"sequence_number": 1234,
+	}).encode("utf-8")
+
+	baseline = None
+	for name, codec_class in Codecs.items():
+		try:
+			codec = codec_class()
+		except ImportError:
+			print("{:<10} not installed".format(name))
+			continue
+
+		tps = bench(codec, frame, args.tokens)
+		if baseline is None:
+			baseline = tps
+		print("{:<10} {:>12.0f} tokens/s/core  {:>5.2f}x".format(name, tps, tps / baseline))
+
+
+if __name__ == '__main__':
+	main()
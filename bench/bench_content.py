@@ -0,0 +1,88 @@
+#! /usr/bin/env python3
+'''
+Benchmark of the accumulation of streaming item content.
+
+The text of the item grows by one token per delta, as in provider adapters for long generations (e.g. reasoning traces).
+`str +=` on the item attribute (the baseline) is compared with `append_content()` of the item (see `ContentBuffer`),
+the text is read once when the item is completed.
+The 'reader' case also reads the new text after every token, as `ChatCompletion` does when it streams the answer.
+
+Usage:
+	python3 bench/bench_content.py [--tokens 100000]
+'''
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from llmulink.llm.datamodel import AssistentMessage  # noqa: E402
+
+
+class StrItem():
+	__slots__ = ('content',)
+
+	def __init__(self):
+		self.content = ''
+
+
+def bench_str(tokens: list) -> float:
+	t0 = time.perf_counter()
+	item = StrItem()
+	for token in tokens:
+		item.content += token
+	len(item.content)
+	return time.perf_counter() - t0
+
+
+def bench_buffer(tokens: list) -> float:
+	t0 = time.perf_counter()
+	item = AssistentMessage(content='', status='in_progress', role='assistant')
+	for token in tokens:
+		item.append_content(token)
+	len(item.content)
+	return time.perf_counter() - t0
+
+
+def bench_str_reader(tokens: list) -> float:
+	t0 = time.perf_counter()
+	item = StrItem()
+	sent = 0
+	for token in tokens:
+		item.content += token
+		item.content[sent:]
+		sent = len(item.content)
+	return time.perf_counter() - t0
+
+
+def bench_buffer_reader(tokens: list) -> float:
+	t0 = time.perf_counter()
+	item = AssistentMessage(content='', status='in_progress', role='assistant')
+	sent = 0
+	for token in tokens:
+		item.append_content(token)
+		item.content_since(sent)
+		sent = item.content_length
+	return time.perf_counter() - t0
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--tokens', type=int, default=100000)
+	args = parser.parse_args()
+
+	# Tokens of varying length, so that the interpreter cannot share them
+	tokens = [" token{}".format(i % 1000) for i in range(args.tokens)]
+
+	for name, baseline, buffered in [
+		("append", bench_str, bench_buffer),
+		("reader", bench_str_reader, bench_buffer_reader),
+	]:
+		t_baseline = baseline(tokens)
+		t_buffered = buffered(tokens)
+		print("{:<8} str += {:>8.3f} s  buffer {:>8.3f} s  {:>7.2f}x  ({} tokens)".format(name, t_baseline, t_buffered, t_baseline / t_buffered, args.tokens))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,83 @@
+#! /usr/bin/env python3
+'''
+Memory benchmark of conversation items.
+
+The compact items of `llmulink.llm.datamodel` (slotted objects with integer ids and epoch timestamps)
+are compared with the equivalent pydantic models (string uuid keys and datetime timestamps, the baseline).
+Items are empty so that only the overhead of the representation is measured, not the content.
+The result is in bytes per 1,000 items, as allocated (tracemalloc).
+
+Usage:
+	python3 bench/bench_items.py [--items 100000]
+'''
+import os
+import sys
+import uuid
+import typing
+import argparse
+import datetime
+import tracemalloc
+
+import pydantic
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from llmulink.llm.datamodel import AssistentMessage, FunctionCall  # noqa: E402
+
+
+def _utc_now() -> datetime.datetime:
+	return datetime.datetime.now(datetime.timezone.utc)
+
+
+class PydanticAssistentMessage(pydantic.BaseModel):
+	content: str
+	status: str
+	role: str
+	key: str = pydantic.Field(default_factory=lambda: "message-{}".format(str(uuid.uuid4())))
+	type: typing.Literal['message'] = 'message'
+	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+
+
+class PydanticFunctionCall(pydantic.BaseModel):
+	call_id: str
+	name: str
+	arguments: str
+	status: str
+	content: str = ''
+	error: bool = False
+	key: str = pydantic.Field(default_factory=lambda: "fc-{}".format(str(uuid.uuid4())))
+	type: typing.Literal['function_call'] = 'function_call'
+	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+
+
+def measure(factory: typing.Callable, count: int) -> float:
+	'''
+	Bytes per 1,000 items created by `factory()`.
+	'''
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	items = [factory() for _ in range(count)]
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	del items
+	return (after - before) * 1000 / count
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--items', type=int, default=100000)
+	args = parser.parse_args()
+
+	cases = [
+		("message", lambda: PydanticAssistentMessage(content='', status='completed', role='assistant'), lambda: AssistentMessage(content='', status='completed', role='assistant')),
+		("function_call", lambda: PydanticFunctionCall(call_id='', name='', arguments='', status='finished'), lambda: FunctionCall(call_id='', name='', arguments='', status='finished')),
+	]
+
+	for name, baseline_factory, compact_factory in cases:
+		baseline = measure(baseline_factory, args.items)
+		compact = measure(compact_factory, args.items)
+		print("{:<14} pydantic {:>9.0f} B/1k items  compact {:>9.0f} B/1k items  {:>5.2f}x smaller".format(name, baseline, compact, baseline / compact))
+
+
+if __name__ == '__main__':
+	main()
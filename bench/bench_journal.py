@@ -0,0 +1,108 @@
+#! /usr/bin/env python3
+'''
+Benchmark of the journal of conversations.
+
+Conversations with streamed answers are written to the journal (write-behind batches, see `ConversationJournal`),
+then the journal is loaded again as at the startup and one conversation is recovered.
+The startup reads only indexes of sealed segments, so its time stays flat as the history grows,
+the recovery reads only byte ranges of the recovered conversation.
+
+Usage:
+	python3 bench/bench_journal.py [--conversations 1000,10000] [--segment-size 4194304]
+'''
+import os
+import sys
+import time
+import types
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import asab  # noqa: E402
+
+from llmulink.llm.codec import create_codec  # noqa: E402
+from llmulink.llm.journal import ConversationJournal  # noqa: E402
+from llmulink.llm.datamodel import Conversation, Exchange, UserMessage, AssistentMessage  # noqa: E402
+
+
+class _Counter():
+	def add(self, name, value):
+		pass
+
+
+def _create_journal(path: str) -> ConversationJournal:
+	# The journal needs only the codec of the router and metrics and pubsub of the application
+	router = types.SimpleNamespace(JSONCodec=create_codec("json"))
+	app = types.SimpleNamespace(
+		MetricsService=types.SimpleNamespace(create_counter=lambda *args, **kwargs: _Counter()),
+		PubSub=types.SimpleNamespace(subscribe=lambda *args: None),
+	)
+	return ConversationJournal(router, app, path)
+
+
+async def write(path: str, conversations: int, tokens: int) -> tuple[float, str]:
+	journal = _create_journal(path)
+	await journal.initialize()
+
+	t0 = time.perf_counter()
+	conversation = None
+	for i in range(conversations):
+		conversation = Conversation(conversation_id="conversation-{}".format(i), instructions="You are a helpful assistant.")
+		journal.register(conversation)
+		exchange = Exchange()
+		conversation.append_exchange(exchange)
+		for item in (UserMessage(role='user', content="Question {}".format(i), model='model'), AssistentMessage(content='', status='in_progress', role='assistant')):
+			exchange.append_item(item)
+			conversation.sequence += 1
+			journal.on_event(conversation, {"type": "item.appended", "item": item.to_dict(), "seq": conversation.sequence})
+		for t in range(tokens):
+			conversation.sequence += 1
+			journal.on_event(conversation, {"type": "item.delta", "key": item.key, "delta": " token{}".format(t), "seq": conversation.sequence})
+		conversation.sequence += 1
+		journal.on_event(conversation, {"type": "item.patched", "key": item.key, "version": 1, "set": {"status": "completed"}, "seq": conversation.sequence})
+		if i % 100 == 99:
+			await journal.flush()
+
+	await journal.finalize()
+	return time.perf_counter() - t0, conversation.conversation_id
+
+
+async def load(path: str, conversation_id: str) -> tuple[float, float]:
+	journal = _create_journal(path)
+	t0 = time.perf_counter()
+	await journal.initialize()
+	t_load = time.perf_counter() - t0
+
+	t0 = time.perf_counter()
+	conversation = await journal.recover(conversation_id, [])
+	t_recover = time.perf_counter() - t0
+	assert conversation is not None and len(conversation.exchanges[0].items) == 2
+
+	await journal.finalize()
+	return t_load, t_recover
+
+
+async def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--conversations', default="1000,10000")
+	parser.add_argument('--tokens', type=int, default=200)
+	parser.add_argument('--segment-size', type=int, default=4194304)
+	args = parser.parse_args()
+
+	asab.Config["journal"]["segment_size"] = str(args.segment_size)
+	asab.Config["journal"]["fsync"] = "false"
+
+	for conversations in [int(c) for c in args.conversations.split(',')]:
+		with tempfile.TemporaryDirectory() as path:
+			t_write, conversation_id = await write(path, conversations, args.tokens)
+			size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+			t_load, t_recover = await load(path, conversation_id)
+			print("{:>7} conversations  {:>7.1f} MB  write {:>7.3f} s  startup {:>7.3f} s  recovery {:>7.4f} s".format(
+				conversations, size / 1048576, t_write, t_load, t_recover,
+			))
+
+
+if __name__ == '__main__':
+	asyncio.run(main())
@@ -0,0 +1,91 @@
+#! /usr/bin/env python3
+'''
+Micro-benchmark of the SSE framer used by LLM provider adapters.
+
+Streams are recorded in the shape produced by vLLM / OpenAI (responses and chat completions) and Anthropic (messages),
+they are replayed in network-sized chunks and the number of parsed frames per second is reported.
+
+Usage:
+	python3 bench/bench_sse.py [--tokens 20000] [--chunk 1400]
+'''
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from llmulink.llm.provider.sse import SSEFramer  # noqa: E402
+
+
+def record_v1response(tokens: int) -> bytes:
+	out = []
+	out.append(b'event: response.created\ndata: ' + json.dumps({"type": "response.created", "response": {"status": "in_progress"}}).encode() + b'\n\n')
+	out.append(b'event: response.output_item.added\ndata: ' + json.dumps({"type": "response.output_item.added", "output_index": 0, "item": {"type": "message", "role": "assistant", "status": "in_progress", "content": None}}).encode() + b'\n\n')
+	for i in range(tokens):
+		out.append(b'event: response.output_text.delta\ndata: ' + json.dumps({"type": "response.output_text.delta", "item_id": "msg_1", "output_index": 0, "content_index": 0, "delta": " token", "sequence_number": i}).encode() + b'\n\n')
+	out.append(b'event: response.completed\ndata: ' + json.dumps({"type": "response.completed"}).encode() + b'\n\n')
+	return b''.join(out)
+
+
+def record_v1messages(tokens: int) -> bytes:
+	out = []
+	out.append(b'event: message_start\r\ndata: ' + json.dumps({"type": "message_start", "message": {"usage": {"input_tokens": 25}}}).encode() + b'\r\n\r\n')
+	out.append(b'event: content_block_start\r\ndata: ' + json.dumps({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}).encode() + b'\r\n\r\n')
+	for i in range(tokens):
+		if i % 100 == 0:
+			out.append(b'event: ping\r\ndata: {"type": "ping"}\r\n\r\n')
+		out.append(b'event: content_block_delta\r\ndata: ' + json.dumps({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": " token"}}).encode() + b'\r\n\r\n')
+	out.append(b'event: message_stop\r\ndata: {"type": "message_stop"}\r\n\r\n')
+	return b''.join(out)
+
+
+def record_v1chatcompletition(tokens: int) -> bytes:
+	out = []
+	for i in range(tokens):
+		if i % 100 == 0:
+			out.append(b': keep-alive\n\n')
+		out.append(b'data: ' + json.dumps({"id": "chatcmpl-1", "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": " token"}, "finish_reason": None}]}).encode() + b'\n\n')
+	out.append(b'data: [DONE]\n\n')
+	return b''.join(out)
+
+
+def bench(name: str, stream: bytes, chunk_size: int, decode: bool) -> None:
+	chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+	t0 = time.perf_counter()
+	framer = SSEFramer()
+	frames = 0
+	for chunk in chunks:
+		for _, data in framer.feed(chunk):
+			frames += 1
+			if decode and data != b'[DONE]':
+				json.loads(data)
+	frames += len(framer.flush())
+	elapsed = time.perf_counter() - t0
+
+	print("{:<22} {:>9} frames {:>10.0f} frames/s {:>8.1f} MB/s{}".format(
+		name, frames, frames / elapsed, len(stream) / elapsed / 1e6, " (incl. JSON decode)" if decode else ""
+	))
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--tokens', type=int, default=20000, help="Number of token deltas in each recorded stream")
+	parser.add_argument('--chunk', type=int, default=1400, help="Size of the network chunk in bytes")
+	args = parser.parse_args()
+
+	streams = {
+		"v1response": record_v1response(args.tokens),
+		"v1messages": record_v1messages(args.tokens),
+		"v1chatcompletition": record_v1chatcompletition(args.tokens),
+	}
+
+	for decode in (False, True):
+		for name, stream in streams.items():
+			bench(name, stream, args.chunk, decode)
+
+
+if __name__ == '__main__':
+	main()
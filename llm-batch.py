@@ -0,0 +1,7 @@
+#! /usr/bin/env python3
+
+from llmulink import LLMBatchApplication
+
+if __name__ == '__main__':
+	app = LLMBatchApplication()
+	app.run()
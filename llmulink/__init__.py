@@ -1,5 +1,7 @@
 from .app import LLMMicrolinkApplication
+from .app_batch import LLMBatchApplication
 
 __all__ = [
 	"LLMMicrolinkApplication",
+	"LLMBatchApplication",
 ]
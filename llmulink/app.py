@@ -2,9 +2,10 @@ import logging
 
 import asab.api
 import asab.library
+import asab.metrics
 import asab.web.rest
 
-from .llm import LLMRouterService, LLMWebHandler
+from .llm import LLMRouterService, LLMWebHandler, LLMRestHandler, LLMBatchHandler
 from .tool import ToolService
 
 #
@@ -30,6 +31,10 @@ class LLMMicrolinkApplication(asab.Application):
 
 		self.ASABApiService = asab.api.ApiService(self)
 
+		# Initialize MetricsService
+		self.add_module(asab.metrics.Module)
+		self.MetricsService = self.get_service("asab.MetricsService")
+
 		# Initialize WebService
 		self.add_module(asab.web.Module)
 		self.WebService = self.get_service("asab.WebService")
@@ -53,6 +58,8 @@ class LLMMicrolinkApplication(asab.Application):
 		# Initialize LLMConversationRouterService
 		self.LLMRouterService = LLMRouterService(self)
 		self.LLMWebHandler = LLMWebHandler(self)
+		self.LLMRestHandler = LLMRestHandler(self)
+		self.LLMBatchHandler = LLMBatchHandler(self)
 
 		# Initialize ToolService
 		self.ToolService = ToolService(self)
@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+
+import asab
+import asab.library
+import asab.metrics
+import asab.zookeeper
+
+from .llm import LLMRouterService
+from .llm.batch import BatchJob
+from .tool import ToolService
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+asab.Config.add_defaults({
+	"library": {
+		"providers": "file://./library",
+	}
+})
+
+
+class LLMBatchApplication(asab.Application):
+	'''
+	Headless batch runner: reads JSONL conversations, drives them through `LLMRouterService` and writes results to JSONL.
+	It uses the same configuration as the `llm-microlink` server, but it doesn't listen on any port.
+	'''
+
+	Description = "Run a batch of LLM conversations from a JSONL file."
+
+	def __init__(self):
+		super().__init__()
+
+		self.add_module(asab.metrics.Module)
+		self.MetricsService = self.get_service("asab.MetricsService")
+
+		self.ZooKeeperService = None
+		self.ZkContainer = None
+		if 'zookeeper' in asab.Config.sections():
+			# Zookeeper is optional, it is used for the discovery of tools
+			self.add_module(asab.zookeeper.Module)
+			self.ZooKeeperService = self.get_service("asab.ZooKeeperService")
+			self.ZkContainer = asab.zookeeper.ZooKeeperContainer(self.ZooKeeperService, 'zookeeper')
+
+		self.LibraryService = asab.library.LibraryService(self, "LibraryService")
+		self.LLMRouterService = LLMRouterService(self)
+		self.ToolService = ToolService(self)
+
+
+	def create_argument_parser(self, *args, **kwargs):
+		parser = super().create_argument_parser(*args, **kwargs)
+		parser.add_argument('-i', '--input', required=True, help='JSONL file with conversations, "-" for the standard input')
+		parser.add_argument('-o', '--output', required=True, help='JSONL file for results')
+		parser.add_argument('--resume', action='store_true', help='skip conversations that already succeeded in the output and append to it')
+		parser.add_argument('--concurrency', type=int, help='conversations processed at the same time')
+		parser.add_argument('--model-concurrency', type=int, help='conversations processed at the same time per model')
+		parser.add_argument('--tenant', help='tenant of the conversations')
+		parser.add_argument('--tools-timeout', type=float, default=10.0, help='how long to wait for the discovery of tools (in seconds)')
+		return parser
+
+
+	async def main(self):
+		try:
+			await self._wait_for_tools()
+			models = await self.LLMRouterService.get_models()
+			L.log(asab.LOG_NOTICE, "Models available", struct_data={"models": len(models)})
+			stats = await self.run_batch()
+			print(json.dumps(stats, indent=2), file=sys.stderr)
+			if stats['status'] != 'completed' or stats['failed'] > 0:
+				self.set_exit_code(1)
+		except Exception:
+			L.exception("Batch failed")
+			self.set_exit_code(1)
+		finally:
+			self.stop()
+
+
+	async def run_batch(self) -> dict:
+		done = set()
+		if self.Args.resume and os.path.exists(self.Args.output):
+			# Successful results of the previous run are the checkpoint, failed conversations are tried again
+			with open(self.Args.output, "rb") as f:
+				for line in f:
+					try:
+						result = json.loads(line)
+					except ValueError:
+						# The last line may be incomplete if the previous run was killed
+						continue
+					if result.get('error') is None:
+						done.add(result['id'])
+			L.log(asab.LOG_NOTICE, "Resuming batch", struct_data={"done": len(done)})
+
+		output = open(self.Args.output, "ab" if self.Args.resume else "wb")
+		dumps = self.LLMRouterService.JSONCodec.dumps
+
+		async def write(result):
+			output.write(dumps(result).encode("utf-8") + b"\n")
+			output.flush()
+
+		job = BatchJob(
+			self.LLMRouterService,
+			write,
+			concurrency=self.Args.concurrency,
+			model_concurrency=self.Args.model_concurrency,
+			tenant=self.Args.tenant,
+			done=done,
+		)
+		try:
+			await job.run(self._read_input())
+		finally:
+			output.close()
+		return job.get_stats()
+
+
+	async def _read_input(self):
+		f = sys.stdin.buffer if self.Args.input == '-' else open(self.Args.input, "rb")
+		try:
+			for line in f:
+				yield line
+		finally:
+			if f is not sys.stdin.buffer:
+				f.close()
+
+
+	async def _wait_for_tools(self):
+		if len(self.ToolService.Providers) == 0:
+			return
+		deadline = self.Loop.time() + self.Args.tools_timeout
+		while len(self.ToolService.get_tools()) == 0 and self.Loop.time() < deadline:
+			await asyncio.sleep(0.5)
+		L.log(asab.LOG_NOTICE, "Tools discovered", struct_data={"tools": len(self.ToolService.get_tools())})
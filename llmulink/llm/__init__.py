@@ -1,9 +1,13 @@
 from .svc_router import LLMRouterService
 from .handler_web import LLMWebHandler
+from .handler_rest import LLMRestHandler
+from .handler_batch import LLMBatchHandler
 from .datamodel import FunctionCallTool
 
 __all__ = [
 	"LLMRouterService",
 	"LLMWebHandler",
+	"LLMRestHandler",
+	"LLMBatchHandler",
 	"FunctionCallTool",
 ]
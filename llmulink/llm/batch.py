@@ -0,0 +1,219 @@
+import time
+import uuid
+import typing
+import asyncio
+import logging
+
+import asab
+
+from .completion import ChatCompletion
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+asab.Config.add_defaults({
+	"batch": {
+		# Conversations of the batch processed at the same time, overall and per model (0 means no per-model limit)
+		"concurrency": 16,
+		"model_concurrency": 0,
+		# Tenant of batch conversations
+		"tenant": "batch",
+	}
+})
+
+
+class BatchJob():
+	'''
+	Drives JSONL conversations through `LLMRouterService` and the tool loop.
+
+	Each input line is a JSON object with `id` (or `custom_id`), `model` and `messages` in the format of the OpenAI chat completions API;
+	these can also be in `body` as in the OpenAI batch input.
+	Each result is one JSON object passed to `write()` as soon as the conversation is finished, in the order of completion:
+
+		{"id": "...", "response": {...chat.completion...}, "error": null, "latency": 1.23}
+
+	Conversations with ids in `done` (e.g. successful results of the previous run) are skipped, so the job can resume from its output.
+	'''
+
+	def __init__(self, router, write: typing.Callable, concurrency: int = None, model_concurrency: int = None, tenant: str = None, done: set = frozenset()):
+		self.LLMRouterService = router
+		self.Write = write  # async write(result: dict)
+		self.Id = "batch-" + uuid.uuid4().hex
+
+		self.Concurrency = concurrency if concurrency is not None else asab.Config.getint("batch", "concurrency")
+		self.ModelConcurrency = model_concurrency if model_concurrency is not None else asab.Config.getint("batch", "model_concurrency")
+		self.Tenant = tenant if tenant is not None else asab.Config.get("batch", "tenant")
+		self.Done = done
+
+		self.Semaphore = asyncio.Semaphore(max(1, self.Concurrency))
+		self.ModelSemaphores = {}
+
+		self.Status = "created"
+		self.StartedAt = None
+		self.FinishedAt = None
+		self.Succeeded = 0
+		self.Failed = 0
+		self.Skipped = 0
+		self.OutputTokens = 0
+		self.Latencies = []
+
+
+	async def run(self, lines: typing.AsyncIterable) -> None:
+		'''
+		Process all input lines, at most `concurrency` conversations at the same time.
+		'''
+		self.Status = "running"
+		self.StartedAt = time.time()
+		try:
+			async with asyncio.TaskGroup() as tg:
+				lineno = 0
+				async for line in lines:
+					lineno += 1
+					line = line.strip()
+					if len(line) == 0:
+						continue
+
+					# Reading of the input is paused until there is a free slot
+					await self.Semaphore.acquire()
+					tg.create_task(self._process(lineno, line))
+
+			self.Status = "completed"
+
+		except asyncio.CancelledError:
+			self.Status = "cancelled"
+			raise
+
+		except Exception:
+			L.exception("Batch failed", struct_data={"batch": self.Id})
+			self.Status = "failed"
+
+		finally:
+			self.FinishedAt = time.time()
+			L.log(asab.LOG_NOTICE, "Batch finished", struct_data={"batch": self.Id, "status": self.Status, "succeeded": self.Succeeded, "failed": self.Failed, "skipped": self.Skipped})
+
+
+	async def _process(self, lineno: int, line: str | bytes) -> None:
+		try:
+			await self._process_line(lineno, line)
+		finally:
+			self.Semaphore.release()
+
+
+	async def _process_line(self, lineno: int, line: str | bytes) -> None:
+		codec = self.LLMRouterService.JSONCodec
+		try:
+			request = codec.loads(line)
+			if not isinstance(request, dict):
+				raise ValueError("Not a JSON object")
+		except (*codec.DecodeError, ValueError):
+			L.warning("Invalid JSON in the batch input", struct_data={"batch": self.Id, "line": lineno})
+			await self._write_result(str(lineno), None, "Invalid JSON on line {}".format(lineno), 0.0)
+			return
+
+		request_id = str(request.get('id', request.get('custom_id', lineno)))
+		if request_id in self.Done:
+			self.Skipped += 1
+			return
+
+		body = request.get('body', request)
+		if not isinstance(body, dict):
+			await self._write_result(request_id, None, "'body' must be a JSON object", 0.0)
+			return
+
+		model = body.get('model')
+		if not isinstance(model, str):
+			await self._write_result(request_id, None, "'model' must be a string", 0.0)
+			return
+		models = await self.LLMRouterService.get_models()
+		if models is None or model not in models:
+			await self._write_result(request_id, None, "The model '{}' does not exist".format(model), 0.0)
+			return
+
+		semaphore = self._get_model_semaphore(model)
+		t0 = time.perf_counter()
+		completion = ChatCompletion(self.LLMRouterService, model)
+		try:
+			if semaphore is not None:
+				await semaphore.acquire()
+			try:
+				await completion.start(self.Tenant, body.get('messages'))
+				await completion.wait()
+			finally:
+				if semaphore is not None:
+					semaphore.release()
+
+			if completion.Error is not None:
+				await self._write_result(request_id, None, completion.Error, time.perf_counter() - t0)
+			else:
+				response = completion.to_dict()
+				self.OutputTokens += response['usage']['completion_tokens']
+				await self._write_result(request_id, response, None, time.perf_counter() - t0)
+
+		except ValueError as e:
+			await self._write_result(request_id, None, str(e), time.perf_counter() - t0)
+
+		except Exception as e:
+			# One broken conversation doesn't fail the whole batch
+			L.exception("Error in the batch conversation", struct_data={"batch": self.Id, "id": request_id})
+			await self._write_result(request_id, None, "Internal error: {}".format(e), time.perf_counter() - t0)
+
+		finally:
+			await completion.close()
+
+
+	async def _write_result(self, request_id: str, response: dict | None, error: str | None, latency: float) -> None:
+		if error is None:
+			self.Succeeded += 1
+			self.Latencies.append(latency)
+		else:
+			self.Failed += 1
+
+		await self.Write({
+			"id": request_id,
+			"response": response,
+			"error": error,
+			"latency": round(latency, 3),
+		})
+
+
+	def _get_model_semaphore(self, model: str) -> asyncio.Semaphore | None:
+		if self.ModelConcurrency <= 0:
+			return None
+		semaphore = self.ModelSemaphores.get(model)
+		if semaphore is None:
+			semaphore = self.ModelSemaphores[model] = asyncio.Semaphore(self.ModelConcurrency)
+		return semaphore
+
+
+	def get_stats(self) -> dict:
+		'''
+		Throughput and latency (of successful conversations, in seconds) of the job.
+		'''
+		finished_at = self.FinishedAt if self.FinishedAt is not None else time.time()
+		elapsed = finished_at - self.StartedAt if self.StartedAt is not None else 0.0
+		processed = self.Succeeded + self.Failed
+
+		latencies = sorted(self.Latencies)
+
+		def percentile(p):
+			if len(latencies) == 0:
+				return None
+			return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 3)
+
+		return {
+			"id": self.Id,
+			"status": self.Status,
+			"succeeded": self.Succeeded,
+			"failed": self.Failed,
+			"skipped": self.Skipped,
+			"elapsed": round(elapsed, 3),
+			"throughput": round(processed / elapsed, 3) if elapsed > 0 else None,  # Conversations per second
+			"output_tokens_per_second": round(self.OutputTokens / elapsed, 1) if elapsed > 0 else None,
+			"latency_p50": percentile(0.5),
+			"latency_p90": percentile(0.9),
+			"latency_p99": percentile(0.99),
+			"latency_max": round(latencies[-1], 3) if len(latencies) > 0 else None,
+		}
@@ -0,0 +1,118 @@
+import time
+import asyncio
+import logging
+
+import asab
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+asab.Config.add_defaults({
+	"llm": {
+		# How often (in seconds) the list of models is refreshed from providers
+		"models_refresh_interval": 60,
+		# How long (in seconds) to wait for a single provider to answer with its models
+		"models_refresh_timeout": 10,
+	}
+})
+
+
+class ModelCatalog():
+	'''
+	Cached catalog of models offered by LLM providers.
+
+	The catalog is refreshed in the background on a timer.
+	When a provider fails or times out during the refresh, its previously known models are kept (stale-while-revalidate).
+	'''
+
+	def __init__(self, app, providers: list):
+		self.Providers = providers
+
+		self.RefreshInterval = asab.Config.getfloat("llm", "models_refresh_interval")
+		self.RefreshTimeout = asab.Config.getfloat("llm", "models_refresh_timeout")
+
+		self.Models = list[str]()  # Model ids in a stable order
+		self.Index = dict[str, list]()  # Model id -> list of providers that serve the model
+		self.ProviderModels = dict()  # Provider -> last known list of model ids
+
+		self.RefreshedAt = None
+		self.RefreshTask = None
+
+		self.Timer = asab.Timer(app, self._on_timer, autorestart=True)
+
+
+	def start(self):
+		self.Timer.start(self.RefreshInterval)
+		self.refresh()
+
+
+	def stop(self):
+		self.Timer.stop()
+		if self.RefreshTask is not None:
+			self.RefreshTask.cancel()
+
+
+	async def _on_timer(self):
+		self.refresh()
+
+
+	def refresh(self) -> asyncio.Task:
+		'''
+		Start the refresh of the catalog in the background.
+		If a refresh is already in progress, its task is returned.
+		'''
+		if self.RefreshTask is None or self.RefreshTask.done():
+			self.RefreshTask = asyncio.create_task(self._refresh(), name="llm-model-catalog-refresh")
+		return self.RefreshTask
+
+
+	async def get_models(self) -> list[str]:
+		if self.RefreshedAt is None:
+			# The catalog has never been loaded, the caller has to wait for the first refresh
+			await asyncio.shield(self.refresh())
+
+		elif time.monotonic() - self.RefreshedAt > self.RefreshInterval:
+			# Serve the stale catalog and revalidate in the background
+			self.refresh()
+
+		return self.Models
+
+
+	def get_providers(self, model: str) -> list:
+		return self.Index.get(model, [])
+
+
+	async def _refresh(self):
+		async def collect_models(provider):
+			try:
+				pmodels = await asyncio.wait_for(provider.get_models(), timeout=self.RefreshTimeout)
+			except asyncio.TimeoutError:
+				L.warning("Timeout when collecting models", struct_data={"provider": provider.URL})
+				return
+			except Exception:
+				L.exception("Error collecting models", struct_data={"provider": provider.URL})
+				return
+
+			if pmodels is not None:
+				self.ProviderModels[provider] = pmodels
+
+		async with asyncio.TaskGroup() as tg:
+			for provider in self.Providers:
+				tg.create_task(collect_models(provider))
+
+		models = []
+		index = {}
+		for provider in self.Providers:
+			for model in self.ProviderModels.get(provider, []):
+				providers = index.get(model)
+				if providers is None:
+					providers = index[model] = []
+					models.append(model)
+				providers.append(provider)
+
+		self.Models = models
+		self.Index = index
+		self.RefreshedAt = time.monotonic()
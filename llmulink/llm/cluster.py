@@ -0,0 +1,168 @@
+import json
+import logging
+
+import aiohttp
+import asab
+import kazoo.exceptions
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+asab.Config.add_defaults({
+	"cluster": {
+		# URL of the web API of this node for other nodes (e.g. http://node1:8920); empty disables the cluster mode
+		"advertised_url": "",
+		# ZooKeeper path with owners of conversations
+		"path": "/asab/llm/conversation",
+	}
+})
+
+# Marks the websocket proxied from another node of the cluster, such a websocket is never proxied again (409 is returned instead)
+PROXIED_HEADER = "X-LLM-Microlink-Proxied"
+
+
+class ConversationOwnership():
+	'''
+	Ownership of conversations in the cluster of `llm-microlink` nodes, coordinated through ZooKeeper.
+
+	The owner node keeps the conversation in the memory and runs its tasks.
+	Each owned conversation has an ephemeral ZooKeeper node '{path}/{conversation_id}' with the URL of the owner,
+	so the ownership ends when the owner node fails (its ZooKeeper session expires) or when the conversation is removed.
+
+	A client that reconnects to another node is proxied to the owner. If there is no owner, the node takes the conversation over
+	when it has the conversation in its journal; otherwise the conversation is lost and the client receives 404.
+	'''
+
+	def __init__(self, router, app, url: str):
+		self.LLMRouterService = router
+		self.ZkContainer = app.ZkContainer
+		self.URL = url.rstrip('/')
+		self.Path = asab.Config.get("cluster", "path").rstrip('/')
+
+		self.Owned = set()  # Ids of conversations owned by this node
+		self.Session = None  # HTTP session for websockets proxied to other nodes
+
+		self.Counter = app.MetricsService.create_counter(
+			"llm_cluster_conversations",
+			init_values={"claimed": 0, "proxied": 0, "lost": 0},
+			help="Conversations claimed by this node, websockets proxied to owner nodes and conversations taken over by other nodes",
+		)
+
+		app.PubSub.subscribe("ZooKeeperContainer.state/CONNECTED!", self._on_zk_connected)
+		app.PubSub.subscribe("ConversationStore.removed!", self._on_conversation_removed)
+
+		L.log(asab.LOG_NOTICE, "Cluster mode enabled", struct_data={"url": self.URL, "path": self.Path})
+
+
+	async def finalize(self):
+		if self.Session is not None:
+			await self.Session.close()
+			self.Session = None
+
+
+	async def claim(self, conversation_id: str) -> str | None:
+		'''
+		Become the owner of the conversation.
+		Returns `None` when this node owns the conversation, otherwise the URL of the owner node.
+		'''
+		path = "{}/{}".format(self.Path, conversation_id)
+		zk = self.ZkContainer.ZooKeeper
+		try:
+			for _ in range(2):
+				try:
+					await zk.create(path, json.dumps({"url": self.URL}).encode("utf-8"), ephemeral=True, makepath=True)
+					break
+				except kazoo.exceptions.NodeExistsError:
+					owner = await self._get_owner(path)
+					if owner is None:
+						# The owner has just released the conversation
+						continue
+					if owner != self.URL:
+						return owner
+					# The node of the previous run of this node, its session has not expired yet
+					break
+
+		except kazoo.exceptions.KazooException as e:
+			# Availability is preferred, the ownership is claimed again when ZooKeeper is connected
+			L.warning("Cannot claim the conversation, serving it locally", struct_data={"conversation_id": conversation_id, "error": str(e)})
+
+		self.Owned.add(conversation_id)
+		self.Counter.add("claimed", 1)
+		return None
+
+
+	async def get_owner(self, conversation_id: str) -> str | None:
+		try:
+			return await self._get_owner("{}/{}".format(self.Path, conversation_id))
+		except kazoo.exceptions.KazooException:
+			return None
+
+
+	async def connect(self, owner: str, path_qs: str, protocols: list) -> aiohttp.ClientWebSocketResponse:
+		'''
+		Open the websocket to the owner node, `path_qs` is the path with the query of the client request.
+		'''
+		if self.Session is None:
+			self.Session = aiohttp.ClientSession()
+		self.Counter.add("proxied", 1)
+		return await self.Session.ws_connect(owner + path_qs, protocols=protocols, headers={PROXIED_HEADER: self.URL})
+
+
+	async def _get_owner(self, path: str) -> str | None:
+		data = await self.ZkContainer.ZooKeeper.get_data(path)
+		if data is None:
+			return None
+		try:
+			return json.loads(data)['url']
+		except (ValueError, KeyError, TypeError):
+			L.warning("Invalid owner of the conversation", struct_data={"path": path})
+			return None
+
+
+	async def _on_conversation_removed(self, message_type, conversation_id):
+		await self.release(conversation_id)
+
+
+	async def release(self, conversation_id: str) -> None:
+		'''
+		End the ownership of the conversation by this node.
+		'''
+		if conversation_id not in self.Owned:
+			return
+		self.Owned.discard(conversation_id)
+
+		path = "{}/{}".format(self.Path, conversation_id)
+		try:
+			if await self._get_owner(path) == self.URL:
+				await self.ZkContainer.ZooKeeper.delete(path)
+		except kazoo.exceptions.KazooException as e:
+			L.warning("Cannot release the conversation", struct_data={"conversation_id": conversation_id, "error": str(e)})
+
+
+	async def _on_zk_connected(self, message_type, zkcontainer):
+		'''
+		Ephemeral nodes are gone when the ZooKeeper session expired, owned conversations are claimed again.
+		Conversations that have been taken over by other nodes meanwhile are dropped, their clients reconnect.
+		'''
+		if zkcontainer is not self.ZkContainer:
+			return
+
+		for conversation_id in list(self.Owned):
+			self.Owned.discard(conversation_id)
+			owner = await self.claim(conversation_id)
+			if owner is None:
+				continue
+
+			L.warning("Conversation has been taken over by another node", struct_data={"conversation_id": conversation_id, "owner": owner})
+			self.Counter.add("lost", 1)
+			if self.LLMRouterService.Journal is not None:
+				self.LLMRouterService.Journal.forget(conversation_id)
+			conversation = self.LLMRouterService.Conversations.remove(conversation_id)
+			if conversation is None:
+				continue
+			await self.LLMRouterService.stop_conversation(conversation)
+			for monitor in list(conversation.monitors):
+				await monitor.Close()
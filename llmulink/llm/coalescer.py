@@ -0,0 +1,101 @@
+import asyncio
+import typing
+import logging
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class DeltaCoalescer():
+	'''
+	Merges consecutive `item.delta` events of the same item into one event.
+
+	Deltas are held for at most `window` seconds or until `max_size` characters are accumulated.
+	Any other event flushes pending deltas first, so the order of events is preserved.
+	The coalescer is closed when its conversation is dropped, pending deltas are discarded then.
+	'''
+
+	def __init__(self, send: typing.Callable, window: float, max_size: int):
+		self.Send = send
+		self.Window = window
+		self.MaxSize = max_size
+
+		self.Key = None
+		self.Deltas = []
+		self.Size = 0
+
+		self.Timer = None
+		self.FlushTask = None
+
+
+	async def push(self, event: dict) -> None:
+		if event.get('type') != 'item.delta':
+			await self.flush()
+			await self.Send(event)
+			return
+
+		if self.Key is not None and self.Key != event['key']:
+			await self.flush()
+
+		if self.Key is None:
+			self.Key = event['key']
+			self.Timer = asyncio.get_running_loop().call_later(self.Window, self._on_timer)
+
+		self.Deltas.append(event['delta'])
+		self.Size += len(event['delta'])
+		if self.Size >= self.MaxSize:
+			await self.flush()
+
+
+	async def flush(self) -> None:
+		if self.Key is None:
+			return
+
+		event = {
+			"type": "item.delta",
+			"key": self.Key,
+			"delta": self.Deltas[0] if len(self.Deltas) == 1 else ''.join(self.Deltas),
+		}
+
+		self.Key = None
+		self.Deltas = []
+		self.Size = 0
+		if self.Timer is not None:
+			self.Timer.cancel()
+			self.Timer = None
+
+		await self.Send(event)
+
+
+	def close(self) -> None:
+		'''
+		Discard pending deltas, stop the timer and the flush in progress.
+		'''
+		if self.Timer is not None:
+			self.Timer.cancel()
+			self.Timer = None
+		if self.FlushTask is not None:
+			self.FlushTask.cancel()
+			self.FlushTask = None
+		self.Key = None
+		self.Deltas = []
+		self.Size = 0
+
+
+	def _on_timer(self):
+		self.Timer = None
+		self.FlushTask = asyncio.create_task(self.flush(), name="delta-coalescer-flush")
+		self.FlushTask.add_done_callback(self._on_flush_done)
+
+
+	def _on_flush_done(self, task: asyncio.Task) -> None:
+		if task is self.FlushTask:
+			self.FlushTask = None
+		if task.cancelled():
+			return
+		e = task.exception()
+		if e is not None:
+			L.error("Flush of coalesced deltas failed", exc_info=e, struct_data={"error": str(e)})
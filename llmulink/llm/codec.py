@@ -0,0 +1,97 @@
+import json
+import logging
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class JSONCodec():
+	'''
+	JSON codec based on the Python standard library.
+
+	`loads()` accepts `str`, `bytes` and `bytearray`, `dumps()` returns `str`.
+	Errors of `loads()` are instances of one of `DecodeError` classes.
+	'''
+
+	Name = "json"
+	DecodeError = (ValueError,)
+
+	def __init__(self):
+		self.loads = json.loads
+		self.dumps = self._dumps
+
+	@staticmethod
+	def _dumps(obj) -> str:
+		return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+class OrjsonCodec(JSONCodec):
+
+	Name = "orjson"
+
+	def __init__(self):
+		import orjson
+		self.loads = orjson.loads
+		dumps = orjson.dumps
+		self.dumps = lambda obj: dumps(obj).decode("utf-8")
+
+
+class MsgspecCodec(JSONCodec):
+
+	Name = "msgspec"
+
+	def __init__(self):
+		import msgspec
+		self.DecodeError = (msgspec.DecodeError, ValueError)
+		self.loads = msgspec.json.Decoder().decode
+		encode = msgspec.json.Encoder().encode
+		self.dumps = lambda obj: encode(obj).decode("utf-8")
+
+
+class MessagePackCodec():
+	'''
+	MessagePack codec for binary websocket frames, `dumps()` returns `bytes`.
+	'''
+
+	Name = "msgpack"
+
+	def __init__(self):
+		import msgpack
+		self.DecodeError = (msgpack.UnpackException, ValueError)
+		self.loads = msgpack.unpackb
+		self.dumps = msgpack.Packer().pack
+
+
+Codecs = {
+	"json": JSONCodec,
+	"orjson": OrjsonCodec,
+	"msgspec": MsgspecCodec,
+}
+
+
+def create_codec(name: str = "auto") -> JSONCodec:
+	'''
+	Create the JSON codec by its name.
+	The 'auto' picks the fastest one that is installed (orjson, msgspec, then the standard library).
+	'''
+	if name == "auto":
+		for candidate in ("orjson", "msgspec"):
+			try:
+				return Codecs[candidate]()
+			except ImportError:
+				continue
+		return JSONCodec()
+
+	codec_class = Codecs.get(name)
+	if codec_class is None:
+		L.warning("Unknown JSON codec, using 'json'", struct_data={"json_codec": name})
+		return JSONCodec()
+
+	try:
+		return codec_class()
+	except ImportError:
+		L.warning("JSON codec is not installed, using 'json'", struct_data={"json_codec": name})
+		return JSONCodec()
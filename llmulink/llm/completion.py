@@ -0,0 +1,242 @@
+import time
+import uuid
+import asyncio
+import logging
+
+from .datamodel import Exchange, UserMessage, AssistentMessage, FunctionCall, Usage
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class ChatCompletion():
+	'''
+	Stateless chat completion in the format of the OpenAI chat completions API.
+
+	The conversation is built from `messages` (system, user, assistant incl. tool calls, tool) and dropped by `close()`.
+	It is routed by `LLMRouterService` like any other conversation and tools of the `ToolService` are executed server-side,
+	the LLM is called again until it gives the final answer.
+
+	The completion is a monitor of its conversation, it collects the answer of the LLM.
+	The answer is complete when no tasks (LLM requests and tool calls) remain in the conversation.
+	'''
+
+	def __init__(self, router, model: str):
+		self.LLMRouterService = router
+		self.Model = model
+		self.Id = "chatcmpl-" + uuid.uuid4().hex
+		self.Created = int(time.time())
+
+		self.Conversation = None
+		self.ExchangesCount = 0  # Exchanges of the chat history, these that follow are the answer
+
+		self.Events = asyncio.Queue()
+		self.Items = {}  # key -> assistant message or reasoning item of the answer
+		self.Sent = {}  # key -> length of the content already yielded
+		self.Error = None
+
+
+	async def start(self, tenant: str, messages: list, tools: bool = True) -> None:
+		'''
+		Create the conversation and request the answer to the last user message.
+		If `tools` is false, the LLM is not offered any tools.
+		Raises `ValueError` when messages cannot be turned into a conversation.
+		'''
+		self.Conversation = await self.LLMRouterService.create_conversation(tenant)
+		if not tools:
+			self.Conversation.tools = []
+		user_message = self._load_messages(messages)
+		self.ExchangesCount = len(self.Conversation.exchanges)
+
+		self.Conversation.monitors.add(self)
+		await self.LLMRouterService.create_exchange(self.Conversation, user_message)
+
+
+	async def close(self) -> None:
+		if self.Conversation is None:
+			return
+		self.Conversation.monitors.discard(self)
+		if len(self.Conversation.tasks) > 0:
+			# The answer is not complete, e.g. the client went away
+			await self.LLMRouterService.stop_conversation(self.Conversation)
+		self.LLMRouterService.Conversations.remove(self.Conversation.conversation_id)
+
+
+	def put(self, event: dict) -> None:
+		self.Events.put_nowait(event)
+
+
+	async def contents(self):
+		'''
+		Yield ('content' or 'reasoning_content', text) as the answer grows.
+		'''
+		messages = 0
+		while True:
+			event = await self.Events.get()
+			match event.get('type'):
+
+				case 'item.appended':
+					item = self.Conversation.get_item(event['item']['key'])
+					if item is not None and (item.type == 'reasoning' or (item.type == 'message' and item.role == 'assistant')):
+						self.Items[item.key] = item
+						self.Sent[item.key] = 0
+						if item.type == 'message':
+							messages += 1
+							if messages > 1:
+								yield 'content', "\n\n"
+
+				case 'chat.error':
+					self.Error = event['error']
+
+				case 'tasks.updated':
+					if event['count'] == 0:
+						return
+
+			key = event.get('key') or event.get('item', {}).get('key')
+			item = self.Items.get(key)
+			if item is not None and item.content_length > self.Sent[key]:
+				# The item may already contain text of events that are not processed yet, they will yield nothing then
+				sent = self.Sent[key]
+				self.Sent[key] = item.content_length
+				yield ('content' if item.type == 'message' else 'reasoning_content'), item.content_since(sent)
+
+
+	async def wait(self) -> None:
+		'''
+		Wait for the complete answer.
+		'''
+		async for _ in self.contents():
+			pass
+
+
+	def get_content(self) -> str:
+		return "\n\n".join(item.content for item in self.Items.values() if item.type == 'message')
+
+
+	def get_usage(self) -> dict:
+		usage = Usage()
+		for exchange in self.Conversation.exchanges[self.ExchangesCount:]:
+			if exchange.usage is None:
+				continue
+			usage.input_tokens += exchange.usage.input_tokens
+			usage.output_tokens += exchange.usage.output_tokens
+			usage.cache_read_tokens += exchange.usage.cache_read_tokens
+		return {
+			"prompt_tokens": usage.input_tokens,
+			"completion_tokens": usage.output_tokens,
+			"total_tokens": usage.input_tokens + usage.output_tokens,
+			"prompt_tokens_details": {"cached_tokens": usage.cache_read_tokens},
+		}
+
+
+	def to_dict(self) -> dict:
+		return {
+			"id": self.Id,
+			"object": "chat.completion",
+			"created": self.Created,
+			"model": self.Model,
+			"choices": [{
+				"index": 0,
+				"message": {
+					"role": "assistant",
+					"content": self.get_content(),
+				},
+				"finish_reason": "stop",
+			}],
+			"usage": self.get_usage(),
+		}
+
+
+	def _load_messages(self, messages: list) -> UserMessage:
+		'''
+		Build exchanges of the conversation from the chat history.
+		Returns the last user message, it is the one to be answered.
+		'''
+		if not isinstance(messages, list) or len(messages) == 0:
+			raise ValueError("'messages' must be a non-empty list")
+
+		instructions = []
+		function_calls = {}
+		exchange = None
+
+		for message in messages:
+			if not isinstance(message, dict):
+				raise ValueError("Every message must be an object")
+
+		for message in messages[:-1]:
+			role = message.get('role')
+			content = _text(message.get('content'))
+
+			match role:
+
+				case 'system' | 'developer':
+					instructions.append(content)
+
+				case 'user':
+					exchange = Exchange(completed=True)
+					exchange.append_item(UserMessage(role='user', content=content, model=self.Model))
+					self.Conversation.append_exchange(exchange)
+
+				case 'assistant':
+					if exchange is None:
+						raise ValueError("The first message of the conversation must be from the user")
+					if len(content) > 0:
+						exchange.append_item(AssistentMessage(role='assistant', content=content, status='completed'))
+					tool_calls = message.get('tool_calls') or []
+					if not isinstance(tool_calls, list):
+						raise ValueError("'tool_calls' must be a list")
+					for tool_call in tool_calls:
+						function = tool_call.get('function', {}) if isinstance(tool_call, dict) else None
+						if not isinstance(function, dict):
+							raise ValueError("Every tool call must be an object with the 'function' object")
+						function_call = FunctionCall(
+							call_id=_string(tool_call, 'id'),
+							name=_string(function, 'name'),
+							arguments=_string(function, 'arguments'),
+							status='finished',
+						)
+						function_calls[function_call.call_id] = function_call
+						exchange.append_item(function_call)
+
+				case 'tool':
+					function_call = function_calls.get(_string(message, 'tool_call_id'))
+					if function_call is None:
+						raise ValueError("Tool message without a matching tool call '{}'".format(message.get('tool_call_id')))
+					function_call.content = content
+
+				case _:
+					raise ValueError("Unsupported message role '{}'".format(role))
+
+		last = messages[-1]
+		if last.get('role') != 'user':
+			raise ValueError("The last message must be from the user")
+
+		if len(instructions) > 0:
+			self.Conversation.instructions = "\n\n".join(instructions)
+
+		return UserMessage(role='user', content=_text(last.get('content')), model=self.Model)
+
+
+def _text(content) -> str:
+	'''
+	Content of the message is a string or a list of parts, only text parts are supported.
+	'''
+	if content is None:
+		return ''
+	if isinstance(content, str):
+		return content
+	if not isinstance(content, list) or not all(isinstance(part, dict) for part in content):
+		raise ValueError("'content' must be a string or a list of content parts")
+	return ''.join(_string(part, 'text') for part in content if part.get('type') == 'text')
+
+
+def _string(data: dict, key: str) -> str:
+	value = data.get(key)
+	if value is None:
+		return ''
+	if not isinstance(value, str):
+		raise ValueError("'{}' must be a string".format(key))
+	return value
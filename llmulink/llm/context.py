@@ -0,0 +1,355 @@
+import logging
+
+import asab
+
+from .datamodel import Conversation, UserMessage, AssistentMessage, FunctionCall
+from .completion import ChatCompletion
+from .provider.provider_abc import is_settled
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+asab.Config.add_defaults({
+	"llm": {
+		# Context window (in tokens) of models that don't report it and are not in 'context_budgets', 0 means no limit
+		"context_budget": 0,
+		# Context windows of models, one 'model tokens' per line; these override what providers report
+		"context_budgets": "",
+		# Tokens of the context window reserved for the answer of the LLM
+		"context_reserve": 4096,
+		# Compaction brings the context down to this fraction of the budget, so that next requests reuse the compacted prefix
+		"context_target": 0.75,
+		# The most recent exchanges are never compacted
+		"context_keep_exchanges": 2,
+		# Estimation of tokens: heuristic, tiktoken
+		"context_tokenizer": "heuristic",
+		# Cheap model that summarizes old exchanges; if empty, old exchanges are dropped without a summary
+		"context_summary_model": "",
+	}
+})
+
+
+class HeuristicTokenizer():
+	'''
+	Approximate count of tokens, about 4 bytes of UTF-8 per token.
+	'''
+
+	Name = "heuristic"
+
+	def count(self, text: str) -> int:
+		if len(text) == 0:
+			return 0
+		if text.isascii():
+			return len(text) // 4 + 1
+		return len(text.encode("utf-8")) // 4 + 1
+
+
+class TiktokenTokenizer():
+	'''
+	Count of tokens by the `tiktoken` module, the encoding of recent OpenAI models.
+	It is exact for these models and a close estimate for others.
+	'''
+
+	Name = "tiktoken"
+
+	def __init__(self):
+		import tiktoken
+		self.Encoding = tiktoken.get_encoding("o200k_base")
+
+	def count(self, text: str) -> int:
+		return len(self.Encoding.encode(text, disallowed_special=()))
+
+
+Tokenizers = {
+	"heuristic": HeuristicTokenizer,
+	"tiktoken": TiktokenTokenizer,
+}
+
+
+def create_tokenizer(name: str = "heuristic") -> HeuristicTokenizer:
+	tokenizer_class = Tokenizers.get(name)
+	if tokenizer_class is None:
+		L.warning("Unknown tokenizer, using 'heuristic'", struct_data={"context_tokenizer": name})
+		return HeuristicTokenizer()
+
+	try:
+		return tokenizer_class()
+	except ImportError:
+		L.warning("Tokenizer is not installed, using 'heuristic'", struct_data={"context_tokenizer": name})
+		return HeuristicTokenizer()
+
+
+_ITEM_TOKENS = 8  # Approximate overhead of the message structure per item
+_COLLAPSED_OUTPUT = "[The output of the tool was removed from the context to save space.]"
+_SUMMARY_INSTRUCTIONS = """Summarize the conversation between the user and the AI assistant below.
+Keep facts, decisions, names, numbers, results of tools and open questions that may be needed to continue the conversation.
+Be concise, write only the summary."""
+
+
+class ContextWindow():
+	'''
+	The part of the conversation that is sent to the LLM, see `ContextManager`.
+
+	Exchanges before `Start` are replaced by the `Summary` (or dropped if there is none),
+	function calls in `Collapsed` are sent without their output.
+	'''
+
+	def __init__(self):
+		self.Start = 0
+		self.Summary = None
+		self.Collapsed = set()  # Ids of items
+		self.Tokens = {}  # Item id -> estimated tokens of the settled item
+
+
+	def view(self, item):
+		'''
+		The item as it is sent to the LLM, `None` if it is dropped.
+		'''
+		if item.id not in self.Collapsed:
+			return item
+		if item.type == 'function_call':
+			return FunctionCall(
+				call_id=item.call_id,
+				name=item.name,
+				arguments=item.arguments,
+				status=item.status,
+				content=_COLLAPSED_OUTPUT,
+				error=item.error,
+				id=item.id,
+				created=item.created,
+			)
+		return None
+
+
+class ContextManager():
+	'''
+	Keeps conversations within the context window of the model.
+
+	Tokens of items are estimated by the tokenizer (estimates of settled items are cached).
+	Reasoning items are not sent to LLMs by any provider, they don't count.
+	When the conversation doesn't fit the budget of the model, older exchanges are compacted, the oldest first:
+
+	1. outputs of tools are collapsed,
+	2. exchanges of whole user turns are replaced by the summary produced by `context_summary_model` (or dropped).
+
+	The compaction goes down to the `context_target` fraction of the budget, the compacted prefix of the conversation
+	stays the same for next requests so that payload and prompt caches are reused until the next compaction.
+	The most recent `context_keep_exchanges` exchanges are never compacted.
+	'''
+
+	def __init__(self, router):
+		self.LLMRouterService = router
+
+		self.DefaultBudget = asab.Config.getint("llm", "context_budget")
+		self.Reserve = asab.Config.getint("llm", "context_reserve")
+		self.Target = asab.Config.getfloat("llm", "context_target")
+		self.KeepExchanges = max(1, asab.Config.getint("llm", "context_keep_exchanges"))
+		self.SummaryModel = asab.Config.get("llm", "context_summary_model").strip()
+
+		self.Budgets = {}  # Model -> tokens
+		for line in asab.Config.get("llm", "context_budgets").splitlines():
+			line = line.strip()
+			if len(line) == 0:
+				continue
+			try:
+				model, tokens = line.rsplit(None, 1)
+				self.Budgets[model] = int(tokens)
+			except ValueError:
+				L.warning("Invalid context budget", struct_data={"line": line})
+
+		self.Tokenizer = create_tokenizer(asab.Config.get("llm", "context_tokenizer"))
+
+		self.Counter = router.MetricsService.create_counter(
+			"llm_context_compactions",
+			init_values={"collapsed": 0, "summarized": 0, "dropped": 0},
+			help="Items collapsed and exchanges summarized or dropped to fit conversations into context windows",
+		)
+
+
+	def get_budget(self, model: str) -> int:
+		'''
+		Tokens of the conversation that fit the context window of the model, 0 means no limit.
+		'''
+		window = self.Budgets.get(model)
+		if window is None:
+			# vLLM reports 'max_model_len', some other providers 'context_length'
+			lengths = [
+				model_info.get('max_model_len') or model_info.get('context_length')
+				for provider in self.LLMRouterService.ModelCatalog.get_providers(model)
+				for model_info in provider.Models
+				if model_info.get('id') == model
+			]
+			lengths = [length for length in lengths if isinstance(length, int) and length > 0]
+			window = min(lengths) if len(lengths) > 0 else self.DefaultBudget
+
+		if window <= 0:
+			return 0
+		return max(window - self.Reserve, window // 2)
+
+
+	def estimate(self, conversation: Conversation) -> int:
+		'''
+		Estimated tokens of instructions and items that are sent to the LLM.
+		'''
+		window = conversation.context
+		if window is None:
+			window = conversation.context = ContextWindow()
+
+		tokens = self.Tokenizer.count(conversation.get_instructions())
+		for exchange in conversation.exchanges[window.Start:]:
+			for item in exchange.items:
+				tokens += self._get_item_tokens(window, item)
+		return tokens
+
+
+	async def prepare(self, conversation: Conversation, model: str) -> None:
+		'''
+		Compact the conversation if it doesn't fit the budget of the model.
+		'''
+		budget = self.get_budget(model)
+		if budget <= 0:
+			return
+
+		tokens = self.estimate(conversation)
+		if tokens <= budget:
+			return
+
+		window = conversation.context
+		target = int(budget * self.Target)
+		keep_from = max(window.Start, len(conversation.exchanges) - self.KeepExchanges)
+		tokens_before = tokens
+
+		# Collapse outputs of tools first, they are the least useful part of old exchanges
+		collapsed = 0
+		for exchange in conversation.exchanges[window.Start:keep_from]:
+			if tokens <= target:
+				break
+			for item in exchange.items:
+				if item.type != 'function_call' or item.id in window.Collapsed:
+					continue
+				item_tokens = self._get_item_tokens(window, item)
+				window.Collapsed.add(item.id)
+				window.Tokens.pop(item.id, None)
+				tokens += self._get_item_tokens(window, item) - item_tokens
+				collapsed += 1
+
+		# Then remove whole user turns, the window starts with a user message so that every provider accepts it
+		start = window.Start
+		cut = start
+		removed_tokens = 0
+		tokens_at_cut = tokens
+		for i in range(start, keep_from):
+			if tokens - removed_tokens <= target:
+				break
+			removed_tokens += sum(self._get_item_tokens(window, item) for item in conversation.exchanges[i].items)
+			if i + 1 < len(conversation.exchanges) and _starts_user_turn(conversation.exchanges[i + 1]):
+				cut = i + 1
+				tokens_at_cut = tokens - removed_tokens
+
+		summarized = False
+		if cut > start:
+			summary = None
+			if len(self.SummaryModel) > 0:
+				summary = await self._summarize(conversation, cut)
+
+			if summary is not None:
+				window.Summary = summary
+				summarized = True
+
+			for exchange in conversation.exchanges[start:cut]:
+				for item in exchange.items:
+					window.Tokens.pop(item.id, None)
+					window.Collapsed.discard(item.id)
+			window.Start = cut
+			tokens = tokens_at_cut
+
+		if collapsed == 0 and cut == start:
+			L.warning("Conversation doesn't fit the context window", struct_data={
+				"conversation_id": conversation.conversation_id,
+				"model": model,
+				"tokens": tokens,
+				"budget": budget,
+			})
+			return
+
+		# Converted messages don't match the compacted conversation
+		conversation.payload_cache.clear()
+		self.LLMRouterService.Conversations.invalidate(conversation)
+
+		self.Counter.add("collapsed", collapsed)
+		self.Counter.add("summarized" if summarized else "dropped", cut - start)
+		L.log(asab.LOG_NOTICE, "Conversation compacted", struct_data={
+			"conversation_id": conversation.conversation_id,
+			"model": model,
+			"budget": budget,
+			"tokens_before": tokens_before,
+			"tokens": self.estimate(conversation),
+			"collapsed": collapsed,
+			"exchanges": cut - start,
+			"summarized": summarized,
+		})
+
+
+	async def _summarize(self, conversation: Conversation, cut: int) -> str | None:
+		'''
+		Summarize exchanges of the context window up to `cut` (and the previous summary) by the summary model.
+		'''
+		window = conversation.context
+		lines = []
+		if window.Summary is not None:
+			lines.append("Summary of the earlier part of the conversation: " + window.Summary)
+
+		for exchange in conversation.exchanges[window.Start:cut]:
+			for item in exchange.items:
+				item = window.view(item)
+				if isinstance(item, UserMessage):
+					lines.append("User: " + item.content)
+				elif isinstance(item, AssistentMessage):
+					lines.append("Assistant: " + item.content)
+				elif isinstance(item, FunctionCall):
+					lines.append("Tool call {}({}): {}".format(item.name, item.arguments, item.content))
+
+		completion = ChatCompletion(self.LLMRouterService, self.SummaryModel)
+		try:
+			await completion.start(conversation.tenant, [
+				{"role": "system", "content": _SUMMARY_INSTRUCTIONS},
+				{"role": "user", "content": "\n\n".join(lines)},
+			], tools=False)
+			await completion.wait()
+			if completion.Error is not None:
+				L.warning("Summary of the conversation failed", struct_data={"conversation_id": conversation.conversation_id, "error": completion.Error})
+				return None
+			return completion.get_content()
+
+		except Exception:
+			L.exception("Summary of the conversation failed", struct_data={"conversation_id": conversation.conversation_id})
+			return None
+
+		finally:
+			await completion.close()
+
+
+	def _get_item_tokens(self, window: ContextWindow, item) -> int:
+		tokens = window.Tokens.get(item.id)
+		if tokens is not None:
+			return tokens
+
+		view = window.view(item)
+		if view is None or view.type == 'reasoning':
+			# Providers don't convert reasoning items to messages
+			tokens = 0
+		else:
+			tokens = _ITEM_TOKENS + self.Tokenizer.count(view.content)
+			if view.type == 'function_call':
+				tokens += self.Tokenizer.count(view.arguments)
+
+		if is_settled(item):
+			window.Tokens[item.id] = tokens
+		return tokens
+
+
+def _starts_user_turn(exchange) -> bool:
+	return len(exchange.items) > 0 and isinstance(exchange.items[0], UserMessage)
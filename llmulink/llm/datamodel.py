@@ -1,5 +1,6 @@
 from asyncio import Task
-import uuid
+import time
+import random
 import typing
 import datetime
 
@@ -13,13 +14,130 @@ def _utc_now() -> datetime.datetime:
 	return datetime.datetime.now(datetime.timezone.utc)
 
 
-class AssistentReasoning(pydantic.BaseModel):
+def _new_id() -> int:
+	"""Random 64-bit identifier of the item, unique enough across restarts and nodes of the cluster."""
+	return random.getrandbits(64)
+
+
+class ContentBuffer():
+	"""
+	Append-optimized text of a streaming item.
+
+	Appended chunks are joined only when the text is read and the result is cached until the next append,
+	so growing the text token by token is linear instead of quadratic.
+	"""
+	__slots__ = ('Chunks', 'Length', 'Text')
+
+	def __init__(self, text: str = ''):
+		self.Chunks = [text] if len(text) > 0 else []
+		self.Length = len(text)
+		self.Text = text
+
+	def __len__(self) -> int:
+		return self.Length
+
+	def append(self, text: str) -> None:
+		if len(text) == 0:
+			return
+		self.Chunks.append(text)
+		self.Length += len(text)
+		self.Text = None
+
+	def get(self) -> str:
+		if self.Text is None:
+			self.Text = ''.join(self.Chunks)
+			self.Chunks = [self.Text]
+		return self.Text
+
+	def since(self, offset: int) -> str:
+		"""
+		Text after `offset`, only the chunks that contain it are joined.
+		"""
+		if self.Text is not None:
+			return self.Text[offset:]
+		tail = []
+		position = self.Length
+		for chunk in reversed(self.Chunks):
+			if position <= offset:
+				break
+			tail.append(chunk)
+			position -= len(chunk)
+		tail.reverse()
+		return ''.join(tail)[offset - position:]
+
+
+def _get_text(value: str | ContentBuffer) -> str:
+	return value if value.__class__ is str else value.get()
+
+
+def _append_text(value: str | ContentBuffer, text: str) -> ContentBuffer:
+	if value.__class__ is str:
+		# The buffer is created on the first append, items that don't stream keep the plain string
+		value = ContentBuffer(value)
+	value.append(text)
+	return value
+
+
+class _Item():
+	"""
+	Compact item of the conversation, used on the hot path (streaming of deltas, building of payloads).
+
+	Items are slotted objects with an integer identifier and an epoch timestamp;
+	the string `key` and the ISO `created_at` are produced on demand for the API.
+
+	The `content` grows by `append_content()` while the item streams, see `ContentBuffer`.
+	"""
+	__slots__ = ('id', 'created', '_content')
+	KeyPrefix = None
+
+	def __init__(self, id: int | None = None, created: float | None = None):
+		self.id = id if id is not None else _new_id()
+		self.created = created if created is not None else time.time()
+
+	@property
+	def content(self) -> str:
+		return _get_text(self._content)
+
+	@content.setter
+	def content(self, value: str) -> None:
+		self._content = value
+
+	@property
+	def content_length(self) -> int:
+		return len(self._content)
+
+	def append_content(self, text: str) -> None:
+		self._content = _append_text(self._content, text)
+
+	def content_since(self, offset: int) -> str:
+		"""
+		The part of the `content` after `offset`, e.g. the text not yet sent to the client.
+		"""
+		content = self._content
+		return content[offset:] if content.__class__ is str else content.since(offset)
+
+	@property
+	def key(self) -> str:
+		return "{}-{:016x}".format(self.KeyPrefix, self.id)
+
+	@property
+	def created_at(self) -> datetime.datetime:
+		return datetime.datetime.fromtimestamp(self.created, datetime.timezone.utc)
+
+	def __repr__(self) -> str:
+		return "<{} {}>".format(self.__class__.__name__, self.key)
+
+
+class AssistentReasoning(_Item):
 	"""Reasoning block from the LLM response."""
-	content: str
-	status: str
-	key: str = pydantic.Field(default_factory=lambda: "reasoning-{}".format(str(uuid.uuid4())))
-	type: typing.Literal['reasoning'] = 'reasoning'
-	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+	__slots__ = ('status',)
+	KeyPrefix = "reasoning"
+	type = 'reasoning'
+
+	def __init__(self, content: str, status: str, **kwargs):
+		super().__init__(**kwargs)
+		self.content = content
+		self.status = status
 
 	def to_dict(self) -> dict:
 		return {
@@ -31,14 +149,17 @@ class AssistentReasoning(pydantic.BaseModel):
 		}
 
 
-class AssistentMessage(pydantic.BaseModel):
+class AssistentMessage(_Item):
 	"""Message block from the LLM response."""
-	content: str
-	status: str
-	role: str
-	key: str = pydantic.Field(default_factory=lambda: "message-{}".format(str(uuid.uuid4())))
-	type: typing.Literal['message'] = 'message'
-	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+	__slots__ = ('status', 'role')
+	KeyPrefix = "message"
+	type = 'message'
+
+	def __init__(self, content: str, status: str, role: str, **kwargs):
+		super().__init__(**kwargs)
+		self.content = content
+		self.status = status
+		self.role = role
 
 	def to_dict(self) -> dict:
 		return {
@@ -51,14 +172,17 @@ class AssistentMessage(pydantic.BaseModel):
 		}
 
 
-class UserMessage(pydantic.BaseModel):
+class UserMessage(_Item):
 	"""User message (item) in a conversation."""
-	role: str
-	content: str
-	model: str
-	key: str = pydantic.Field(default_factory=lambda: "user-message-{}".format(str(uuid.uuid4())))
-	type: typing.Literal['message'] = 'message'
-	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+	__slots__ = ('role', 'model')
+	KeyPrefix = "user-message"
+	type = 'message'
+
+	def __init__(self, role: str, content: str, model: str, **kwargs):
+		super().__init__(**kwargs)
+		self.role = role
+		self.content = content
+		self.model = model
 
 	def to_dict(self) -> dict:
 		return {
@@ -71,17 +195,31 @@ class UserMessage(pydantic.BaseModel):
 		}
 
 
-class FunctionCall(pydantic.BaseModel):
+class FunctionCall(_Item):
 	"""Function call block from the LLM response."""
-	call_id: str
-	name: str
-	arguments: str
-	status: str
-	content: str = ''
-	error: bool = False
-	key: str = pydantic.Field(default_factory=lambda: "fc-{}".format(str(uuid.uuid4())))
-	type: typing.Literal['function_call'] = 'function_call'
-	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+	__slots__ = ('call_id', 'name', '_arguments', 'status', 'error')
+	KeyPrefix = "fc"
+	type = 'function_call'
+
+	def __init__(self, call_id: str, name: str, arguments: str, status: str, content: str = '', error: bool = False, **kwargs):
+		super().__init__(**kwargs)
+		self.call_id = call_id
+		self.name = name
+		self.arguments = arguments
+		self.status = status
+		self.content = content
+		self.error = error
+
+	@property
+	def arguments(self) -> str:
+		return _get_text(self._arguments)
+
+	@arguments.setter
+	def arguments(self, value: str) -> None:
+		self._arguments = value
+
+	def append_arguments(self, text: str) -> None:
+		self._arguments = _append_text(self._arguments, text)
 
 	def to_dict(self) -> dict:
 		return {
@@ -96,6 +234,12 @@ class FunctionCall(pydantic.BaseModel):
 		}
 
 
+class UserMessageCreated(pydantic.BaseModel):
+	"""Request of the client to add the user message, validated at the API boundary and then turned into `UserMessage`."""
+	content: str = ''
+	model: str | None = None
+
+
 class ChatToolResult(pydantic.BaseModel):
 	"""Result of a tool/function execution."""
 	call_id: str
@@ -103,39 +247,148 @@ class ChatToolResult(pydantic.BaseModel):
 	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
 
 
+class Usage(pydantic.BaseModel):
+	"""Token usage of a single request to the LLM."""
+	input_tokens: int = 0  # All input tokens, including these read from or written to the prompt cache
+	output_tokens: int = 0
+	cache_read_tokens: int = 0  # Input tokens served from the prompt cache of the provider
+	cache_creation_tokens: int = 0  # Input tokens written to the prompt cache of the provider
+
+	def to_dict(self) -> dict:
+		return {
+			"input_tokens": self.input_tokens,
+			"output_tokens": self.output_tokens,
+			"cache_read_tokens": self.cache_read_tokens,
+			"cache_creation_tokens": self.cache_creation_tokens,
+		}
+
+
 class Exchange(pydantic.BaseModel):
 	"""An exchange between the user and the LLM."""
-	items: list[UserMessage|AssistentReasoning|AssistentMessage|FunctionCall] = pydantic.Field(default_factory=list)
+	# UserMessage, AssistentReasoning, AssistentMessage or FunctionCall; these are not validated by pydantic
+	# Items are added by `append_item()`, so that lookups stay indexed
+	items: list[typing.Any] = pydantic.Field(default_factory=list)
 	completed: bool = False
+	usage: Usage | None = None
+
+	_last_items: dict[str, typing.Any] = pydantic.PrivateAttr(default_factory=dict)  # item type -> the last item of that type
+	_conversation: typing.Any = pydantic.PrivateAttr(default=None)  # The conversation the exchange is appended to
+	_index: int = pydantic.PrivateAttr(default=0)  # Index of the exchange in the conversation
+
+	def append_item(self, item: UserMessage | AssistentReasoning | AssistentMessage | FunctionCall) -> None:
+		self.items.append(item)
+		self._last_items[item.type] = item
+		if self._conversation is not None:
+			self._conversation._index_item(self._index, len(self.items) - 1, item)
 
 	def get_last_item(self, item_type: typing.Literal['message', 'reasoning', 'function_call']) -> UserMessage|AssistentReasoning|FunctionCall:
-		for item in reversed(self.items):
-			if item.type == item_type:
-				return item
-		return None
+		return self._last_items.get(item_type)
 
 
 class Conversation(pydantic.BaseModel):
 	"""A complete conversation."""
 	conversation_id: str
 	instructions: str
+	tenant: str | None = None
 	tools: list[FunctionCallTool] = pydantic.Field(default_factory=list)
 	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
 
 	exchanges: list[Exchange] = pydantic.Field(default_factory=list)
 
-	monitors: set[typing.Callable] = pydantic.Field(default_factory=set)
+	# Outbound queues of connected clients, see `ConversationMonitor`
+	monitors: set[typing.Any] = pydantic.Field(default_factory=set)
 		
 	tasks: list[typing.Callable] = pydantic.Field(default_factory=list)
 	chat_requested: bool = False  # If true, then a LLMService will request a new exchange with the LLM when tasks are completed
 
+	# Already converted messages per provider format, see `LLMChatProviderABC.build_messages()`
+	payload_cache: dict[str, typing.Any] = pydantic.Field(default_factory=dict)
 
-	def get_model(self) -> str | None:
+	# Merges item deltas sent to monitors, see `DeltaCoalescer`
+	coalescer: typing.Any = None
+
+	# Versions and last sent fields of items, see `ItemPatcher`
+	patcher: typing.Any = None
+
+	# Sequence number of the last event sent to monitors and recent events for clients that resume
+	sequence: int = 0
+	replay: typing.Any = None
+
+	# Serialized items for full updates, see `ConversationSnapshot`
+	snapshot: typing.Any = None
+
+	# The part of the conversation that is sent to the LLM, see `ContextWindow`
+	context: typing.Any = None
+
+
+	_item_index: dict[str, tuple[int, int]] = pydantic.PrivateAttr(default_factory=dict)  # item key -> (exchange index, item index)
+	_model: str | None = pydantic.PrivateAttr(default=None)  # Model of the most recent user message
+
+
+	def append_exchange(self, exchange: Exchange) -> None:
+		'''
+		Append the exchange, use it instead of `exchanges.append()` so that lookups stay indexed.
 		'''
-		Get the model from the most recent item in the conversation.
+		exchange._conversation = self
+		exchange._index = len(self.exchanges)
+		self.exchanges.append(exchange)
+		for item_index, item in enumerate(exchange.items):
+			self._index_item(exchange._index, item_index, item)
+
+
+	def truncate(self, exchange_index: int) -> list[Exchange]:
 		'''
+		Remove exchanges from `exchange_index` on, return the removed exchanges.
+		'''
+		removed = self.exchanges[exchange_index:]
+		del self.exchanges[exchange_index:]
+		for exchange in removed:
+			exchange._conversation = None
+			for item in exchange.items:
+				self._item_index.pop(item.key, None)
+
+		# Truncation is rare, the model is found by the scan
+		self._model = None
 		for exchange in reversed(self.exchanges):
 			for item in reversed(exchange.items):
 				if isinstance(item, UserMessage):
-					return item.model
-		return None
+					self._model = item.model
+					return removed
+
+		return removed
+
+
+	def find_item(self, key: str) -> tuple[int, int] | None:
+		'''
+		Get the (exchange index, item index) of the item with the `key`.
+		'''
+		return self._item_index.get(key)
+
+
+	def get_item(self, key: str) -> UserMessage | AssistentReasoning | AssistentMessage | FunctionCall | None:
+		position = self._item_index.get(key)
+		if position is None:
+			return None
+		return self.exchanges[position[0]].items[position[1]]
+
+
+	def get_instructions(self) -> str:
+		'''
+		Get instructions with the summary of exchanges that are no longer in the context window.
+		'''
+		if self.context is None or self.context.Summary is None:
+			return self.instructions
+		return self.instructions + "\n\nSummary of the earlier part of the conversation:\n" + self.context.Summary
+
+
+	def get_model(self) -> str | None:
+		'''
+		Get the model from the most recent user message in the conversation.
+		'''
+		return self._model
+
+
+	def _index_item(self, exchange_index: int, item_index: int, item) -> None:
+		self._item_index[item.key] = (exchange_index, item_index)
+		if isinstance(item, UserMessage):
+			self._model = item.model
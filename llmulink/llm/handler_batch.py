@@ -0,0 +1,121 @@
+import asyncio
+import logging
+
+import asab.web.rest
+import aiohttp.web
+
+from .batch import BatchJob
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class LLMBatchHandler():
+	'''
+	REST API of batch jobs, see `BatchJob`.
+
+	The input (JSONL) is the body of the POST request, results are kept in the memory until the job is deleted.
+	'''
+
+	def __init__(self, app):
+		self.LLMRouterService = app.LLMRouterService
+		self.JSONCodec = self.LLMRouterService.JSONCodec
+
+		self.Jobs = {}  # batch id -> (tenant, job, task, results)
+
+		web_app = app.WebContainer.WebApp
+		web_app.router.add_post(r"/{tenant}/v1/batches", self.create_batch)
+		web_app.router.add_get(r"/{tenant}/v1/batches", self.list_batches)
+		web_app.router.add_get(r"/{tenant}/v1/batches/{batch_id}", self.get_batch)
+		web_app.router.add_get(r"/{tenant}/v1/batches/{batch_id}/output", self.get_batch_output)
+		web_app.router.add_delete(r"/{tenant}/v1/batches/{batch_id}", self.delete_batch)
+
+
+	async def create_batch(self, request):
+		'''
+		Start the batch job, optional query parameters `concurrency` and `model_concurrency` override the configuration.
+		'''
+		tenant = request.match_info['tenant']
+		try:
+			concurrency = int(request.query['concurrency']) if 'concurrency' in request.query else None
+			model_concurrency = int(request.query['model_concurrency']) if 'model_concurrency' in request.query else None
+		except ValueError:
+			return asab.web.rest.json_response(request, {"result": "ERROR", "error": "Invalid concurrency"}, status=400)
+
+		lines = (await request.read()).splitlines()
+		results = []
+
+		async def write(result):
+			results.append(result)
+
+		job = BatchJob(self.LLMRouterService, write, concurrency=concurrency, model_concurrency=model_concurrency, tenant=tenant)
+		task = asyncio.create_task(job.run(_iter_lines(lines)), name="batch-{}".format(job.Id))
+		self.Jobs[job.Id] = (tenant, job, task, results)
+
+		L.log(asab.LOG_NOTICE, "Batch created", struct_data={"batch": job.Id, "tenant": tenant, "lines": len(lines)})
+		return asab.web.rest.json_response(request, job.get_stats())
+
+
+	async def list_batches(self, request):
+		tenant = request.match_info['tenant']
+		return asab.web.rest.json_response(request, [
+			job.get_stats()
+			for job_tenant, job, _, _ in self.Jobs.values()
+			if job_tenant == tenant
+		])
+
+
+	async def get_batch(self, request):
+		entry = self._get_job(request)
+		if entry is None:
+			return asab.web.rest.json_response(request, {"result": "NOT-FOUND"}, status=404)
+		return asab.web.rest.json_response(request, entry[1].get_stats())
+
+
+	async def get_batch_output(self, request):
+		'''
+		Results that are available so far, in JSONL.
+		'''
+		entry = self._get_job(request)
+		if entry is None:
+			return asab.web.rest.json_response(request, {"result": "NOT-FOUND"}, status=404)
+
+		response = aiohttp.web.StreamResponse(headers={"Content-Type": "application/jsonl"})
+		await response.prepare(request)
+		for result in list(entry[3]):
+			await response.write(self.JSONCodec.dumps(result).encode("utf-8") + b"\n")
+		await response.write_eof()
+		return response
+
+
+	async def delete_batch(self, request):
+		'''
+		Cancel the batch job (if it is running) and forget its results.
+		'''
+		entry = self._get_job(request)
+		if entry is None:
+			return asab.web.rest.json_response(request, {"result": "NOT-FOUND"}, status=404)
+
+		_, job, task, _ = entry
+		task.cancel()
+		try:
+			await task
+		except asyncio.CancelledError:
+			pass
+		del self.Jobs[job.Id]
+		return asab.web.rest.json_response(request, job.get_stats())
+
+
+	def _get_job(self, request):
+		entry = self.Jobs.get(request.match_info['batch_id'])
+		if entry is None or entry[0] != request.match_info['tenant']:
+			return None
+		return entry
+
+
+async def _iter_lines(lines: list):
+	for line in lines:
+		yield line
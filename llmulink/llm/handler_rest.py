@@ -0,0 +1,121 @@
+import logging
+
+import aiohttp.web
+
+from .completion import ChatCompletion
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class LLMRestHandler():
+	'''
+	OpenAI-compatible chat completions endpoint, see `ChatCompletion`.
+
+	The request is stateless, the conversation is built from `messages` of the request and dropped after the response.
+	Tools of the request (client-side tools) are not supported.
+	'''
+
+	def __init__(self, app):
+		self.LLMRouterService = app.LLMRouterService
+		self.JSONCodec = self.LLMRouterService.JSONCodec
+		app.WebContainer.WebApp.router.add_post(r"/{tenant}/v1/chat/completions", self.chat_completions)
+
+
+	async def chat_completions(self, request):
+		try:
+			body = self.JSONCodec.loads(await request.read())
+		except self.JSONCodec.DecodeError:
+			return self._error_response(400, "Request body is not a valid JSON")
+
+		if not isinstance(body, dict):
+			return self._error_response(400, "Request body must be a JSON object")
+		if not isinstance(body.get('stream_options') or {}, dict):
+			return self._error_response(400, "'stream_options' must be an object")
+
+		model = body.get('model')
+		if not isinstance(model, str):
+			return self._error_response(400, "'model' must be a string")
+		models = await self.LLMRouterService.get_models()
+		if models is None or model not in models:
+			return self._error_response(404, "The model '{}' does not exist".format(model), error_type="not_found_error")
+
+		completion = ChatCompletion(self.LLMRouterService, model)
+		try:
+			try:
+				await completion.start(request.match_info['tenant'], body.get('messages'))
+			except ValueError as e:
+				return self._error_response(400, str(e))
+
+			if body.get('stream', False):
+				include_usage = (body.get('stream_options') or {}).get('include_usage', False)
+				return await self._stream_response(request, completion, include_usage)
+
+			await completion.wait()
+			if completion.Error is not None:
+				return self._error_response(502, completion.Error, error_type="api_error")
+
+			return aiohttp.web.Response(
+				body=self.JSONCodec.dumps(completion.to_dict()),
+				content_type="application/json",
+			)
+
+		finally:
+			await completion.close()
+
+
+	async def _stream_response(self, request, completion: ChatCompletion, include_usage: bool):
+		response = aiohttp.web.StreamResponse(headers={
+			"Content-Type": "text/event-stream",
+			"Cache-Control": "no-cache",
+		})
+		await response.prepare(request)
+
+		async def send_chunk(delta: dict, finish_reason=None):
+			chunk = {
+				"id": completion.Id,
+				"object": "chat.completion.chunk",
+				"created": completion.Created,
+				"model": completion.Model,
+				"choices": [{
+					"index": 0,
+					"delta": delta,
+					"finish_reason": finish_reason,
+				}],
+			}
+			await response.write(b"data: " + self.JSONCodec.dumps(chunk).encode("utf-8") + b"\n\n")
+
+		await send_chunk({"role": "assistant", "content": ""})
+		async for field, text in completion.contents():
+			await send_chunk({field: text})
+
+		if completion.Error is not None:
+			await response.write(b"data: " + self.JSONCodec.dumps({
+				"error": {"message": completion.Error, "type": "api_error"},
+			}).encode("utf-8") + b"\n\n")
+		else:
+			await send_chunk({}, finish_reason="stop")
+			if include_usage:
+				await response.write(b"data: " + self.JSONCodec.dumps({
+					"id": completion.Id,
+					"object": "chat.completion.chunk",
+					"created": completion.Created,
+					"model": completion.Model,
+					"choices": [],
+					"usage": completion.get_usage(),
+				}).encode("utf-8") + b"\n\n")
+
+		await response.write(b"data: [DONE]\n\n")
+		await response.write_eof()
+		return response
+
+
+	def _error_response(self, status: int, message: str, error_type: str = "invalid_request_error"):
+		return aiohttp.web.Response(
+			status=status,
+			body=self.JSONCodec.dumps({"error": {"message": message, "type": error_type}}),
+			content_type="application/json",
+		)
@@ -1,21 +1,44 @@
-import json
 import weakref
 import asyncio
 import logging
 
+import asab
 import asab.web.rest
 import aiohttp.web
 
 
-from .datamodel import UserMessage
+from .datamodel import UserMessage, UserMessageCreated
+from .codec import MessagePackCodec
+from .cluster import PROXIED_HEADER
 
 
 L = logging.getLogger(__name__)
 
 
+asab.Config.add_defaults({
+	"llm": {
+		# Negotiate permessage-deflate compression of websocket frames with clients that offer it
+		"ws_compress": True,
+		# Offer 'asab.msgpack' websocket subprotocol (MessagePack binary frames) next to 'asab' (JSON text frames)
+		"ws_msgpack": True,
+	}
+})
+
+
 class LLMWebHandler():
 	def __init__(self, app):
 		self.LLMRouterService = app.LLMRouterService
+		self.JSONCodec = self.LLMRouterService.JSONCodec
+		self.Compress = asab.Config.getboolean("llm", "ws_compress")
+
+		self.Protocols = ('asab',)
+		self.MessagePackCodec = None
+		if asab.Config.getboolean("llm", "ws_msgpack"):
+			try:
+				self.MessagePackCodec = MessagePackCodec()
+				self.Protocols = ('asab', 'asab.msgpack')
+			except ImportError:
+				L.warning("Module 'msgpack' is not installed, websocket subprotocol 'asab.msgpack' is not available")
 		app.WebContainer.WebApp.router.add_get(r"/{tenant}/llm/conversation", self.ws_conversation)
 
 		self.Websockets = weakref.WeakSet()
@@ -28,20 +51,41 @@ class LLMWebHandler():
 		if models is None or len(models) == 0:
 			return asab.web.rest.json_response(request, {"result": "ERROR", "error": "No LLM models available"})
 
+		tenant = request.match_info['tenant']
+		try:
+			conversation, owner = await self.LLMRouterService.open_conversation(tenant, request.query.get('conversation_id'))
+		except ValueError as e:
+			return asab.web.rest.json_response(request, {"result": "ERROR", "error": str(e)}, status=400)
+		if owner is not None:
+			if PROXIED_HEADER in request.headers:
+				# The ownership has moved since the client was proxied here, a local copy would split the conversation
+				L.warning("Proxied conversation is owned by another node", struct_data={"conversation_id": request.query.get('conversation_id'), "owner": owner})
+				return asab.web.rest.json_response(request, {"result": "ERROR", "error": "Conversation is owned by another node"}, status=409)
+			return await self.proxy_to_owner(request, owner)
+		if conversation is None:
+			return asab.web.rest.json_response(request, {"result": "ERROR", "error": "Conversation is lost, its node is gone; open a new conversation"}, status=404)
+
 		ws = aiohttp.web.WebSocketResponse(
 			receive_timeout=60.0,
-			protocols=('asab',)
+			protocols=self.Protocols,
+			compress=self.Compress,
 		)
+		await ws.prepare(request)
 
-		conversation_id = request.query.get('conversation_id')
-		if conversation_id is None:
-			conversation = await self.LLMRouterService.create_conversation()
+		# MessagePack binary frames for 'asab.msgpack' subprotocol, JSON text frames otherwise
+		if ws.ws_protocol == 'asab.msgpack':
+			dumps, send = self.MessagePackCodec.dumps, ws.send_bytes
 		else:
-			conversation = await self.LLMRouterService.get_conversation(conversation_id, create=True)
+			dumps, send = self.JSONCodec.dumps, ws.send_str
 
-		await ws.prepare(request)
+		async def reply_to_client(data):
+			"""
+			Closure that is responsible for sending replay from the LLM (etc) to the client.
+			It is called by the writer task of the monitor, never directly by the LLM stream.
+			"""
+			await send(dumps(data))
 
-		await ws.send_json({
+		await reply_to_client({
 			"type": "chat.mounted",
 			"conversation_id": conversation.conversation_id,
 			"models": models,
@@ -49,17 +93,24 @@ class LLMWebHandler():
 
 		self.Websockets.add(ws)
 
-		async def reply_to_client(data):
-			"""
-			Closure that is responsible for sending replay from the LLM (etc) to the client.
-			Works as a monitor for the conversation.
-			"""
-			await ws.send_json(data)
+		# Client may want only the most recent exchanges in full updates
+		try:
+			exchanges = int(request.query['exchanges'])
+		except (KeyError, ValueError):
+			exchanges = None
+
+		monitor = self.LLMRouterService.create_monitor(conversation, reply_to_client, ws.close, exchanges)
 
-		# Send initial full update so that the client has the current state of the conversation
-		await self.LLMRouterService.send_full_update(conversation, reply_to_client)
+		# A reconnecting client receives only events it has missed (if they are still available),
+		# otherwise send initial full update so that the client has the current state of the conversation
+		try:
+			last_seq = int(request.query['last_seq'])
+		except (KeyError, ValueError):
+			last_seq = None
+		if last_seq is None or not await self.LLMRouterService.resume(conversation, monitor, last_seq):
+			await self.LLMRouterService.send_full_update(conversation, monitor, exchanges)
 
-		conversation.monitors.add(reply_to_client)
+		conversation.monitors.add(monitor)
 		try:
 			async for msg in ws:
 
@@ -67,12 +118,16 @@ class LLMWebHandler():
 
 					match (msg.type):
 
-						case aiohttp.WSMsgType.TEXT:
-							data = json.loads(msg.data)
+						case aiohttp.WSMsgType.TEXT | aiohttp.WSMsgType.BINARY:
+							if msg.type == aiohttp.WSMsgType.BINARY and self.MessagePackCodec is not None:
+								data = self.MessagePackCodec.loads(msg.data)
+							else:
+								data = self.JSONCodec.loads(msg.data)
 							match data.get('type'):
 
 								case 'user.message.created':
-									user_message = UserMessage(role='user', content=data.get('content', ''), model=data.get('model', models[0]))
+									created = UserMessageCreated.model_validate(data)
+									user_message = UserMessage(role='user', content=created.content, model=created.model or models[0])
 									await self.LLMRouterService.create_exchange(conversation, user_message)
 
 								case 'conversation.stop':
@@ -80,20 +135,23 @@ class LLMWebHandler():
 
 								case 'conversation.restart':
 									self.LLMRouterService.restart_conversation(conversation, key=data.get('key'))
-									await self.App.LLMRouterService.send_full_update(conversation, reply_to_client)
+									await self.LLMRouterService.send_full_update(conversation, monitor, exchanges)
 
 								case 'conversation.instructions.update':
 									await self.LLMRouterService.update_instructions(conversation, data.get('item'), data.get('params', {}))
 
 								case 'update.full.requested':
-									await self.LLMRouterService.send_full_update(conversation, reply_to_client)
+									await self.LLMRouterService.send_full_update(conversation, monitor, _get_exchanges(data, exchanges))
+
+								case 'update.page.requested':
+									await self.LLMRouterService.send_page(conversation, monitor, data.get('before'), _get_exchanges(data, exchanges))
+
+								case 'item.resync.requested':
+									await self.LLMRouterService.send_item(conversation, monitor, data.get('key'))
 
 								case _:
 									L.warning("Unknown message type receive", struct_data={"data": data})
 
-						case aiohttp.WSMsgType.BINARY:
-							print("aiohttp.WSMsgType.BINARY>", msg.data)
-
 						case aiohttp.WSMsgType.CLOSE:
 							print("aiohttp.WSMsgType.CLOSE!")
 							await ws.close()
@@ -108,7 +166,53 @@ class LLMWebHandler():
 					break
 		
 		finally:
-			conversation.monitors.discard(reply_to_client)
+			conversation.monitors.discard(monitor)
+			await monitor.stop()
+
+		return ws
+
+
+	async def proxy_to_owner(self, request, owner: str):
+		'''
+		Relay frames between the client and the websocket of the node that owns the conversation (in the cluster mode).
+		'''
+		protocols = [protocol.strip() for protocol in request.headers.get('Sec-WebSocket-Protocol', '').split(',') if len(protocol.strip()) > 0]
+		try:
+			upstream = await self.LLMRouterService.Cluster.connect(owner, request.rel_url.path_qs, protocols)
+		except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+			L.warning("Cannot connect to the owner of the conversation", struct_data={"owner": owner, "error": str(e)})
+			return asab.web.rest.json_response(request, {"result": "ERROR", "error": "Owner of the conversation is not available"}, status=502)
+
+		ws = aiohttp.web.WebSocketResponse(
+			receive_timeout=60.0,
+			protocols=(upstream.protocol,) if upstream.protocol is not None else (),
+			compress=self.Compress,
+		)
+		await ws.prepare(request)
+		self.Websockets.add(ws)
+
+		async def relay(source, target):
+			async for msg in source:
+				match msg.type:
+					case aiohttp.WSMsgType.TEXT:
+						await target.send_str(msg.data)
+					case aiohttp.WSMsgType.BINARY:
+						await target.send_bytes(msg.data)
+					case _:
+						return
+
+		tasks = [
+			asyncio.create_task(relay(ws, upstream)),
+			asyncio.create_task(relay(upstream, ws)),
+		]
+		try:
+			# The websocket ends when either side closes it
+			await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			for task in tasks:
+				task.cancel()
+			await upstream.close()
+			await ws.close()
 
 		return ws
 
@@ -119,3 +223,17 @@ class LLMWebHandler():
 				if ws.closed:
 					continue
 				tg.create_task(ws.ping())
+
+
+def _get_exchanges(data: dict, default: int | None) -> int | None:
+	'''
+	The number of exchanges requested by the client, `default` if it is missing or invalid.
+	'''
+	exchanges = data.get('exchanges')
+	if exchanges is None:
+		return default
+	try:
+		return int(exchanges)
+	except (TypeError, ValueError):
+		L.warning("Invalid number of exchanges requested, using the default", struct_data={"exchanges": str(exchanges)[:100]})
+		return default
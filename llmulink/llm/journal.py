@@ -0,0 +1,716 @@
+import os
+import time
+import fcntl
+import asyncio
+import logging
+import datetime
+
+import asab
+
+from .datamodel import Conversation, Exchange, UserMessage, AssistentReasoning, AssistentMessage, FunctionCall
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+asab.Config.add_defaults({
+	"journal": {
+		# Directory of the durable log of conversations, conversations are recovered from it after a restart; empty disables the log
+		"path": "",
+		# Events are written in batches, one write (and fsync) per batch at most after this interval (in seconds)
+		"flush_interval": 0.1,
+		# 'false' leaves flushing of batches to the disk on the operating system, faster but the last seconds may be lost on a power failure
+		"fsync": True,
+		# The active segment is sealed and a new one started when it reaches this size (in bytes)
+		"segment_size": 67108864,
+		# Sealed segments are compacted to the current state of conversations every this many seconds; 0 disables
+		"compaction_interval": 3600,
+		# The compaction drops conversations idle for longer than this (in seconds); 0 keeps them forever
+		"retention": 2592000,
+	}
+})
+
+# Item classes by the key prefix and fields of the item that are persisted
+_ITEMS = {
+	AssistentReasoning.KeyPrefix: (AssistentReasoning, ('content', 'status')),
+	AssistentMessage.KeyPrefix: (AssistentMessage, ('content', 'status', 'role')),
+	UserMessage.KeyPrefix: (UserMessage, ('role', 'content', 'model')),
+	FunctionCall.KeyPrefix: (FunctionCall, ('call_id', 'name', 'arguments', 'status', 'content', 'error')),
+}
+
+_JOURNALED_EVENTS = frozenset(['item.appended', 'item.delta', 'item.patched', 'item.updated'])
+_INTERRUPTED_OUTPUT = "The function call was interrupted by the restart of the service, no result available."
+
+
+class _Segment():
+	'''
+	A file of the journal, `{number}.log`; sealed segments have the index `{number}.idx`.
+	'''
+	__slots__ = ('Number', 'Index', 'Size', 'Modified')
+
+	def __init__(self, number: int):
+		self.Number = number
+		self.Index = {}  # conversation id -> [offset of the first record, end of the last record, time of the last record]
+		self.Size = 0
+		self.Modified = time.time()
+
+
+class ConversationJournal():
+	'''
+	Durable append-only log of conversations of websocket clients, they survive the restart of the service.
+
+	Records are JSON lines: the creation of the conversation, events that change items (as sent to clients),
+	restarts and changes of instructions. Records are written behind: they are collected in the memory
+	and written with one fsync per batch every `flush_interval`; consecutive deltas of the same item are merged.
+
+	The log consists of segments. When the active segment reaches `segment_size`, it is sealed with an index
+	of byte ranges of conversations in the segment. The startup reads only these indexes (and scans the last segment
+	of the previous run, which is sealed then), so it doesn't depend on the size of the history.
+	A conversation is recovered lazily, when its client reconnects, from the ranges of the conversation in segments.
+
+	The periodic compaction rewrites sealed segments to one segment with the current state of conversations,
+	the creation record and one `item.appended` per item, and drops conversations idle for longer than `retention`.
+	The idle time is measured from the time of the last record of the conversation kept in indexes,
+	the compaction preserves it, so rewritten conversations still expire.
+	The creation record resets the conversation in the replay, so a compaction interrupted by a crash is harmless.
+
+	The journal belongs to one node: the directory is locked, the journal is not loaded if another process uses it.
+	In the cluster mode, every node needs its own `path`; only conversations of the node itself are recovered
+	(after its restart), conversations of a failed node are lost and their clients are told so (see `open_conversation`).
+	'''
+
+	def __init__(self, router, app, path: str):
+		self.LLMRouterService = router
+		self.JSONCodec = router.JSONCodec
+		self.Path = path
+
+		self.FlushInterval = asab.Config.getfloat("journal", "flush_interval")
+		self.FSync = asab.Config.getboolean("journal", "fsync")
+		self.SegmentSize = asab.Config.getint("journal", "segment_size")
+		self.CompactionInterval = asab.Config.getfloat("journal", "compaction_interval")
+		self.Retention = asab.Config.getfloat("journal", "retention")
+
+		self.Segments = {}  # number -> _Segment, the oldest first; the last one is active
+		self.Active = None
+		self.File = None  # The active segment open for appending
+		self.LockFile = None  # Holds the lock of the directory
+
+		self.Known = set()  # Ids of conversations in the journal, events of other conversations are not journaled
+		self.Pending = []  # Records not written yet
+		self.Lock = asyncio.Lock()  # Serializes operations with segment files
+		self.FlushTask = None
+		self.CompactionTask = None
+		self.CompactedNumber = None  # The segment produced by the last compaction
+		self.LastCompaction = time.monotonic()
+
+		self.Counter = app.MetricsService.create_counter(
+			"llm_journal",
+			init_values={"records": 0, "batches": 0, "bytes": 0, "recovered": 0, "compactions": 0, "errors": 0},
+			help="Records and batches written to the journal of conversations, conversations recovered from it",
+		)
+
+		app.PubSub.subscribe("Application.tick/60!", self._on_tick)
+
+
+	async def initialize(self):
+		t0 = time.perf_counter()
+		await asyncio.to_thread(self._load)
+		self.FlushTask = asyncio.create_task(self._flusher(), name="llm-journal-flush")
+		L.log(asab.LOG_NOTICE, "Journal of conversations loaded", struct_data={
+			"path": self.Path,
+			"segments": len(self.Segments) - 1,
+			"conversations": len(self.Known),
+			"duration": round(time.perf_counter() - t0, 3),
+		})
+
+
+	async def finalize(self):
+		if self.FlushTask is not None:
+			self.FlushTask.cancel()
+		if self.CompactionTask is not None:
+			# Files are being replaced, the compaction is not interrupted
+			await self.CompactionTask
+		async with self.Lock:
+			await self._flush()
+			if self.File is not None:
+				await asyncio.to_thread(self.File.close)
+				self.File = None
+		if self.LockFile is not None:
+			self.LockFile.close()
+			self.LockFile = None
+
+
+	# Records
+
+	def register(self, conversation: Conversation) -> None:
+		'''
+		Start journaling of a new conversation.
+		'''
+		self.Known.add(conversation.conversation_id)
+		self.Pending.append({
+			"c": conversation.conversation_id,
+			"t": "created",
+			"tenant": conversation.tenant,
+			"instructions": conversation.instructions,
+			"created": conversation.created_at.timestamp(),
+			"seq": conversation.sequence,
+		})
+
+
+	def forget(self, conversation_id: str) -> None:
+		'''
+		The conversation is not recovered anymore (e.g. it has been taken over by another node).
+		'''
+		if conversation_id not in self.Known:
+			return
+		self.Known.discard(conversation_id)
+		self.Pending.append({"c": conversation_id, "t": "removed"})
+
+
+	def on_event(self, conversation: Conversation, event: dict) -> None:
+		'''
+		Journal the event sent to clients of the conversation, if it changes items.
+		'''
+		conversation_id = conversation.conversation_id
+		if conversation_id not in self.Known:
+			return
+
+		event_type = event['type']
+		if event_type not in _JOURNALED_EVENTS:
+			return
+
+		if event_type == 'item.delta':
+			last = self.Pending[-1] if len(self.Pending) > 0 else None
+			if last is not None and last['c'] == conversation_id and last['t'] == 'event':
+				last_event = last['e']
+				if last_event['type'] == 'item.delta' and last_event['key'] == event['key']:
+					last['e'] = {"type": "item.delta", "key": event['key'], "delta": last_event['delta'] + event['delta'], "seq": event['seq']}
+					return
+
+		record = {"c": conversation_id, "t": "event", "e": event}
+		if event_type == 'item.appended':
+			position = conversation.find_item(event['item']['key'])
+			if position is None:
+				return
+			record['x'] = position[0]
+			item = conversation.exchanges[position[0]].items[position[1]]
+			if item.type == 'function_call':
+				# The call id is not sent to clients but providers need it
+				record['e'] = dict(event, item=dict(event['item'], call_id=item.call_id))
+
+		self.Pending.append(record)
+
+
+	def on_restart(self, conversation: Conversation, exchange_index: int) -> None:
+		if conversation.conversation_id not in self.Known:
+			return
+		self.Pending.append({"c": conversation.conversation_id, "t": "restart", "x": exchange_index, "seq": conversation.sequence})
+
+
+	def on_instructions(self, conversation: Conversation) -> None:
+		if conversation.conversation_id not in self.Known:
+			return
+		self.Pending.append({"c": conversation.conversation_id, "t": "instructions", "instructions": conversation.instructions})
+
+
+	# Recovery
+
+	async def recover(self, conversation_id: str, tools: list) -> Conversation | None:
+		'''
+		Rebuild the conversation from the journal, `None` if it is not in the journal.
+		'''
+		if conversation_id not in self.Known:
+			return None
+
+		async with self.Lock:
+			await self._flush()
+			conversation = await asyncio.to_thread(self._recover, conversation_id, list(self.Segments.values()), tools)
+
+		if conversation is None:
+			return None
+
+		self.Counter.add("recovered", 1)
+		L.log(asab.LOG_NOTICE, "Conversation recovered from the journal", struct_data={
+			"conversation_id": conversation_id,
+			"exchanges": len(conversation.exchanges),
+		})
+		return conversation
+
+
+	def _recover(self, conversation_id: str, segments: list, tools: list) -> Conversation | None:
+		return replay(self._read(conversation_id, segments), tools)
+
+
+	def _read(self, conversation_id: str, segments: list) -> list:
+		'''
+		Records of the conversation, only byte ranges of the conversation in segments are read.
+		'''
+		records = []
+		for segment in segments:
+			span = segment.Index.get(conversation_id)
+			if span is None:
+				continue
+			with open(self._get_path(segment.Number, "log"), 'rb') as f:
+				f.seek(span[0])
+				data = f.read(span[1] - span[0])
+			for line in data.splitlines():
+				try:
+					record = self.JSONCodec.loads(line)
+				except self.JSONCodec.DecodeError:
+					continue
+				if record.get('c') == conversation_id:
+					records.append(record)
+		return records
+
+
+	# Writing
+
+	async def flush(self) -> None:
+		async with self.Lock:
+			await self._flush()
+
+
+	async def _flush(self) -> None:
+		if len(self.Pending) == 0:
+			return
+
+		records, self.Pending = self.Pending, []
+		try:
+			written = await asyncio.to_thread(self._write, records)
+		except Exception:
+			L.exception("Cannot write to the journal, records are lost", struct_data={"records": len(records)})
+			self.Counter.add("errors", 1)
+			return
+
+		self.Counter.add("records", len(records))
+		self.Counter.add("batches", 1)
+		self.Counter.add("bytes", written)
+
+
+	async def _flusher(self) -> None:
+		while True:
+			await asyncio.sleep(self.FlushInterval)
+			if len(self.Pending) > 0:
+				# The write of the batch is not interrupted by the cancellation at the exit
+				await asyncio.shield(self.flush())
+
+
+	def _write(self, records: list) -> int:
+		segment = self.Active
+		position = segment.Size
+		now = time.time()
+		lines = []
+		for record in records:
+			line = (self.JSONCodec.dumps(record) + '\n').encode("utf-8")
+			span = segment.Index.get(record['c'])
+			if span is None:
+				segment.Index[record['c']] = [position, position + len(line), now]
+			else:
+				span[1] = position + len(line)
+				span[2] = now
+			position += len(line)
+			lines.append(line)
+
+		self.File.write(b''.join(lines))
+		self.File.flush()
+		if self.FSync:
+			os.fsync(self.File.fileno())
+
+		written = position - segment.Size
+		segment.Size = position
+		segment.Modified = time.time()
+
+		if segment.Size >= self.SegmentSize:
+			self._seal()
+			self._open_segment(segment.Number + 1)
+
+		return written
+
+
+	def _seal(self) -> None:
+		self.File.close()
+		self.File = None
+		self._write_index(self.Active)
+
+
+	def _open_segment(self, number: int) -> None:
+		self.Active = _Segment(number)
+		self.Segments[number] = self.Active
+		self.File = open(self._get_path(number, "log"), 'ab')
+
+
+	def _write_index(self, segment: _Segment) -> None:
+		path = self._get_path(segment.Number, "idx")
+		with open(path + ".tmp", 'w', encoding="utf-8") as f:
+			f.write(self.JSONCodec.dumps(segment.Index))
+			f.flush()
+			if self.FSync:
+				os.fsync(f.fileno())
+		os.replace(path + ".tmp", path)
+
+
+	def _get_path(self, number: int, extension: str) -> str:
+		return os.path.join(self.Path, "{:012d}.{}".format(number, extension))
+
+
+	# Startup
+
+	def _load(self) -> None:
+		os.makedirs(self.Path, exist_ok=True)
+
+		# Segment numbers and files are not coordinated between processes, two of them would overwrite each other
+		self.LockFile = open(os.path.join(self.Path, "journal.lock"), 'a')
+		try:
+			fcntl.flock(self.LockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except OSError:
+			self.LockFile.close()
+			self.LockFile = None
+			raise RuntimeError("Journal path '{}' is used by another process, every node needs its own path".format(self.Path)) from None
+
+		numbers = []
+		for name in os.listdir(self.Path):
+			if name.endswith(".tmp"):
+				# Leftover of an interrupted compaction or sealing
+				os.unlink(os.path.join(self.Path, name))
+			elif name.endswith(".log") and name[:-4].isdigit():
+				numbers.append(int(name[:-4]))
+		numbers.sort()
+
+		for number in numbers:
+			segment = _Segment(number)
+			path = self._get_path(number, "log")
+			if os.path.getsize(path) == 0:
+				# The active segment of a run without conversations
+				for extension in ("log", "idx"):
+					try:
+						os.unlink(self._get_path(number, extension))
+					except FileNotFoundError:
+						pass
+				continue
+			try:
+				with open(self._get_path(number, "idx"), 'rb') as f:
+					segment.Index = self.JSONCodec.loads(f.read())
+			except (FileNotFoundError, *self.JSONCodec.DecodeError):
+				# The active segment of the previous run, it is sealed now
+				self._scan(segment)
+				self._write_index(segment)
+			segment.Size = os.path.getsize(path)
+			segment.Modified = os.path.getmtime(path)
+			self.Segments[number] = segment
+			self.Known.update(segment.Index.keys())
+
+		self._open_segment(numbers[-1] + 1 if len(numbers) > 0 else 1)
+
+
+	def _scan(self, segment: _Segment) -> None:
+		'''
+		Build the index of the segment from its records; the torn record at the end (from a crash) is cut off.
+		'''
+		path = self._get_path(segment.Number, "log")
+		with open(path, 'rb') as f:
+			data = f.read()
+		# Records don't have their time, the last write of the segment is the upper bound
+		modified = os.path.getmtime(path)
+
+		position = 0
+		valid = 0
+		while position < len(data):
+			end = data.find(b'\n', position)
+			if end < 0:
+				break
+			end += 1
+			try:
+				record = self.JSONCodec.loads(data[position:end])
+				conversation_id = record['c']
+			except (KeyError, TypeError, *self.JSONCodec.DecodeError):
+				position = end
+				continue
+
+			span = segment.Index.get(conversation_id)
+			if span is None:
+				segment.Index[conversation_id] = [position, end, modified]
+			else:
+				span[1] = end
+			position = valid = end
+
+		if valid < len(data):
+			L.warning("Torn record at the end of the journal segment, it is cut off", struct_data={"path": path, "bytes": len(data) - valid})
+			with open(path, 'r+b') as f:
+				f.truncate(valid)
+
+
+	# Compaction
+
+	def _on_tick(self, message_type):
+		if self.CompactionInterval <= 0 or self.Active is None:
+			return
+		if self.CompactionTask is not None and not self.CompactionTask.done():
+			return
+		if time.monotonic() - self.LastCompaction < self.CompactionInterval:
+			return
+		self.LastCompaction = time.monotonic()
+		self.CompactionTask = asyncio.create_task(self.compact(), name="llm-journal-compaction")
+
+
+	async def compact(self) -> None:
+		'''
+		Rewrite sealed segments to one segment with the current state of conversations.
+
+		Sealed segments don't change, so they are rewritten without the lock, the journal is written and conversations
+		are recovered meanwhile. The lock is held only to take the list of sealed segments and to replace them.
+		'''
+		async with self.Lock:
+			sealed = [segment for segment in self.Segments.values() if segment is not self.Active]
+		if len(sealed) == 0 or (len(sealed) == 1 and sealed[0].Number == self.CompactedNumber):
+			return
+
+		t0 = time.perf_counter()
+		try:
+			segment, expired, removed = await asyncio.to_thread(self._compact, sealed, time.time())
+
+			async with self.Lock:
+				# Conversations written since the list was taken are not dropped
+				await self._flush()
+				written = set()
+				for s in self.Segments.values():
+					if s.Number > segment.Number:
+						written.update(s.Index.keys())
+				await asyncio.to_thread(self._replace, segment, sealed, expired & written)
+				dropped = (expired | removed) - written
+				self.Known.difference_update(dropped)
+
+		except Exception:
+			L.exception("Compaction of the journal failed")
+			self.Counter.add("errors", 1)
+			return
+
+		self.CompactedNumber = segment.Number
+		self.Counter.add("compactions", 1)
+		L.log(asab.LOG_NOTICE, "Journal of conversations compacted", struct_data={
+			"segments": len(sealed),
+			"bytes_before": sum(s.Size for s in sealed),
+			"bytes": segment.Size,
+			"conversations": len(segment.Index),
+			"dropped": len(dropped),
+			"duration": round(time.perf_counter() - t0, 3),
+		})
+
+
+	def _compact(self, sealed: list, now: float) -> tuple[_Segment, set, set]:
+		'''
+		Write the compacted segment to a temporary file, returns it with ids of expired and removed conversations.
+		'''
+		# The compacted segment takes the number of the newest sealed segment, so it precedes the active one
+		segment = _Segment(sealed[-1].Number)
+		expired = set()
+		removed = set()
+
+		last_active = {}  # conversation id -> time of the last record of the conversation
+		for s in sealed:
+			for conversation_id, span in s.Index.items():
+				last_active[conversation_id] = max(last_active.get(conversation_id, 0), _get_last_active(s, span))
+
+		with open(self._get_path(segment.Number, "log") + ".tmp", 'wb') as f:
+			for conversation_id, modified in last_active.items():
+				if self.Retention > 0 and now - modified > self.Retention:
+					expired.add(conversation_id)
+				elif not self._write_snapshot(f, segment, conversation_id, sealed, modified):
+					removed.add(conversation_id)
+
+			f.flush()
+			if self.FSync:
+				os.fsync(f.fileno())
+
+		return segment, expired, removed
+
+
+	def _replace(self, segment: _Segment, sealed: list, revived: set) -> None:
+		'''
+		Replace sealed segments with the compacted one; `revived` expired conversations have been written meanwhile, they are kept.
+		'''
+		path = self._get_path(segment.Number, "log")
+		if len(revived) > 0:
+			with open(path + ".tmp", 'ab') as f:
+				for conversation_id in revived:
+					modified = max(_get_last_active(s, s.Index[conversation_id]) for s in sealed if conversation_id in s.Index)
+					self._write_snapshot(f, segment, conversation_id, sealed, modified)
+				f.flush()
+				if self.FSync:
+					os.fsync(f.fileno())
+
+		# The stale index must not describe the new segment, a segment without the index is scanned at the startup
+		try:
+			os.unlink(self._get_path(segment.Number, "idx"))
+		except FileNotFoundError:
+			pass
+		os.replace(path + ".tmp", path)
+		self._write_index(segment)
+
+		for s in sealed[:-1]:
+			os.unlink(self._get_path(s.Number, "log"))
+			try:
+				os.unlink(self._get_path(s.Number, "idx"))
+			except FileNotFoundError:
+				pass
+			del self.Segments[s.Number]
+
+		segment.Modified = sealed[-1].Modified
+		self.Segments[segment.Number] = segment
+
+
+	def _write_snapshot(self, f, segment: _Segment, conversation_id: str, sealed: list, modified: float) -> bool:
+		conversation = replay(self._read(conversation_id, sealed), [], settle=False)
+		if conversation is None:
+			return False
+
+		data = b''.join((self.JSONCodec.dumps(record) + '\n').encode("utf-8") for record in snapshot(conversation))
+		# The time of the last record is kept, the rewrite is not an activity of the conversation
+		segment.Index[conversation_id] = [segment.Size, segment.Size + len(data), modified]
+		segment.Size += len(data)
+		f.write(data)
+		return True
+
+
+def _get_last_active(segment: _Segment, span: list) -> float:
+	# Indexes of older versions don't have the time, the modification of the segment is used
+	return span[2] if len(span) > 2 else segment.Modified
+
+
+def snapshot(conversation: Conversation) -> list:
+	'''
+	Records that recreate the current state of the conversation.
+	'''
+	conversation_id = conversation.conversation_id
+	records = [{
+		"c": conversation_id,
+		"t": "created",
+		"tenant": conversation.tenant,
+		"instructions": conversation.instructions,
+		"created": conversation.created_at.timestamp(),
+		"seq": conversation.sequence,
+	}]
+	for exchange_index, exchange in enumerate(conversation.exchanges):
+		for item in exchange.items:
+			fields = item.to_dict()
+			if item.type == 'function_call':
+				fields['call_id'] = item.call_id
+			records.append({"c": conversation_id, "t": "event", "x": exchange_index, "e": {"type": "item.appended", "item": fields}})
+	return records
+
+
+def replay(records: list, tools: list, settle: bool = True) -> Conversation | None:
+	'''
+	Rebuild the conversation from its records, `None` if it has been removed (or there is no creation record).
+
+	If `settle`, items interrupted by the restart are finished (their streams and tasks are gone),
+	the sequence of events continues after the last journaled event, so resuming clients receive the full update.
+	'''
+	conversation = None
+	sequence = 0
+
+	for record in records:
+		try:
+			match record['t']:
+
+				case 'created':
+					conversation = Conversation(
+						conversation_id=record['c'],
+						tenant=record.get('tenant'),
+						instructions=record['instructions'],
+						tools=tools,
+						created_at=datetime.datetime.fromtimestamp(record['created'], datetime.timezone.utc),
+					)
+					sequence = record.get('seq', 0)
+
+				case 'removed':
+					conversation = None
+
+				case _ if conversation is None:
+					# The history before the creation record is incomplete
+					continue
+
+				case 'event':
+					event = record['e']
+					sequence = max(sequence, event.get('seq', 0))
+					_apply_event(conversation, record.get('x'), event)
+
+				case 'restart':
+					conversation.truncate(record['x'])
+					sequence = max(sequence, record.get('seq', 0))
+
+				case 'instructions':
+					conversation.instructions = record['instructions']
+
+		except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+			L.warning("Invalid record in the journal, skipped", struct_data={"conversation_id": record.get('c'), "type": record.get('t'), "error": str(e)})
+
+	if conversation is None:
+		return None
+
+	conversation.sequence = sequence + 1 if settle else sequence
+	if settle:
+		_settle(conversation)
+	return conversation
+
+
+def _apply_event(conversation: Conversation, exchange_index: int | None, event: dict) -> None:
+	match event['type']:
+
+		case 'item.appended':
+			while len(conversation.exchanges) <= exchange_index:
+				conversation.append_exchange(Exchange())
+			conversation.exchanges[exchange_index].append_item(_create_item(event['item']))
+
+		case 'item.delta':
+			item = conversation.get_item(event['key'])
+			if item is not None:
+				item.append_content(event['delta'])
+
+		case 'item.patched':
+			item = conversation.get_item(event['key'])
+			if item is None:
+				return
+			for name, value in event.get('set', {}).items():
+				_set_field(item, name, value)
+			for name, (offset, text) in event.get('append', {}).items():
+				value = getattr(item, name, '')
+				_set_field(item, name, value[:offset] + text)
+
+		case 'item.updated':
+			item = conversation.get_item(event['item']['key'])
+			if item is None:
+				return
+			for name, value in event['item'].items():
+				_set_field(item, name, value)
+
+
+def _create_item(fields: dict):
+	prefix, _, id = fields['key'].rpartition('-')
+	item_class, names = _ITEMS[prefix]
+	return item_class(
+		id=int(id, 16),
+		created=datetime.datetime.fromisoformat(fields['created_at']).timestamp(),
+		**{name: fields[name] for name in names if name in fields},
+	)
+
+
+def _set_field(item, name: str, value) -> None:
+	if name != 'call_id' and name in _ITEMS[item.KeyPrefix][1]:
+		setattr(item, name, value)
+
+
+def _settle(conversation: Conversation) -> None:
+	for exchange in conversation.exchanges:
+		for item in exchange.items:
+			match item.type:
+				case 'function_call':
+					if item.status != 'finished':
+						item.status = 'finished'
+						if len(item.content) == 0:
+							item.content = _INTERRUPTED_OUTPUT
+							item.error = True
+				case 'message' | 'reasoning':
+					if getattr(item, 'status', 'completed') != 'completed':
+						item.status = 'completed'
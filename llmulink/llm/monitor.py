@@ -0,0 +1,163 @@
+import time
+import typing
+import asyncio
+import logging
+import collections
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+_RESYNC = object()  # Marker in the queue, the client receives a fresh full update instead of dropped events
+
+
+class ConversationMonitor():
+	'''
+	Outbound queue of events for one client (websocket) of the conversation.
+
+	Producers (LLM streams, tool calls) only `put()` events into a bounded queue and never wait for the client.
+	A writer task sends queued events to the client.
+	When the client cannot keep up and the queue is full, the overflow policy applies:
+
+	* `merge`: consecutive deltas of the same item in the queue are merged; if it is not enough, `resync` follows
+	* `resync`: queued events are dropped and the client receives a fresh full update of the conversation instead
+	* `disconnect`: the client is disconnected
+	'''
+
+	def __init__(self, send: typing.Callable, resync: typing.Callable, close: typing.Callable, queue_size: int = 1000, overflow: str = "merge", counter=None):
+		self.Send = send  # async send(event)
+		self.Resync = resync  # async resync() -> full update event
+		self.Close = close  # async close()
+		self.Counter = counter  # Optional metrics counter shared by all monitors
+
+		self.QueueSize = queue_size
+		self.Overflow = overflow
+
+		self.Queue = collections.deque()  # (event, enqueued_at)
+		self.Ready = asyncio.Event()
+		self.WriterTask = None
+
+		self.Stats = {"sent": 0, "merged": 0, "resyncs": 0, "disconnects": 0}
+		self.Disconnected = False
+		self.ResyncPending = False  # The full update is built when the writer gets to it, it covers all events put until then
+
+
+	def start(self) -> None:
+		self.WriterTask = asyncio.create_task(self._writer(), name="conversation-monitor-writer")
+
+
+	async def stop(self) -> None:
+		if self.WriterTask is not None:
+			self.WriterTask.cancel()
+			try:
+				await self.WriterTask
+			except asyncio.CancelledError:
+				pass
+			self.WriterTask = None
+
+
+	def put(self, event: dict) -> None:
+		if self.Disconnected or self.ResyncPending:
+			return
+
+		queue = self.Queue
+		if len(queue) > 0 and event.get('type') == 'item.delta':
+			# Append to the last queued delta of the same item, it costs nothing and saves a frame
+			last, enqueued_at = queue[-1]
+			if last.get('type') == 'item.delta' and last['key'] == event['key']:
+				queue[-1] = (_merge_deltas(last, event), enqueued_at)
+				self._count("merged")
+				return
+
+		if len(queue) >= self.QueueSize:
+			self._on_overflow()
+			if self.Disconnected or self.ResyncPending:
+				return
+
+		queue.append((event, time.monotonic()))
+		self.Ready.set()
+
+
+	def get_lag(self) -> float:
+		'''
+		Age (in seconds) of the oldest event waiting in the queue.
+		'''
+		if len(self.Queue) == 0:
+			return 0.0
+		return time.monotonic() - self.Queue[0][1]
+
+
+	def _count(self, name: str) -> None:
+		self.Stats[name] += 1
+		if self.Counter is not None:
+			self.Counter.add(name, 1)
+
+
+	def _on_overflow(self) -> None:
+		match self.Overflow:
+			case 'disconnect':
+				L.warning("Client is too slow, disconnecting", struct_data={"queue": len(self.Queue)})
+				self.Disconnected = True
+				self.Queue.clear()
+				self._count("disconnects")
+				asyncio.create_task(self.Close())
+				return
+
+			case 'merge':
+				self._merge()
+				if len(self.Queue) < self.QueueSize:
+					return
+
+		L.warning("Client is too slow, dropping events for a full update", struct_data={"queue": len(self.Queue)})
+		enqueued_at = self.Queue[0][1]
+		self.Queue.clear()
+		self.Queue.append((_RESYNC, enqueued_at))
+		self.ResyncPending = True
+		self._count("resyncs")
+		self.Ready.set()
+
+
+	def _merge(self) -> None:
+		'''
+		Merge deltas of the same item that follow each other in the queue.
+		'''
+		merged = collections.deque()
+		for event, enqueued_at in self.Queue:
+			if len(merged) > 0 and event.get('type') == 'item.delta':
+				last, last_enqueued_at = merged[-1]
+				if last.get('type') == 'item.delta' and last['key'] == event['key']:
+					merged[-1] = (_merge_deltas(last, event), last_enqueued_at)
+					self._count("merged")
+					continue
+			merged.append((event, enqueued_at))
+		self.Queue = merged
+
+
+	async def _writer(self) -> None:
+		while True:
+			await self.Ready.wait()
+			while len(self.Queue) > 0:
+				event, _ = self.Queue.popleft()
+				try:
+					if event is _RESYNC:
+						# Events put while the full update is built (e.g. flushed deltas) are part of it, they are dropped
+						event = await self.Resync()
+						self.ResyncPending = False
+					await self.Send(event)
+				except Exception:
+					L.exception("Error when sending event to the client")
+					self.Disconnected = True
+					self.Queue.clear()
+					return
+				self._count("sent")
+			self.Ready.clear()
+
+
+def _merge_deltas(first: dict, second: dict) -> dict:
+	merged = {"type": "item.delta", "key": first['key'], "delta": first['delta'] + second['delta']}
+	if 'seq' in second:
+		# The merged event stands for the last one when the client resumes
+		merged['seq'] = second['seq']
+	return merged
@@ -0,0 +1,137 @@
+import logging
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class ItemPatcher():
+	'''
+	Turns `item.updated` events into `item.patched` events that carry only what has changed since the item was last sent.
+
+	Every item has a version, it is 0 in `item.appended` and in full updates it is the current one.
+	`item.patched` increments the version by one:
+
+		{
+			"type": "item.patched",
+			"key": "fc-...",
+			"version": 3,
+			"set": {"status": "finished"},  # Fields with a new value
+			"append": {"content": [120, "64 bytes from ..."]},  # Field is truncated to the offset and the text is appended
+		}
+
+	A client that missed a version (or has a field shorter than the append offset) asks for the whole item
+	with `item.resync.requested` and receives `item.updated` with the current item and version.
+
+	`item.delta` events are not versioned, they append to the `content` of the item.
+	'''
+
+	def __init__(self):
+		self.Items = {}  # key -> _SentItem
+
+
+	def apply(self, event: dict) -> dict | None:
+		'''
+		Process the event before it is sent to clients.
+		Returns the event to send, or None if there is nothing to send.
+		'''
+		match event.get('type'):
+
+			case 'item.appended':
+				item = event['item']
+				item['version'] = 0
+				self.Items[item['key']] = _SentItem(item)
+				return event
+
+			case 'item.delta':
+				sent = self.Items.get(event['key'])
+				if sent is not None:
+					if sent.ContentLength is None:
+						sent.ContentLength = len(sent.Fields.get('content', ''))
+					sent.ContentLength += len(event['delta'])
+				return event
+
+			case 'item.updated':
+				item = event['item']
+				sent = self.Items.get(item['key'])
+				if sent is None:
+					# Not seen yet, send it whole
+					item['version'] = 0
+					self.Items[item['key']] = _SentItem(item)
+					return event
+				return sent.patch(item)
+
+			case _:
+				return event
+
+
+	def get_version(self, key: str) -> int:
+		sent = self.Items.get(key)
+		return 0 if sent is None else sent.Version
+
+
+	def forget(self, keys) -> None:
+		'''
+		Drop versions and sent fields of items that were removed from the conversation.
+		'''
+		for key in keys:
+			self.Items.pop(key, None)
+
+
+class _SentItem():
+
+	__slots__ = ('Version', 'Fields', 'ContentLength')
+
+	def __init__(self, fields: dict):
+		self.Version = 0
+		self.Fields = fields  # Item fields as the client knows them
+		self.ContentLength = None  # Length of the `content` on the client when `item.delta` events were sent since then
+
+
+	def patch(self, item: dict) -> dict | None:
+		changed = {}
+		appended = {}
+
+		for name, value in item.items():
+			if name == 'key' or name == 'version':
+				continue
+
+			if name == 'content' and self.ContentLength is not None:
+				# Deltas only append, so the client has the prefix of the current content
+				if len(value) > self.ContentLength:
+					appended[name] = [self.ContentLength, value[self.ContentLength:]]
+				elif len(value) < self.ContentLength:
+					changed[name] = value
+				continue
+
+			old = self.Fields.get(name)
+			if value is old or value == old:
+				continue
+
+			if isinstance(value, str) and isinstance(old, str) and len(value) > len(old) and value.startswith(old):
+				appended[name] = [len(old), value[len(old):]]
+			else:
+				changed[name] = value
+
+		self.Fields = item
+		self.ContentLength = None
+
+		if len(changed) == 0 and len(appended) == 0:
+			item['version'] = self.Version
+			return None
+
+		self.Version += 1
+		item['version'] = self.Version
+
+		event = {
+			"type": "item.patched",
+			"key": item['key'],
+			"version": self.Version,
+		}
+		if len(changed) > 0:
+			event['set'] = changed
+		if len(appended) > 0:
+			event['append'] = appended
+		return event
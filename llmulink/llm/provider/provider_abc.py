@@ -1,57 +1,297 @@
 import abc
+import time
+import typing
+import datetime
+import email.utils
 import logging
 import aiohttp
 
 import asab
+import asab.utils
 
 from ..datamodel import Conversation, Exchange
+from ..scheduler import RequestScheduler
 
 L = logging.getLogger("llmulink.llm")
 
+class LLMProviderError(Exception):
+	'''
+	The LLM provider failed to accept the request.
+	'''
+
+	def __init__(self, message: str, status: int | None = None, retry_after: float | None = None, retryable: bool = True):
+		super().__init__(message)
+		self.Status = status
+		self.RetryAfter = retry_after
+		self.Retryable = retryable
+
+
+	@classmethod
+	async def from_response(cls, response: aiohttp.ClientResponse) -> 'LLMProviderError':
+		text = await response.text()
+		return cls(
+			"LLM provider responded with HTTP {}: {}".format(response.status, text[:1000]),
+			status=response.status,
+			retry_after=_parse_retry_after(response.headers.get('Retry-After')),
+			retryable=response.status in _RETRYABLE_STATUSES,
+		)
+
+
+_RETRYABLE_STATUSES = frozenset([408, 409, 425, 429, 500, 502, 503, 504, 529])
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+	'''
+	Parse the Retry-After header, it is either a number of seconds or a HTTP date.
+	'''
+	if value is None:
+		return None
+	try:
+		return max(0.0, float(value))
+	except ValueError:
+		pass
+	try:
+		return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+	except (TypeError, ValueError):
+		return None
+
+
+class PayloadCache():
+	'''
+	Already converted messages of the conversation and the position (exchange and item index) where the conversion continues.
+	'''
+
+	def __init__(self):
+		self.Messages = list[str]()
+		self.Exchange = 0
+		self.Item = 0
+
+
+def is_settled(item) -> bool:
+	'''
+	The item will not change anymore.
+	'''
+	match item.type:
+		case 'function_call':
+			return item.status == 'finished'
+		case 'message' | 'reasoning':
+			return getattr(item, 'status', 'completed') == 'completed'
+	return False
+
+
 class LLMChatProviderABC(abc.ABC):
-	def __init__(self, service, *, url):
+	def __init__(self, service, *, url, **kwargs):
 		self.LLMChatService = service
 		self.URL = url.rstrip('/') + '/'
 		self.Models = []  # Cached list of models
+		self.Name = kwargs.get('name', self.URL)  # Name of the provider, e.g. 'a' of the '[provider:a]' section
+		self.Group = kwargs.get('group', self.Name)  # Group of providers that share the selection policy
+
+		# Load indicators used by provider selection policies
+		self.Outstanding = 0  # Number of queued and running requests
+		self.TTFT = None  # EWMA of the time-to-first-token (in seconds)
+		self.TTFTAlpha = float(kwargs.get('ttft_ewma_alpha', 0.3))
+
+		# Health of the provider, the provider is considered unhealthy for a while after a failure
+		self.UnhealthyUntil = None
+		self.FailureCooldown = float(kwargs.get('failure_cooldown', 30.0))
+
+		# Connection pool configuration, the pool itself is created in `initialize()`
+		self.PoolLimit = int(kwargs.get('limit', 100))
+		self.PoolLimitPerHost = int(kwargs.get('limit_per_host', 0))  # 0 means no limit
+		self.PoolKeepAliveTimeout = float(kwargs.get('keepalive_timeout', 60.0))
+		self.PoolDNSCacheTTL = int(kwargs.get('ttl_dns_cache', 300))
+
+		self.Session = None
+		self.RequestCount = 0
+
+		# Send prompt caching hints to the provider (if the API supports them)
+		self.PromptCache = asab.utils.string_to_boolean(kwargs.get('prompt_cache', 'yes'))
+
+		self.Scheduler = RequestScheduler(
+			concurrency=int(kwargs.get('concurrency', 2)),
+			queue_size=int(kwargs.get('queue_size', 64)),
+		)
 
 		L.log(asab.LOG_NOTICE, "Loaded provider", struct_data={"url": self.URL, "type": self.__class__.__name__})
 
+
+	async def initialize(self):
+		'''
+		Create a long-lived HTTP session with a connection pool.
+		The session is shared by all requests to this provider so that TCP and TLS connections are reused.
+		'''
+		connector = aiohttp.TCPConnector(
+			limit=self.PoolLimit,
+			limit_per_host=self.PoolLimitPerHost,
+			keepalive_timeout=self.PoolKeepAliveTimeout,
+			ttl_dns_cache=self.PoolDNSCacheTTL,
+		)
+		self.Session = aiohttp.ClientSession(
+			headers=self.prepare_headers(),
+			connector=connector,
+			json_serialize=self.LLMChatService.JSONCodec.dumps,
+		)
+
+
+	async def finalize(self):
+		if self.Session is not None:
+			await self.Session.close()
+			self.Session = None
+
+
+	def get_pool_stats(self) -> dict:
+		'''
+		Get the usage statistics of the connection pool.
+		'''
+		stats = {
+			"limit": self.PoolLimit,
+			"limit_per_host": self.PoolLimitPerHost,
+			"acquired": 0,
+			"idle": 0,
+			"requests": self.RequestCount,
+		}
+
+		if self.Session is None or self.Session.closed:
+			return stats
+
+		connector = self.Session.connector
+		# aiohttp doesn't expose these counters publicly
+		stats["acquired"] = len(getattr(connector, '_acquired', ()))
+		stats["idle"] = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+		return stats
+
+
+	def observe_ttft(self, started_at: float) -> None:
+		'''
+		Record the time-to-first-token of a request that has been sent at `started_at` (monotonic time).
+		'''
+		ttft = time.monotonic() - started_at
+		if self.TTFT is None:
+			self.TTFT = ttft
+		else:
+			self.TTFT = self.TTFTAlpha * ttft + (1.0 - self.TTFTAlpha) * self.TTFT
+
+
+	def mark_failure(self, retry_after: float | None = None) -> None:
+		'''
+		Mark the provider as unhealthy for the `retry_after` (if the provider told us) or for the failure cooldown.
+		'''
+		self.UnhealthyUntil = time.monotonic() + (retry_after if retry_after is not None else self.FailureCooldown)
+
+
+	def mark_success(self) -> None:
+		self.UnhealthyUntil = None
+
+
+	def is_healthy(self) -> bool:
+		return self.UnhealthyUntil is None or time.monotonic() >= self.UnhealthyUntil
+
+
 	@abc.abstractmethod
 	def prepare_headers(self):
 		pass
 
 	@abc.abstractmethod
-	async def chat_request(self, conversation: Conversation, exchange: Exchange):
+	async def chat_request(self, conversation: Conversation, exchange: Exchange, on_first_token: typing.Callable = None):
+		'''
+		Send the conversation to the LLM and stream the response into the exchange.
+
+		`on_first_token()` is called when the first streamed event arrives, before anything is added to the exchange.
+		Raises `LLMProviderError` when the provider doesn't accept the request.
+		'''
+		pass
+
+	@abc.abstractmethod
+	def convert_item(self, item) -> list[dict]:
+		'''
+		Convert the conversation item to a list of messages in the provider format.
+		'''
 		pass
 
+
+	def build_messages(self, conversation: Conversation) -> list[str]:
+		'''
+		Convert items of the conversation to JSON encoded messages in the provider format.
+
+		The prefix of settled items is cached in the conversation (per provider format) and only items appended since the last call are converted.
+		Items that are still streaming or executing are converted on every call and they are not cached.
+		'''
+		cache = conversation.payload_cache.get(self.__class__.__name__)
+		if cache is None:
+			cache = conversation.payload_cache[self.__class__.__name__] = PayloadCache()
+
+		dumps = self.LLMChatService.JSONCodec.dumps
+		exchanges = conversation.exchanges
+		settled = True
+		tail = []
+
+		# Items outside of the context window are not sent, see `ContextWindow`
+		window = conversation.context
+
+		exchange_index, item_index = cache.Exchange, cache.Item
+		if window is not None and exchange_index < window.Start:
+			exchange_index, item_index = window.Start, 0
+
+		while exchange_index < len(exchanges):
+			items = exchanges[exchange_index].items
+			while item_index < len(items):
+				item = items[item_index]
+				view = item if window is None else window.view(item)
+				messages = [dumps(message) for message in self.convert_item(view)] if view is not None else []
+				item_index += 1
+
+				if settled and is_settled(item):
+					cache.Messages.extend(messages)
+					self.LLMChatService.Conversations.grow(conversation, sum(len(message) for message in messages))
+					cache.Exchange, cache.Item = exchange_index, item_index
+				else:
+					settled = False
+					tail.extend(messages)
+
+			exchange_index += 1
+			item_index = 0
+
+		if len(tail) > 0:
+			return cache.Messages + tail
+		return cache.Messages
+
+
+	def dump_payload(self, data: dict, key: str, messages: list[str]) -> bytes:
+		'''
+		Serialize the request payload, JSON encoded `messages` are spliced into it as a list under the `key`.
+		'''
+		payload = self.LLMChatService.JSONCodec.dumps(data)
+		assert payload.endswith('}')
+		return ''.join((payload[:-1], ',"', key, '":[', ','.join(messages), ']}')).encode("utf-8")
+
 	async def get_models(self):
 		'''
 		Get the list of models from the LLM chat provider.
 		Implements /v1/models call that works with vLLM, tensorrm-llm, OpenAI and Anthropic API and possibly other LLM chat providers.
 		'''
 
-		async with aiohttp.ClientSession(headers=self.prepare_headers()) as session:
-			try:
-				async with session.get(self.URL + "v1/models") as response:
-					if response.status != 200:
-						if response.status == 401 and response.content_type == "application/json":
-							resp = await response.json()
-							L.warning("Unauthorized access to LLM chat provider", struct_data={"url": self.URL, "response": resp})
-							return None
-						L.warning("Error getting models", struct_data={"status": response.status, "text": await response.text()})
+		try:
+			async with self.Session.get(self.URL + "v1/models") as response:
+				if response.status != 200:
+					self.mark_failure()
+					if response.status == 401 and response.content_type == "application/json":
+						resp = await response.json()
+						L.warning("Unauthorized access to LLM chat provider", struct_data={"url": self.URL, "response": resp})
 						return None
+					L.warning("Error getting models", struct_data={"status": response.status, "text": await response.text()})
+					return None
 
-					resp = await response.json()
-					models = resp['data']
-					if self.URL.startswith('https://api.openai.com/'):
-						# Filter only GPT models from OpenAI API
-						# They offer more models but they are not directly usable for chat.
-						models = filter(lambda model: model['owned_by'] == 'openai', models)
-					self.Models = models
-					return [model['id'] for model in self.Models]
-
-			except aiohttp.ClientError as e:
-				L.warning("Error communicating with LLM: {} {}".format(e.__class__.__name__, e), struct_data={"url": self.URL})
-				return None
+				resp = await response.json()
+				models = resp['data']
+				if self.URL.startswith('https://api.openai.com/'):
+					# Filter only GPT models from OpenAI API
+					# They offer more models but they are not directly usable for chat.
+					models = filter(lambda model: model['owned_by'] == 'openai', models)
+				self.Models = list(models)
+				return [model['id'] for model in self.Models]
 
-		return []
+		except aiohttp.ClientError as e:
+			self.mark_failure()
+			L.warning("Error communicating with LLM: {} {}".format(e.__class__.__name__, e), struct_data={"url": self.URL})
+			return None
@@ -0,0 +1,118 @@
+import typing
+
+import aiohttp
+
+
+class SSEFramer():
+	'''
+	Incremental parser of the `text/event-stream` (Server-Sent Events) format.
+
+	https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+
+	Chunks of bytes are fed as they arrive from the network and complete `(event, data)` frames are returned.
+	The event is a `str` (or None if the frame has no `event:` field), the data is `bytes`, ready to be passed to a JSON decoder.
+	Lines are never decoded to `str` except of the (short) event name; CRLF, LF and CR line endings,
+	multi-line `data:` fields and `:` comment lines are supported.
+
+	The value of each `data:` field is copied once from the buffer into `bytes` (the buffer is compacted after every feed).
+	An incomplete line is not scanned again, the next feed continues the search for its end in the new bytes.
+	'''
+
+	def __init__(self):
+		self.Buffer = bytearray()
+		self.Scan = 0  # Offset in the buffer that the search for the end of the incomplete line continues from
+		self.Event = None
+		self.Data = []
+
+
+	def feed(self, chunk: bytes) -> list[tuple[str | None, bytes]]:
+		buf = self.Buffer
+		buf += chunk
+
+		frames = []
+		start = 0
+		end = len(buf)
+		scan = self.Scan
+		while start < end:
+			scan = max(start, scan)
+			lf = buf.find(b'\n', scan)
+			cr = buf.find(b'\r', scan, lf if lf != -1 else end)
+			if cr != -1:
+				if cr + 1 == end:
+					# CR at the end of the buffer may be followed by LF in the next chunk
+					scan = cr
+					break
+				eol = cr
+				nxt = cr + 2 if buf[cr + 1] == 0x0A else cr + 1
+			elif lf != -1:
+				eol = lf
+				nxt = lf + 1
+			else:
+				scan = end
+				break
+
+			self._line(buf, start, eol, frames)
+			start = nxt
+
+		self.Scan = max(scan - start, 0)
+		if start > 0:
+			del buf[:start]
+
+		return frames
+
+
+	def flush(self) -> list[tuple[str | None, bytes]]:
+		'''
+		Finish the stream, a pending frame that is not terminated by an empty line is returned too.
+		'''
+		frames = []
+		if len(self.Buffer) > 0:
+			buf = self.Buffer.rstrip(b'\r')
+			self._line(buf, 0, len(buf), frames)
+			self.Buffer.clear()
+		self.Scan = 0
+		self._line(b'', 0, 0, frames)
+		return frames
+
+
+	def _line(self, buf, start: int, end: int, frames: list) -> None:
+		if start == end:
+			# Empty line dispatches the frame
+			if len(self.Data) == 1:
+				frames.append((self.Event, self.Data[0]))
+			elif len(self.Data) > 1:
+				frames.append((self.Event, b'\n'.join(self.Data)))
+			self.Event = None
+			self.Data = []
+			return
+
+		colon = buf.find(b':', start, end)
+		if colon == start:
+			# Comment line
+			return
+
+		if colon == -1:
+			colon = vstart = end
+		else:
+			vstart = colon + 1
+			if vstart < end and buf[vstart] == 0x20:
+				vstart += 1
+
+		# The field name is compared in place, only the value is copied
+		if colon - start == 4 and buf.startswith(b'data', start, colon):
+			self.Data.append(bytes(buf[vstart:end]))
+		elif colon - start == 5 and buf.startswith(b'event', start, colon):
+			self.Event = bytes(buf[vstart:end]).decode("utf-8")
+		# Fields `id` and `retry` are not used by LLM providers
+
+
+async def iter_sse(content: aiohttp.StreamReader) -> typing.AsyncIterator[tuple[str | None, bytes]]:
+	'''
+	Iterate over SSE frames of the HTTP response body.
+	'''
+	framer = SSEFramer()
+	async for chunk in content.iter_any():
+		for frame in framer.feed(chunk):
+			yield frame
+	for frame in framer.flush():
+		yield frame
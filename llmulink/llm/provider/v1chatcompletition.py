@@ -1,17 +1,27 @@
-import json
-import asyncio
+import time
+import typing
 import logging
 
-import aiohttp
-
 import asab
 
-from ..datamodel import Conversation, Exchange, AssistentMessage, AssistentReasoning, FunctionCall
-from .provider_abc import LLMChatProviderABC
+from ..datamodel import Conversation, Exchange, AssistentMessage, AssistentReasoning, FunctionCall, Usage
+from .provider_abc import LLMChatProviderABC, LLMProviderError
+from .sse import iter_sse
 
 L = logging.getLogger(__name__)
 
 
+class _ChatCompletionStream():
+	'''
+	State of one streamed response; the provider streams several responses at once.
+	'''
+	__slots__ = ('AssistantMessage', 'ToolCalls')
+
+	def __init__(self):
+		self.AssistantMessage = None
+		self.ToolCalls = {}  # Indexed by tool call index
+
+
 class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 	'''
 	OpenAI API v1 chat completions adapter.
@@ -20,9 +30,8 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 	'''
 
 	def __init__(self, service, *, url, **kwargs):
-		super().__init__(service, url=url)
+		super().__init__(service, url=url, **kwargs)
 		self.APIKey = kwargs.get('api_key', None)
-		self.Semaphore = asyncio.Semaphore(2)
 
 	def prepare_headers(self):
 		headers = {
@@ -33,66 +42,69 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 		return headers
 
 
-	async def chat_request(self, conversation: Conversation, exchange: Exchange) -> None:
+	def convert_item(self, item) -> list[dict]:
 		messages = []
+		match item.__class__.__name__:
 
-		# Add system message if instructions are provided
-		if conversation.instructions:
-			messages.append({
-				"role": "system",
-				"content": conversation.instructions,
-			})
+			case "UserMessage":
+				messages.append({
+					"role": "user",
+					"content": item.content,
+				})
+
+			case "AssistentMessage":
+				messages.append({
+					"role": "assistant",
+					"content": item.content,
+				})
 
-		for exch in conversation.exchanges:
-			for item in exch.items:
-				match item.__class__.__name__:
-
-					case "UserMessage":
-						messages.append({
-							"role": "user",
-							"content": item.content,
-						})
-
-					case "AssistentMessage":
-						messages.append({
-							"role": "assistant",
-							"content": item.content,
-						})
-
-					case "AssistentReasoning":
-						# Reasoning is not directly supported in chat completions API
-						# Skip for now
-						pass
-
-					case "FunctionCall":
-						# OpenAI chat completions uses tool_calls format
-						messages.append({
-							"role": "assistant",
-							"content": None,
-							"tool_calls": [{
-								"id": item.call_id,
-								"type": "function",
-								"function": {
-									"name": item.name,
-									"arguments": item.arguments,
-								},
-							}],
-						})
-
-						messages.append({
-							"role": "tool",
-							"tool_call_id": item.call_id,
-							"content": item.content,
-						})
+			case "AssistentReasoning":
+				# Reasoning is not directly supported in chat completions API
+				# Skip for now
+				pass
 
+			case "FunctionCall":
+				# OpenAI chat completions uses tool_calls format
+				messages.append({
+					"role": "assistant",
+					"content": None,
+					"tool_calls": [{
+						"id": item.call_id,
+						"type": "function",
+						"function": {
+							"name": item.name,
+							"arguments": item.arguments,
+						},
+					}],
+				})
+
+				messages.append({
+					"role": "tool",
+					"tool_call_id": item.call_id,
+					"content": item.content,
+				})
+
+		return messages
+
+
+	async def chat_request(self, conversation: Conversation, exchange: Exchange, on_first_token: typing.Callable = None) -> None:
+		messages = self.build_messages(conversation)
+
+		# Add system message if instructions are provided
+		instructions = conversation.get_instructions()
+		if instructions:
+			messages = [self.LLMChatService.JSONCodec.dumps({
+				"role": "system",
+				"content": instructions,
+			})] + messages
 
 		model = conversation.get_model()
 		assert model is not None
 
 		data = {
 			"model": model,
-			"messages": messages,
 			"stream": True,
+			"stream_options": {"include_usage": True},
 		}
 
 		tools = self._build_tools(conversation)
@@ -101,42 +113,49 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 
 		L.log(asab.LOG_NOTICE, "Sending request to LLM", struct_data={"conversation_id": conversation.conversation_id, "model": model, "provider": self.URL})
 
-		# State for tracking streaming content
-		self._current_assistant_message = None
-		self._current_tool_calls = {}  # Indexed by tool call index
-
-		async with aiohttp.ClientSession(headers=self.prepare_headers()) as session:
-			async with session.post(self.URL + "v1/chat/completions", json=data) as response:
-				if response.status != 200:
-					text = await response.text()
-					L.error(
-						"Error when sending request to LLM chat provider",
-						struct_data={"status": response.status, "text": text}
-					)
-					return
+		self.RequestCount += 1
+		started_at = time.monotonic()
+		payload = self.dump_payload(data, "messages", messages)
+		async with self.Session.post(self.URL + "v1/chat/completions", data=payload, headers={"Content-Type": "application/json"}) as response:
+			if response.status != 200:
+				error = await LLMProviderError.from_response(response)
+				L.error(
+					"Error when sending request to LLM chat provider",
+					struct_data={"status": response.status, "text": str(error), "provider": self.URL}
+				)
+				raise error
 
-				assert response.content_type == "text/event-stream"
+			assert response.content_type == "text/event-stream"
+			self.mark_success()
+			codec = self.LLMChatService.JSONCodec
+			stream = _ChatCompletionStream()
 
-				async for line in response.content:
-					line = line.decode("utf-8").rstrip('\n\r')
+			async for _, event_data in iter_sse(response.content):
+				if on_first_token is not None:
+					# The first event decides the hedged race, before anything is added to the exchange
+					on_first_token()
+					on_first_token = None
 
-					if line == '':
-						continue
+				if event_data == b'[DONE]':
+					# Stream finished, finalize any pending items
+					await self._finalize_stream(conversation, exchange, stream)
+					break
 
-					if line.startswith('data: '):
-						data_str = line[6:]
-						if data_str == '[DONE]':
-							# Stream finished, finalize any pending items
-							await self._finalize_stream(conversation, exchange)
-							break
-						try:
-							data = json.loads(data_str)
-							await self._on_llm_chunk(conversation, exchange, data)
-						except json.JSONDecodeError as e:
-							L.warning("Invalid JSON in SSE response", struct_data={"line": line, "error": str(e)})
+				try:
+					data = codec.loads(event_data)
+				except codec.DecodeError as e:
+					L.warning("Invalid JSON in SSE response", struct_data={"data": event_data[:1000].decode("utf-8", errors="replace"), "error": str(e)})
+					continue
 
+				if started_at is not None and _has_token(data):
+					# The time to the first generated token; the first chunk may carry only the role
+					self.observe_ttft(started_at)
+					started_at = None
 
-	async def _on_llm_chunk(self, conversation: Conversation, exchange: Exchange, chunk: dict) -> None:
+				await self._on_llm_chunk(conversation, exchange, stream, data)
+
+
+	async def _on_llm_chunk(self, conversation: Conversation, exchange: Exchange, stream: _ChatCompletionStream, chunk: dict) -> None:
 		'''
 		Process a streaming chunk from the chat completions API.
 
@@ -157,6 +176,16 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 			}]
 		}
 		'''
+		usage = chunk.get('usage')
+		if usage is not None:
+			# The usage is sent in the last chunk (with empty choices)
+			exchange.usage = Usage(
+				input_tokens=usage.get('prompt_tokens', 0),
+				output_tokens=usage.get('completion_tokens', 0),
+				cache_read_tokens=(usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0),
+			)
+			self.LLMChatService.record_usage(self, conversation, exchange)
+
 		choices = chunk.get('choices', [])
 		if not choices:
 			return
@@ -173,24 +202,24 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 		# Handle text content delta
 		if 'content' in delta and delta['content'] is not None:
 			text = delta['content']
-			if self._current_assistant_message is None:
+			if stream.AssistantMessage is None:
 				# Create new assistant message item
-				self._current_assistant_message = AssistentMessage(
+				stream.AssistantMessage = AssistentMessage(
 					role='assistant',
 					content=text,
 					status='in_progress',
 				)
-				exchange.items.append(self._current_assistant_message)
+				exchange.append_item(stream.AssistantMessage)
 				await self.LLMChatService.send_update(conversation, {
 					"type": "item.appended",
-					"item": self._current_assistant_message.to_dict(),
+					"item": stream.AssistantMessage.to_dict(),
 				})
 			else:
 				# Append to existing message
-				self._current_assistant_message.content += text
+				stream.AssistantMessage.append_content(text)
 				await self.LLMChatService.send_update(conversation, {
 					"type": "item.delta",
-					"key": self._current_assistant_message.key,
+					"key": stream.AssistantMessage.key,
 					"delta": text,
 				})
 
@@ -199,7 +228,7 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 			for tool_call_delta in delta['tool_calls']:
 				index = tool_call_delta.get('index', 0)
 
-				if index not in self._current_tool_calls:
+				if index not in stream.ToolCalls:
 					# New tool call
 					tool_call_id = tool_call_delta.get('id', '')
 					function_info = tool_call_delta.get('function', {})
@@ -212,33 +241,33 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 						arguments=arguments,
 						status='in_progress',
 					)
-					self._current_tool_calls[index] = item
-					exchange.items.append(item)
+					stream.ToolCalls[index] = item
+					exchange.append_item(item)
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.appended",
 						"item": item.to_dict(),
 					})
 				else:
 					# Update existing tool call with more arguments
-					item = self._current_tool_calls[index]
+					item = stream.ToolCalls[index]
 					function_info = tool_call_delta.get('function', {})
 					if 'arguments' in function_info:
-						item.arguments += function_info['arguments']
+						item.append_arguments(function_info['arguments'])
 
 		# Handle finish reason
 		if finish_reason is not None:
 			if finish_reason == 'stop':
 				# Normal completion
-				if self._current_assistant_message is not None:
-					self._current_assistant_message.status = 'completed'
+				if stream.AssistantMessage is not None:
+					stream.AssistantMessage.status = 'completed'
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.updated",
-						"item": self._current_assistant_message.to_dict(),
+						"item": stream.AssistantMessage.to_dict(),
 					})
 
 			elif finish_reason == 'tool_calls':
 				# Tool calls completion - finalize all tool calls
-				for index, item in self._current_tool_calls.items():
+				for index, item in stream.ToolCalls.items():
 					item.status = 'completed'
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.updated",
@@ -247,20 +276,20 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 					await self.LLMChatService.create_function_call(conversation, item)
 
 
-	async def _finalize_stream(self, conversation: Conversation, exchange: Exchange) -> None:
+	async def _finalize_stream(self, conversation: Conversation, exchange: Exchange, stream: _ChatCompletionStream) -> None:
 		'''
 		Finalize any pending items when the stream ends.
 		'''
 		# Finalize assistant message if still in progress
-		if self._current_assistant_message is not None and self._current_assistant_message.status == 'in_progress':
-			self._current_assistant_message.status = 'completed'
+		if stream.AssistantMessage is not None and stream.AssistantMessage.status == 'in_progress':
+			stream.AssistantMessage.status = 'completed'
 			await self.LLMChatService.send_update(conversation, {
 				"type": "item.updated",
-				"item": self._current_assistant_message.to_dict(),
+				"item": stream.AssistantMessage.to_dict(),
 			})
 
 		# Finalize any tool calls still in progress
-		for index, item in self._current_tool_calls.items():
+		for index, item in stream.ToolCalls.items():
 			if item.status == 'in_progress':
 				item.status = 'completed'
 				await self.LLMChatService.send_update(conversation, {
@@ -269,10 +298,6 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 				})
 				await self.LLMChatService.create_function_call(conversation, item)
 
-		# Reset state
-		self._current_assistant_message = None
-		self._current_tool_calls = {}
-
 
 	def _build_tools(self, conversation: Conversation) -> list[dict]:
 		'''
@@ -309,3 +334,14 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 				}
 			})
 		return tools
+
+
+def _has_token(chunk: dict) -> bool:
+	'''
+	The chunk carries generated text, reasoning or tool call arguments.
+	'''
+	for choice in chunk.get('choices') or ():
+		delta = choice.get('delta') or {}
+		if delta.get('content') or delta.get('reasoning_content') or delta.get('tool_calls'):
+			return True
+	return False
@@ -1,16 +1,29 @@
-import json
-import asyncio
+import time
+import typing
 import logging
 
-import aiohttp
-
 import asab
 
-from ..datamodel import Conversation, Exchange, AssistentMessage, AssistentReasoning, FunctionCall
-from .provider_abc import LLMChatProviderABC
+from ..datamodel import Conversation, Exchange, AssistentMessage, AssistentReasoning, FunctionCall, Usage
+from .provider_abc import LLMChatProviderABC, LLMProviderError
+from .sse import iter_sse
 
 L = logging.getLogger(__name__)
 
+# Errors streamed by the API that are worth repeating the request, possibly with another provider
+# https://platform.claude.com/docs/en/api/errors
+_RETRYABLE_ERRORS = frozenset(['overloaded_error', 'api_error', 'rate_limit_error'])
+
+
+class _MessageStream():
+	'''
+	State of one streamed response; the provider streams several responses at once.
+	'''
+	__slots__ = ('ContentBlock',)
+
+	def __init__(self):
+		self.ContentBlock = None  # The item of the content block that is being streamed
+
 
 class LLMChatProviderV1Messages(LLMChatProviderABC):
 	'''
@@ -20,9 +33,8 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 	'''
 
 	def __init__(self, service, *, url, **kwargs):
-		super().__init__(service, url=url)
+		super().__init__(service, url=url, **kwargs)
 		self.APIKey = kwargs.get('api_key', None)
-		self.Semaphore = asyncio.Semaphore(2)
 
 	def prepare_headers(self):
 		headers = {
@@ -37,56 +49,58 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 		return headers
 
 
-	async def chat_request(self, conversation: Conversation, exchange: Exchange) -> None:
+	def convert_item(self, item) -> list[dict]:
 		messages = []
-		for exch in conversation.exchanges:
-			for item in exch.items:
-				match item.__class__.__name__:
-
-					case "UserMessage":
-						messages.append({
-							"role": "user",
-							"content": item.content,
-						})
-
-					case "AssistentMessage":
-						messages.append({
-							"role": "assistant",
-							"content": item.content,
-						})
-
-					case "AssistentReasoning":
-						pass
-
-					case "FunctionCall":
-						# Anthropic uses tool_use/tool_result format
-						messages.append({
-							"role": "assistant",
-							"content": [{
-								"type": "tool_use",
-								"id": item.call_id,
-								"name": item.name,
-								"input": json.loads(item.arguments) if item.arguments else {},
-							}],
-						})
-
-						messages.append({
-							"role": "user",
-							"content": [{
-								"type": "tool_result",
-								"tool_use_id": item.call_id,
-								"content": item.content,
-							}],
-						})
+		match item.__class__.__name__:
 
+			case "UserMessage":
+				messages.append({
+					"role": "user",
+					"content": item.content,
+				})
+
+			case "AssistentMessage":
+				messages.append({
+					"role": "assistant",
+					"content": item.content,
+				})
+
+			case "AssistentReasoning":
+				pass
+
+			case "FunctionCall":
+				# Anthropic uses tool_use/tool_result format
+				messages.append({
+					"role": "assistant",
+					"content": [{
+						"type": "tool_use",
+						"id": item.call_id,
+						"name": item.name,
+						"input": self.LLMChatService.JSONCodec.loads(item.arguments) if item.arguments else {},
+					}],
+				})
+
+				messages.append({
+					"role": "user",
+					"content": [{
+						"type": "tool_result",
+						"tool_use_id": item.call_id,
+						"content": item.content,
+					}],
+				})
+
+		return messages
+
+
+	async def chat_request(self, conversation: Conversation, exchange: Exchange, on_first_token: typing.Callable = None) -> None:
+		messages = self.build_messages(conversation)
 
 		model = conversation.get_model()
 		assert model is not None
 
 		data = {
 			"model": model,
-			"system": conversation.instructions,
-			"messages": messages,
+			"system": conversation.get_instructions(),
 			"max_tokens": 4096,
 			"stream": True,
 		}
@@ -95,46 +109,65 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 		if len(tools) > 0:
 			data["tools"] = tools
 
+		if self.PromptCache:
+			# Cache breakpoints: the system prompt, the tools and the conversation history
+			# https://platform.claude.com/docs/en/build-with-claude/prompt-caching
+			if data["system"]:
+				data["system"] = [{
+					"type": "text",
+					"text": data["system"],
+					"cache_control": {"type": "ephemeral"},
+				}]
+			if len(tools) > 0:
+				tools[-1]["cache_control"] = {"type": "ephemeral"}
+			if len(messages) > 0:
+				messages = messages[:-1] + [self._cache_breakpoint(messages[-1])]
+
 		L.log(asab.LOG_NOTICE, "Sending request to LLM", struct_data={"conversation_id": conversation.conversation_id, "model": model, "provider": self.URL})
 
-		async with aiohttp.ClientSession(headers=self.prepare_headers()) as session:
-			async with session.post(self.URL + "v1/messages", json=data) as response:
-				if response.status != 200:
-					text = await response.text()
-					L.error(
-						"Error when sending request to LLM chat provider",
-						struct_data={"status": response.status, "text": text}
-					)
-					return
+		self.RequestCount += 1
+		started_at = time.monotonic()
+		payload = self.dump_payload(data, "messages", messages)
+		async with self.Session.post(self.URL + "v1/messages", data=payload, headers={"Content-Type": "application/json"}) as response:
+			if response.status != 200:
+				error = await LLMProviderError.from_response(response)
+				L.error(
+					"Error when sending request to LLM chat provider",
+					struct_data={"status": response.status, "text": str(error), "provider": self.URL}
+				)
+				raise error
+
+			assert response.content_type == "text/event-stream"
+			self.mark_success()
+			codec = self.LLMChatService.JSONCodec
 
-				assert response.content_type == "text/event-stream"
+			stream = _MessageStream()
 
-				# State for tracking content blocks
-				self._current_content_block = None
-				self._current_content_block_index = None
+			async for event_type, event_data in iter_sse(response.content):
+				if on_first_token is not None:
+					# The first event decides the hedged race, before anything is added to the exchange
+					on_first_token()
+					on_first_token = None
 
-				async for line in response.content:
-					line = line.decode("utf-8").rstrip('\n\r')
-					
-					if line == '':
-						continue
+				if event_data == b'[DONE]':
+					break
 
-					if line.startswith('event: '):
-						event_type = line[7:]
-						continue
+				try:
+					data = codec.loads(event_data)
+				except codec.DecodeError as e:
+					L.warning("Invalid JSON in SSE response", struct_data={"data": event_data[:1000].decode("utf-8", errors="replace"), "error": str(e)})
+					continue
 
-					if line.startswith('data: '):
-						data_str = line[6:]
-						if data_str == '[DONE]':
-							break
-						try:
-							data = json.loads(data_str)
-							await self._on_llm_event(conversation, exchange, event_type, data)
-						except json.JSONDecodeError as e:
-							L.warning("Invalid JSON in SSE response", struct_data={"line": line, "error": str(e)})
+				event_type = event_type or data.get('type', "???")
+				if started_at is not None and event_type == 'content_block_delta':
+					# The time to the first generated token; the first events (e.g. 'message_start') arrive before any token
+					self.observe_ttft(started_at)
+					started_at = None
 
+				await self._on_llm_event(conversation, exchange, stream, event_type, data)
 
-	async def _on_llm_event(self, conversation: Conversation, exchange: Exchange, event_type: str, data: dict) -> None:
+
+	async def _on_llm_event(self, conversation: Conversation, exchange: Exchange, stream: _MessageStream, event_type: str, data: dict) -> None:
 
 		match event_type:
 
@@ -152,7 +185,16 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 				#     "usage": {"input_tokens": 25, "output_tokens": 1}
 				#   }
 				# }
-				pass
+				usage = data.get('message', {}).get('usage')
+				if usage is not None:
+					cache_read_tokens = usage.get('cache_read_input_tokens') or 0
+					cache_creation_tokens = usage.get('cache_creation_input_tokens') or 0
+					exchange.usage = Usage(
+						input_tokens=usage.get('input_tokens', 0) + cache_read_tokens + cache_creation_tokens,
+						output_tokens=usage.get('output_tokens', 0),
+						cache_read_tokens=cache_read_tokens,
+						cache_creation_tokens=cache_creation_tokens,
+					)
 
 			case 'content_block_start':
 				# {
@@ -172,7 +214,6 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 				#   "index": 0,
 				#   "content_block": {"type": "tool_use", "id": "...", "name": "...", "input": ""}
 				# }
-				self._current_content_block_index = data.get('index')
 				content_block = data.get('content_block', {})
 				block_type = content_block.get('type')
 
@@ -203,8 +244,8 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 						L.warning("Unknown content block type", struct_data={"type": block_type})
 
 				if item is not None:
-					self._current_content_block = item
-					exchange.items.append(item)
+					stream.ContentBlock = item
+					exchange.append_item(item)
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.appended",
 						"item": item.to_dict(),
@@ -231,7 +272,7 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 				delta = data.get('delta', {})
 				delta_type = delta.get('type')
 
-				item = self._current_content_block
+				item = stream.ContentBlock
 				if item is None:
 					L.warning("Received delta without active content block")
 					return
@@ -240,7 +281,7 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 					case 'text_delta':
 						text = delta.get('text', '')
 						if isinstance(item, AssistentMessage):
-							item.content += text
+							item.append_content(text)
 							await self.LLMChatService.send_update(conversation, {
 								"type": "item.delta",
 								"key": item.key,
@@ -250,7 +291,7 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 					case 'thinking_delta':
 						thinking = delta.get('thinking', '')
 						if isinstance(item, AssistentReasoning):
-							item.content += thinking
+							item.append_content(thinking)
 							await self.LLMChatService.send_update(conversation, {
 								"type": "item.delta",
 								"key": item.key,
@@ -260,7 +301,7 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 					case 'input_json_delta':
 						partial_json = delta.get('partial_json', '')
 						if isinstance(item, FunctionCall):
-							item.arguments += partial_json
+							item.append_arguments(partial_json)
 
 					case _:
 						L.warning("Unknown delta type", struct_data={"type": delta_type})
@@ -270,7 +311,7 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 				#   "type": "content_block_stop",
 				#   "index": 0
 				# }
-				item = self._current_content_block
+				item = stream.ContentBlock
 				if item is not None:
 					item.status = 'completed'
 					await self.LLMChatService.send_update(conversation, {
@@ -281,8 +322,7 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 					if isinstance(item, FunctionCall):
 						await self.LLMChatService.create_function_call(conversation, item)
 
-				self._current_content_block = None
-				self._current_content_block_index = None
+				stream.ContentBlock = None
 
 			case 'message_delta':
 				# {
@@ -290,25 +330,53 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 				#   "delta": {"stop_reason": "end_turn", "stop_sequence": null},
 				#   "usage": {"output_tokens": 15}
 				# }
-				pass
+				usage = data.get('usage')
+				if usage is not None and exchange.usage is not None:
+					# The output tokens are cumulative
+					exchange.usage.output_tokens = usage.get('output_tokens', exchange.usage.output_tokens)
 
 			case 'message_stop':
 				# {"type": "message_stop"}
-				pass
+				self.LLMChatService.record_usage(self, conversation, exchange)
 
 			case 'ping':
 				# Keepalive event
 				pass
 
 			case 'error':
-				# Error event from the API
-				error = data.get('error', {})
-				L.error("Error from LLM API", struct_data={"error": error})
+				# {
+				#   "type": "error",
+				#   "error": {"type": "overloaded_error", "message": "Overloaded"}
+				# }
+				# The HTTP status was 200, the router retries or fails over (if nothing has been streamed yet) or sends chat.error
+				error = data.get('error')
+				if not isinstance(error, dict):
+					error = {}
+				raise LLMProviderError(
+					"LLM provider streamed an error: {} {}".format(error.get('type'), error.get('message')),
+					retryable=error.get('type') in _RETRYABLE_ERRORS,
+				)
 
 			case _:
 				L.warning("Unknown/unhandled event", struct_data={"type": event_type})
 
 
+	def _cache_breakpoint(self, message: str) -> str:
+		'''
+		Mark the last content block of the JSON encoded message as a prompt cache breakpoint.
+		'''
+		codec = self.LLMChatService.JSONCodec
+		decoded = codec.loads(message)
+		content = decoded['content']
+		if isinstance(content, str):
+			if len(content) == 0:
+				# Empty text blocks are not allowed
+				return message
+			content = decoded['content'] = [{"type": "text", "text": content}]
+		content[-1]["cache_control"] = {"type": "ephemeral"}
+		return codec.dumps(decoded)
+
+
 	def _build_tools(self, conversation: Conversation) -> list[dict]:
 		'''
 		https://platform.claude.com/docs/en/api/messages/create
@@ -1,16 +1,19 @@
-import json
-import asyncio
+import time
+import typing
 import logging
 
-import aiohttp
-
 import asab
 
-from ..datamodel import Conversation, Exchange, AssistentMessage, AssistentReasoning, FunctionCall, FunctionCallTool
-from .provider_abc import LLMChatProviderABC
+from ..datamodel import Conversation, Exchange, AssistentMessage, AssistentReasoning, FunctionCall, FunctionCallTool, Usage
+from .provider_abc import LLMChatProviderABC, LLMProviderError
+from .sse import iter_sse
 
 L = logging.getLogger(__name__)
 
+# Events that carry generated tokens, the first one gives the time-to-first-token
+_TOKEN_EVENTS = frozenset(['response.output_text.delta', 'response.reasoning_text.delta', 'response.function_call_arguments.delta'])
+
+
 class LLMChatProviderV1Response(LLMChatProviderABC):
 	'''
 	OpenAI API v1 responses adapter.
@@ -19,9 +22,8 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 	'''
 
 	def __init__(self, service, *, url, **kwargs):
-		super().__init__(service, url=url)
+		super().__init__(service, url=url, **kwargs)
 		self.APIKey = kwargs.get('api_key', None)
-		self.Semaphore = asyncio.Semaphore(2)
 
 	def prepare_headers(self):
 		headers = {}
@@ -30,108 +32,101 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 		return headers
 
 
-	async def chat_request(self, conversation: Conversation, exchange: Exchange) -> None:
-		inp = []
-		for exch in conversation.exchanges:
-			for item in exch.items:
-				match item.__class__.__name__:
+	def convert_item(self, item) -> list[dict]:
+		messages = []
+		match item.__class__.__name__:
+
+			case "UserMessage" | "AssistentMessage":
+				messages.append({
+					"role": item.role,
+					"content": item.content,
+				})
+
+			case "AssistentReasoning":
+				# Reasoning items are not included in the input
+				pass
 
-					case "UserMessage" | "AssistentMessage":
-						inp.append({
-							"role": item.role,
-							"content": item.content,
-						})
+			case "FunctionCall":
+				messages.append({
+					"type": "function_call",
+					"call_id": item.call_id,
+					"name": item.name,
+					"arguments": item.arguments,
+				})
 
-					case "AssistentReasoning":
-						# Reasoning items are not included in the input
-						pass
+				messages.append({
+					"type": "function_call_output",
+					"call_id": item.call_id,
+					"output": item.content,
+				})
 
-					case "FunctionCall":
-						inp.append({
-							"type": "function_call",
-							"call_id": item.call_id,
-							"name": item.name,
-							"arguments": item.arguments,
-						})
+		return messages
 
-						inp.append({
-							"type": "function_call_output",
-							"call_id": item.call_id,
-							"output": item.content,
-						})
 
+	async def chat_request(self, conversation: Conversation, exchange: Exchange, on_first_token: typing.Callable = None) -> None:
+		messages = self.build_messages(conversation)
 
 		model = conversation.get_model()
 		assert model is not None
 
 		data = {
 			"model": model,
-			"instructions": conversation.instructions,
-			"input": inp,
+			"instructions": conversation.get_instructions(),
 			"stream": True,  # We expect an SSE response / "text/event-stream"
 		}
 
+		if self.PromptCache:
+			# Requests with the same key are routed to the same prompt cache
+			data["prompt_cache_key"] = conversation.conversation_id
+
 		tools = self._build_tools(conversation)	
 		if len(tools) > 0:
 			data["tools"] = tools
 		
 		L.log(asab.LOG_NOTICE, "Sending request to LLM", struct_data={"conversation_id": conversation.conversation_id, "model": model, "provider": self.URL})
 
-		async with aiohttp.ClientSession(headers=self.prepare_headers()) as session:
-			async with session.post(self.URL + "v1/responses", json=data) as response:
-				if response.status != 200:
-					text = await response.text()
-					L.error(
-						"Error when sending request to LLM chat provider",
-						struct_data={"status": response.status, "text": text}
-					)
-					return
-
-				assert response.content_type == "text/event-stream"
-				event = []  # Accumulator for the event block in the SSE response
-
-				async for line in response.content:
-					if line == b'\n':
-						if len(event) > 0:
-							# Empty line indicates the end of the event block in the SSE response
-							await self._on_llm_event(conversation, exchange, event)
-							event = []
-						continue
-
-					p = line.find(b': ')
-					if p == -1:
-						L.warning("Invalid line in SSE response")
-						return
-
-					event_type = line[:p].decode("utf-8")					
-					match event_type:
-						case "data":
-							data = json.loads(line[p+2:].decode("utf-8"))
-							event.append(('data', data))
-						case "event":
-							event.append(('event', line[p+2:-1].decode("utf-8")))
-						case _:
-							L.warning("Unknown event type in SSE response", struct_data={"event_type": event_type})
-							event.append(('???', line))
-
-				if len(event) > 0:
-					await self._on_llm_event(conversation, exchange, event)
-					event = []
-
-
-	async def _on_llm_event(self, conversation: Conversation, exchange: Exchange, event_items: list[tuple[str, dict | str | bytes]]) -> None:
-		event = {} 
-		for event_type, event_data in event_items:
-			match event_type:
-				case 'data':
-					event['data'] = event_data
-				case 'event':
-					event['type'] = event_data
-				case _:
-					L.warning("Unknown event item type", struct_data={"event_item_type": event_type})
-					pass
-
-		match event.get('type', "???"):
+		self.RequestCount += 1
+		started_at = time.monotonic()
+		payload = self.dump_payload(data, "input", messages)
+		async with self.Session.post(self.URL + "v1/responses", data=payload, headers={"Content-Type": "application/json"}) as response:
+			if response.status != 200:
+				error = await LLMProviderError.from_response(response)
+				L.error(
+					"Error when sending request to LLM chat provider",
+					struct_data={"status": response.status, "text": str(error), "provider": self.URL}
+				)
+				raise error
+
+			assert response.content_type == "text/event-stream"
+			self.mark_success()
+			codec = self.LLMChatService.JSONCodec
+
+			async for event_type, event_data in iter_sse(response.content):
+				if on_first_token is not None:
+					# The first event decides the hedged race, before anything is added to the exchange
+					on_first_token()
+					on_first_token = None
+
+				if event_data == b'[DONE]':
+					break
+
+				try:
+					data = codec.loads(event_data)
+				except codec.DecodeError as e:
+					L.warning("Invalid JSON in SSE response", struct_data={"data": event_data[:1000].decode("utf-8", errors="replace"), "error": str(e)})
+					continue
+
+				event_type = event_type or data.get('type', "???")
+				if started_at is not None and event_type in _TOKEN_EVENTS:
+					# The time to the first generated token; the first events (e.g. 'response.created') arrive before any token
+					self.observe_ttft(started_at)
+					started_at = None
+
+				await self._on_llm_event(conversation, exchange, event_type, data)
+
+
+	async def _on_llm_event(self, conversation: Conversation, exchange: Exchange, event_type: str, data: dict) -> None:
+		match event_type:
 
 			case 'response.created':
 				# {'response': {
@@ -214,7 +209,14 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 
 			case 'response.completed':
 				# TODO: Set status to 'done' for the exchange
-				pass
+				usage = data.get('response', {}).get('usage')
+				if usage is not None:
+					exchange.usage = Usage(
+						input_tokens=usage.get('input_tokens', 0),
+						output_tokens=usage.get('output_tokens', 0),
+						cache_read_tokens=(usage.get('input_tokens_details') or {}).get('cached_tokens', 0),
+					)
+					self.LLMChatService.record_usage(self, conversation, exchange)
 
 
 			case 'response.output_item.added':
@@ -232,37 +234,37 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 				# 	'type': 'response.output_item.added'
 				# }
 
-				# print("->>", event['type'], event['data']['output_index'])
-				# pprint.pprint(event['data'], width=2000)
+				# print("->>", event['type'], data['output_index'])
+				# pprint.pprint(data, width=2000)
 
 				item = None
-				match event['data']['item']['type']:
+				match data['item']['type']:
 					case 'reasoning':
 						item = AssistentReasoning(
-							content=event['data']['item']['content'] or '',
-							status=event['data']['item']['status'],
+							content=data['item']['content'] or '',
+							status=data['item']['status'],
 						)
 
 					case 'message':
 						item = AssistentMessage(
-							role=event['data']['item']['role'],
-							content=event['data']['item']['content'] or '',
-							status=event['data']['item']['status'],
+							role=data['item']['role'],
+							content=data['item']['content'] or '',
+							status=data['item']['status'],
 						)
 
 					case 'function_call':
 						item = FunctionCall(
-							call_id=event['data']['item']['call_id'],
-							name=event['data']['item']['name'],
-							arguments=event['data']['item']['arguments'] or '',
-							status=event['data']['item']['status'],
+							call_id=data['item']['call_id'],
+							name=data['item']['name'],
+							arguments=data['item']['arguments'] or '',
+							status=data['item']['status'],
 						)
 
 					case _:
-						L.warning("Unknown output item type", struct_data={"type": event['data']['item']['type']})
+						L.warning("Unknown output item type", struct_data={"type": data['item']['type']})
 
 				if item is not None:
-					exchange.items.append(item)
+					exchange.append_item(item)
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.appended",
 						"item": item.to_dict(),
@@ -304,12 +306,12 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 				# 'type': 'response.output_item.done'
 				# }
 
-				# print("->>", event['type'], event['data']['output_index'])
-				# pprint.pprint(event['data'], width=2000)
+				# print("->>", event['type'], data['output_index'])
+				# pprint.pprint(data, width=2000)
 
-				item = exchange.get_last_item(event['data']['item']['type'])
+				item = exchange.get_last_item(data['item']['type'])
 				if item is not None:
-					item.status = event['data']['item']['status']  # 'completed'
+					item.status = data['item']['status']  # 'completed'
 					# TODO: Update other fields based on the item type
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.updated",
@@ -359,13 +361,13 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 
 				item = exchange.get_last_item('reasoning')
 				if item is not None:
-					item.content += event['data']['delta']
+					item.append_content(data['delta'])
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.delta",
 						"key": item.key,
-						"delta": event['data']['delta'],
+						"delta": data['delta'],
 					})
-				elif event['data'].get('item_id', '') == '' and len(event['data'].get('delta', '').strip()) == 0:
+				elif data.get('item_id', '') == '' and len(data.get('delta', '').strip()) == 0:
 					# Miss fired event, ignore it
 					# This has been observed on TensorRT LLM with nvidia/Qwen3-235B-A22B-FP4
 					return
@@ -378,13 +380,13 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 			case 'response.output_text.delta':
 				item = exchange.get_last_item('message')
 				if item is not None:
-					item.content += event['data']['delta']
+					item.append_content(data['delta'])
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.delta",
 						"key": item.key,
-						"delta": event['data']['delta'],
+						"delta": data['delta'],
 					})
-				elif event['data'].get('item_id', '') == '' and len(event['data'].get('delta', '').strip()) == 0:
+				elif data.get('item_id', '') == '' and len(data.get('delta', '').strip()) == 0:
 					# Miss fired event, ignore it
 					# This has been observed on TensorRT LLM with nvidia/Qwen3-235B-A22B-FP4
 					return
@@ -409,15 +411,15 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 
 				item = exchange.get_last_item('function_call')
 				if item is not None:
-					item_name = event['data'].get('name', None)
+					item_name = data.get('name', None)
 					if item_name is not None:
 						item.name = item_name
-					item.arguments = event['data']['arguments']
+					item.arguments = data['arguments']
 				else:
 					L.warning("Unknown item for 'response.function_call_arguments.done'")
 
 			case _:
-				L.warning("Unknown/unhandled event", struct_data={"type": event.get('type', "???")})
+				L.warning("Unknown/unhandled event", struct_data={"type": event_type})
 
 
 	def _build_tools(self, conversation: Conversation) -> list[dict]:
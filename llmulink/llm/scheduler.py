@@ -0,0 +1,183 @@
+import time
+import typing
+import asyncio
+import logging
+import collections
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class SchedulerQueueFullError(Exception):
+	pass
+
+
+class _Waiter():
+	__slots__ = ('Future', 'Tenant', 'ConversationId', 'EnqueuedAt')
+
+	def __init__(self, tenant, conversation_id):
+		self.Future = asyncio.get_running_loop().create_future()
+		self.Tenant = tenant
+		self.ConversationId = conversation_id
+		self.EnqueuedAt = time.monotonic()
+
+
+class RequestScheduler():
+	'''
+	Limits the number of concurrent requests to a provider and queues the rest.
+
+	Waiting requests are dispatched in a round-robin fashion, first over tenants and then over conversations of the tenant.
+	One chatty conversation (or tenant) therefore cannot starve the others.
+	'''
+
+	def __init__(self, concurrency: int, queue_size: int, notify_interval: float = 1.0):
+		self.Concurrency = concurrency
+		self.QueueSize = queue_size
+		self.NotifyInterval = notify_interval
+
+		self.Running = 0
+		self.Queued = 0
+
+		# Tenant -> conversation id -> waiters, the order of keys is the round-robin order
+		self.Waiters = collections.OrderedDict[str, collections.OrderedDict[str, collections.deque[_Waiter]]]()
+
+
+	async def acquire(self, tenant: str, conversation_id: str, on_wait: typing.Callable = None) -> float:
+		'''
+		Wait for a free slot, return the time (in seconds) spent waiting in the queue.
+
+		While waiting, `await on_wait(position, wait_time)` is called periodically.
+		The position is 1-based; when the slot is granted after waiting, `on_wait` is called once more with position 0.
+
+		Raises `SchedulerQueueFullError` if the queue is full.
+		'''
+		if self.Running < self.Concurrency and self.Queued == 0:
+			self.Running += 1
+			return 0.0
+
+		if self.Queued >= self.QueueSize:
+			raise SchedulerQueueFullError()
+
+		waiter = _Waiter(tenant, conversation_id)
+		self._enqueue(waiter)
+
+		try:
+			while True:
+				if on_wait is not None:
+					await on_wait(self.position(waiter), time.monotonic() - waiter.EnqueuedAt)
+				done, _ = await asyncio.wait([waiter.Future], timeout=self.NotifyInterval)
+				if len(done) > 0:
+					break
+
+			wait_time = time.monotonic() - waiter.EnqueuedAt
+			if on_wait is not None:
+				await on_wait(0, wait_time)
+
+		except BaseException:
+			# Cancelled or `on_wait` failed, the caller doesn't own the slot
+			if waiter.Future.done() and not waiter.Future.cancelled():
+				# The slot has been granted in the meantime, give it back
+				self.release()
+			else:
+				waiter.Future.cancel()
+				self._remove(waiter)
+			raise
+
+		return wait_time
+
+
+	def release(self) -> None:
+		self.Running -= 1
+		while self.Queued > 0 and self.Running < self.Concurrency:
+			waiter = self._dequeue()
+			if waiter.Future.done():
+				continue
+			self.Running += 1
+			waiter.Future.set_result(True)
+
+
+	def position(self, waiter: _Waiter) -> int:
+		'''
+		Compute the (1-based) position of the waiter in the dispatch order.
+		'''
+		queues = [
+			[list(waiters) for waiters in conversations.values()]
+			for conversations in self.Waiters.values()
+		]
+
+		position = 0
+		while len(queues) > 0:
+			tenant = queues.pop(0)
+			conversation = tenant.pop(0)
+			position += 1
+			if conversation.pop(0) is waiter:
+				return position
+			if len(conversation) > 0:
+				tenant.append(conversation)
+			if len(tenant) > 0:
+				queues.append(tenant)
+
+		return position
+
+
+	def get_stats(self) -> dict:
+		return {
+			"concurrency": self.Concurrency,
+			"running": self.Running,
+			"queued": self.Queued,
+		}
+
+
+	def _enqueue(self, waiter: _Waiter) -> None:
+		conversations = self.Waiters.get(waiter.Tenant)
+		if conversations is None:
+			conversations = self.Waiters[waiter.Tenant] = collections.OrderedDict()
+		waiters = conversations.get(waiter.ConversationId)
+		if waiters is None:
+			waiters = conversations[waiter.ConversationId] = collections.deque()
+		waiters.append(waiter)
+		self.Queued += 1
+
+
+	def _dequeue(self) -> _Waiter:
+		tenant, conversations = next(iter(self.Waiters.items()))
+		conversation_id, waiters = next(iter(conversations.items()))
+
+		waiter = waiters.popleft()
+		self.Queued -= 1
+
+		# Rotate so that the next dispatch goes to other conversation and other tenant
+		if len(waiters) > 0:
+			conversations.move_to_end(conversation_id)
+		else:
+			del conversations[conversation_id]
+
+		if len(conversations) > 0:
+			self.Waiters.move_to_end(tenant)
+		else:
+			del self.Waiters[tenant]
+
+		return waiter
+
+
+	def _remove(self, waiter: _Waiter) -> None:
+		conversations = self.Waiters.get(waiter.Tenant)
+		if conversations is None:
+			return
+		waiters = conversations.get(waiter.ConversationId)
+		if waiters is None:
+			return
+
+		try:
+			waiters.remove(waiter)
+		except ValueError:
+			return
+		self.Queued -= 1
+
+		if len(waiters) == 0:
+			del conversations[waiter.ConversationId]
+		if len(conversations) == 0:
+			del self.Waiters[waiter.Tenant]
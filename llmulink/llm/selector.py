@@ -0,0 +1,108 @@
+import abc
+import hashlib
+import random
+import logging
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class ProviderSelectorABC(abc.ABC):
+	'''
+	Policy that selects one provider from providers that serve the requested model.
+	'''
+
+	@abc.abstractmethod
+	def select(self, providers: list, conversation):
+		pass
+
+
+class RandomSelector(ProviderSelectorABC):
+
+	def select(self, providers: list, conversation):
+		return random.choice(providers)
+
+
+class LeastOutstandingSelector(ProviderSelectorABC):
+	'''
+	Select the provider with the lowest number of outstanding (queued or running) requests.
+	Ties are broken randomly.
+	'''
+
+	def select(self, providers: list, conversation):
+		lowest = min(provider.Outstanding for provider in providers)
+		return random.choice([provider for provider in providers if provider.Outstanding == lowest])
+
+
+class PowerOfTwoChoicesSelector(ProviderSelectorABC):
+	'''
+	Pick two providers at random and select the one with less outstanding requests.
+	'''
+
+	def select(self, providers: list, conversation):
+		if len(providers) < 2:
+			return providers[0]
+		a, b = random.sample(providers, 2)
+		return a if a.Outstanding <= b.Outstanding else b
+
+
+class EWMATimeToFirstTokenSelector(ProviderSelectorABC):
+	'''
+	Select the provider with the lowest expected time-to-first-token.
+
+	The expected time is the EWMA of the observed time-to-first-token multiplied by the number of outstanding requests (plus the new one).
+	Providers without any observation are preferred so that they get measured.
+	'''
+
+	def select(self, providers: list, conversation):
+		unmeasured = [provider for provider in providers if provider.TTFT is None]
+		if len(unmeasured) > 0:
+			return min(unmeasured, key=lambda provider: provider.Outstanding)
+		return min(providers, key=lambda provider: provider.TTFT * (provider.Outstanding + 1))
+
+
+class AffinitySelector(ProviderSelectorABC):
+	'''
+	Route all requests of the conversation to the same provider, so that the provider can reuse the KV cache of the conversation prefix.
+
+	Providers are ordered by the rendezvous (highest random weight) hash of the conversation id and the provider URL.
+	When a provider is added or removed, only conversations that prefer this provider move.
+	If the preferred provider is saturated, the request spills over to the next provider in that order
+	(unhealthy providers are already filtered out by the router).
+	'''
+
+	def select(self, providers: list, conversation):
+		key = conversation.conversation_id.encode("utf-8") + b'\0'
+		ordered = sorted(providers, key=lambda provider: _hrw_weight(key, provider), reverse=True)
+
+		for provider in ordered:
+			if provider.Outstanding < provider.Scheduler.Concurrency:
+				return provider
+
+		# All providers are saturated, pick the least loaded one (keeping the affinity order on ties)
+		return min(ordered, key=lambda provider: provider.Outstanding)
+
+
+def _hrw_weight(key: bytes, provider) -> int:
+	digest = hashlib.blake2b(key + provider.URL.encode("utf-8"), digest_size=8).digest()
+	return int.from_bytes(digest, "big")
+
+
+Selectors = {
+	"random": RandomSelector,
+	"least_outstanding": LeastOutstandingSelector,
+	"p2c": PowerOfTwoChoicesSelector,
+	"ewma_ttft": EWMATimeToFirstTokenSelector,
+	"affinity": AffinitySelector,
+}
+
+
+def create_selector(name: str) -> ProviderSelectorABC:
+	selector_class = Selectors.get(name)
+	if selector_class is None:
+		L.warning("Unknown provider selection policy, using 'random'", struct_data={"selection": name})
+		selector_class = RandomSelector
+	return selector_class()
@@ -0,0 +1,52 @@
+import logging
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class ConversationSnapshot():
+	'''
+	Serialized items of the conversation for full updates.
+
+	Items are cached in the form they were last sent to clients (`item.appended`, `item.updated`).
+	Events that change the item on the client (`item.delta`, `item.patched`) only invalidate the cached form,
+	the item is serialized again when the next full update needs it.
+	'''
+
+	def __init__(self):
+		self.Items = {}  # key -> item dict, None if it has to be serialized again
+
+
+	def on_event(self, event: dict) -> None:
+		match event.get('type'):
+			case 'item.appended' | 'item.updated':
+				item = event['item']
+				self.Items[item['key']] = item
+			case 'item.delta' | 'item.patched':
+				self.Items[event['key']] = None
+
+
+	def get_items(self, exchanges, patcher) -> list[dict]:
+		items = []
+		for exchange in exchanges:
+			for item in exchange.items:
+				item_dict = self.Items.get(item.key)
+				if item_dict is None:
+					item_dict = item.to_dict()
+					if patcher is not None:
+						item_dict['version'] = patcher.get_version(item.key)
+					self.Items[item.key] = item_dict
+				items.append(item_dict)
+		return items
+
+
+	def forget(self, exchanges) -> None:
+		'''
+		Drop cached items of exchanges that were removed from the conversation.
+		'''
+		for exchange in exchanges:
+			for item in exchange.items:
+				self.Items.pop(item.key, None)
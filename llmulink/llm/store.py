@@ -0,0 +1,235 @@
+import time
+import logging
+import collections
+
+import asab
+
+from .datamodel import Conversation
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+asab.Config.add_defaults({
+	"llm": {
+		# Conversations without clients and running tasks are evicted after this idle time (in seconds), 0 disables
+		"conversation_ttl": 3600,
+		# Limits of resident conversations, the least recently used idle conversations are evicted first; 0 disables
+		"conversation_max_count": 10000,
+		"conversation_max_bytes": 1073741824,
+	}
+})
+
+
+class ConversationStore():
+	'''
+	Resident conversations of the router, in the least recently used order.
+
+	A conversation is idle when it has no monitors (clients) and no running tasks; only idle conversations are evicted:
+
+	* after `conversation_ttl` seconds since the last activity,
+	* when there are more than `conversation_max_count` conversations or they take more than `conversation_max_bytes`.
+
+	The size of the conversation is approximate (texts of items and cached provider payloads).
+	It is kept up to date by events of the conversation and by providers that cache converted messages (see `grow`),
+	changes that cannot be accounted this way (restart, new instructions, compaction) only mark the conversation
+	and it is measured again by the next sweep (see `invalidate`).
+	'''
+
+	def __init__(self, app):
+		self.TTL = asab.Config.getfloat("llm", "conversation_ttl")
+		self.MaxCount = asab.Config.getint("llm", "conversation_max_count")
+		self.MaxBytes = asab.Config.getint("llm", "conversation_max_bytes")
+
+		self.Conversations = collections.OrderedDict()  # conversation id -> Conversation, the least recently used first
+		self.LastActive = {}  # conversation id -> time.monotonic() of the last activity
+		self.Sizes = {}  # conversation id -> approximate size in bytes
+		self.Bytes = 0
+		self.Invalid = set()  # conversation ids to be measured again by the sweep
+
+		self.Gauge = app.MetricsService.create_gauge(
+			"llm_conversations",
+			init_values={"resident": 0, "bytes": 0},
+			help="Conversations kept in the memory and their approximate size",
+		)
+		self.Evictions = app.MetricsService.create_counter(
+			"llm_conversation_evictions",
+			init_values={"ttl": 0, "count": 0, "bytes": 0},
+			help="Conversations evicted from the memory, by the reason",
+		)
+
+		self.PubSub = app.PubSub
+		app.PubSub.subscribe("Application.tick/10!", self._on_tick)
+		app.PubSub.subscribe("Metrics.flush!", self._on_metrics_flush)
+
+
+	def __len__(self) -> int:
+		return len(self.Conversations)
+
+
+	def __contains__(self, conversation_id: str) -> bool:
+		return conversation_id in self.Conversations
+
+
+	def get(self, conversation_id: str) -> Conversation | None:
+		conversation = self.Conversations.get(conversation_id)
+		if conversation is not None:
+			self.touch(conversation)
+		return conversation
+
+
+	def add(self, conversation: Conversation) -> None:
+		self.Conversations[conversation.conversation_id] = conversation
+		self.LastActive[conversation.conversation_id] = time.monotonic()
+		# A recovered conversation already has its history, it is measured once here
+		size = _estimate_size(conversation)
+		self.Bytes += size - self.Sizes.get(conversation.conversation_id, 0)
+		self.Sizes[conversation.conversation_id] = size
+
+		if self.MaxCount > 0 and len(self.Conversations) > self.MaxCount:
+			# The new conversation has no clients yet, but it is not to be evicted
+			self._evict_lru(reason="count", keep=conversation.conversation_id)
+
+
+	def remove(self, conversation_id: str) -> Conversation | None:
+		self.LastActive.pop(conversation_id, None)
+		self.Bytes -= self.Sizes.pop(conversation_id, 0)
+		self.Invalid.discard(conversation_id)
+		conversation = self.Conversations.pop(conversation_id, None)
+		if conversation is not None:
+			if conversation.coalescer is not None:
+				# Deltas of a dropped conversation are not sent anymore
+				conversation.coalescer.close()
+			self.PubSub.publish("ConversationStore.removed!", conversation_id)
+		return conversation
+
+
+	def touch(self, conversation: Conversation) -> None:
+		'''
+		Mark the activity of the conversation, it becomes the most recently used one.
+		'''
+		conversation_id = conversation.conversation_id
+		if conversation_id in self.LastActive:
+			self.Conversations.move_to_end(conversation_id)
+			self.LastActive[conversation_id] = time.monotonic()
+
+
+	def on_event(self, conversation: Conversation, event: dict) -> None:
+		'''
+		Account the change of the conversation described by the event, in O(1).
+		'''
+		match event.get('type'):
+			case 'item.delta':
+				self.grow(conversation, len(event['delta']))
+			case 'item.appended':
+				item = event['item']
+				self.grow(conversation, _ITEM_OVERHEAD + len(item.get('content') or '') + len(item.get('arguments') or ''))
+			case 'item.patched':
+				# The append offset is the length of the field the patcher has seen, only the appended text is new
+				self.grow(conversation, sum(len(text) for _, text in event.get('append', {}).values()))
+				changed = event.get('set', {})
+				if 'content' in changed or 'arguments' in changed:
+					self.invalidate(conversation)
+			case 'item.updated':
+				# The previous size of the item is not known
+				self.invalidate(conversation)
+
+
+	def grow(self, conversation: Conversation, size: int) -> None:
+		'''
+		Add bytes to the size of the conversation, e.g. messages cached by a provider.
+		'''
+		conversation_id = conversation.conversation_id
+		if size != 0 and conversation_id in self.Sizes:
+			self.Sizes[conversation_id] += size
+			self.Bytes += size
+
+
+	def invalidate(self, conversation: Conversation) -> None:
+		'''
+		The size of the conversation changed in a way that is not accounted, it is measured again by the next sweep.
+		'''
+		if conversation.conversation_id in self.Sizes:
+			self.Invalid.add(conversation.conversation_id)
+
+
+	def sweep(self) -> None:
+		'''
+		Measure invalidated conversations, evict expired ones and then the least recently used ones over the limits.
+		'''
+		for conversation_id in self.Invalid:
+			size = _estimate_size(self.Conversations[conversation_id])
+			self.Bytes += size - self.Sizes[conversation_id]
+			self.Sizes[conversation_id] = size
+		self.Invalid.clear()
+
+		if self.TTL > 0:
+			# Conversations are in the order of their last activity, only the expired prefix is visited
+			expired_before = time.monotonic() - self.TTL
+			expired = []
+			for conversation_id, conversation in self.Conversations.items():
+				if self.LastActive[conversation_id] >= expired_before:
+					break
+				if _is_idle(conversation):
+					expired.append(conversation_id)
+			for conversation_id in expired:
+				self._evict(conversation_id, reason="ttl")
+
+		if self.MaxCount > 0 and len(self.Conversations) > self.MaxCount:
+			self._evict_lru(reason="count")
+
+		if self.MaxBytes > 0 and self.Bytes > self.MaxBytes:
+			self._evict_lru(reason="bytes")
+
+
+	def _evict_lru(self, reason: str, keep: str = None) -> None:
+		count, bytes_total = len(self.Conversations), self.Bytes
+		evicted = []
+		for conversation_id, conversation in self.Conversations.items():
+			if reason == "count" and count <= self.MaxCount:
+				break
+			if reason == "bytes" and bytes_total <= self.MaxBytes:
+				break
+			if conversation_id != keep and _is_idle(conversation):
+				evicted.append(conversation_id)
+				count -= 1
+				bytes_total -= self.Sizes[conversation_id]
+		for conversation_id in evicted:
+			self._evict(conversation_id, reason=reason)
+
+
+	def _evict(self, conversation_id: str, reason: str) -> None:
+		self.remove(conversation_id)
+		self.Evictions.add(reason, 1)
+		L.info("Conversation evicted", struct_data={"conversation_id": conversation_id, "reason": reason})
+
+
+	def _on_tick(self, message_type):
+		self.sweep()
+
+
+	def _on_metrics_flush(self, message_type):
+		self.Gauge.set("resident", len(self.Conversations))
+		self.Gauge.set("bytes", self.Bytes)
+
+
+def _is_idle(conversation: Conversation) -> bool:
+	return len(conversation.monitors) == 0 and len(conversation.tasks) == 0
+
+
+_ITEM_OVERHEAD = 512  # Approximate size of the item object itself and its dicts in the snapshot and the patcher
+
+
+def _estimate_size(conversation: Conversation) -> int:
+	size = len(conversation.instructions)
+	for exchange in conversation.exchanges:
+		for item in exchange.items:
+			size += _ITEM_OVERHEAD + item.content_length
+			arguments = getattr(item, 'arguments', None)
+			if arguments is not None:
+				size += len(arguments)
+	for cache in conversation.payload_cache.values():
+		size += sum(len(message) for message in cache.Messages)
+	return size
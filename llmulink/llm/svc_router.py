@@ -1,16 +1,35 @@
 import re
+import time
 import uuid
+import weakref
+import collections
 import random
+import itertools
+import functools
 import asyncio
 import logging
 
 import yaml
 import asab
+import aiohttp
 import jinja2
 
-from .datamodel import Conversation, UserMessage, Exchange, FunctionCall, FunctionCallTool
+from .datamodel import Conversation, UserMessage, Exchange, FunctionCall, FunctionCallTool, Usage
 from .tool_ping import tool_ping
-
+from .catalog import ModelCatalog
+from .selector import create_selector
+from .scheduler import SchedulerQueueFullError
+from .codec import create_codec
+from .coalescer import DeltaCoalescer
+from .monitor import ConversationMonitor
+from .patcher import ItemPatcher
+from .snapshot import ConversationSnapshot
+from .store import ConversationStore
+from .context import ContextManager
+from .cluster import ConversationOwnership
+from .journal import ConversationJournal
+
+from .provider.provider_abc import LLMProviderError
 from .provider.v1response import LLMChatProviderV1Response
 from .provider.v1messages import LLMChatProviderV1Messages
 from .provider.v1chatcompletition import LLMChatProviderV1ChatCompletition
@@ -21,6 +40,37 @@ L = logging.getLogger(__name__)
 
 #
 
+asab.Config.add_defaults({
+	"llm": {
+		# Default provider selection policy: random, least_outstanding, p2c, ewma_ttft, affinity
+		"selection": "least_outstanding",
+		# JSON codec for LLM streams and websockets: auto, json, orjson, msgspec
+		"json_codec": "auto",
+		# Failed requests (before the first token) are retried on other providers of the model
+		"retry_attempts": 3,
+		"retry_backoff": 0.5,
+		"retry_max_delay": 30,
+		# Send a duplicate request to another provider when the first token doesn't arrive within this time (in seconds), 0 disables
+		"hedge_after": 0,
+		# Consecutive deltas of the item are merged for up to this time (in seconds) or size (in characters), 0 disables
+		"delta_coalesce_window": 0.025,
+		"delta_coalesce_size": 1024,
+		# Outbound queue of each client (in events) and what happens when it overflows: merge, resync, disconnect
+		"monitor_queue_size": 1000,
+		"monitor_overflow": "merge",
+		# Send only changed fields and appended text of updated items (item.patched), 'false' sends whole items (item.updated)
+		"item_patches": True,
+		# Recent events kept per conversation so that a reconnecting client receives only what it missed
+		"replay_buffer_size": 1000,
+		# Exchanges in the full update (the most recent ones), older are sent on request of the client; 0 means all
+		"full_update_exchanges": 0,
+	}
+})
+
+# Ids of conversations given by clients, they are a part of ZooKeeper paths in the cluster mode
+CONVERSATION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,128}")
+
+
 class LLMRouterService(asab.Service):
 
 
@@ -28,48 +78,206 @@ class LLMRouterService(asab.Service):
 		super().__init__(app, service_name)
 
 		self.LibraryService = app.LibraryService
+		self.MetricsService = app.MetricsService
+
+		self.RetryAttempts = max(1, asab.Config.getint("llm", "retry_attempts"))
+		self.RetryBackoff = asab.Config.getfloat("llm", "retry_backoff")
+		self.RetryMaxDelay = asab.Config.getfloat("llm", "retry_max_delay")
+		self.HedgeAfter = asab.Config.getfloat("llm", "hedge_after")
+		self.CoalesceWindow = asab.Config.getfloat("llm", "delta_coalesce_window")
+		self.CoalesceSize = asab.Config.getint("llm", "delta_coalesce_size")
+		self.MonitorQueueSize = asab.Config.getint("llm", "monitor_queue_size")
+		self.MonitorOverflow = asab.Config.get("llm", "monitor_overflow")
+		self.ItemPatches = asab.Config.getboolean("llm", "item_patches")
+		self.ReplayBufferSize = asab.Config.getint("llm", "replay_buffer_size")
+		self.FullUpdateExchanges = asab.Config.getint("llm", "full_update_exchanges")
+		if self.MonitorOverflow not in ('merge', 'resync', 'disconnect'):
+			L.warning("Unknown monitor overflow policy, using 'merge'", struct_data={"monitor_overflow": self.MonitorOverflow})
+			self.MonitorOverflow = 'merge'
+
+		self.JSONCodec = create_codec(asab.Config.get("llm", "json_codec"))
+		L.log(asab.LOG_NOTICE, "JSON codec selected", struct_data={"json_codec": self.JSONCodec.Name})
 
 		self.Providers = []
-		self.Conversations = dict[str, Conversation]()
+		self.Selectors = {}  # Provider group -> selection policy
+		self.Conversations = ConversationStore(app)
+		self.Monitors = weakref.WeakSet()
 
 		self.load_providers()
+		self.ModelCatalog = ModelCatalog(app, self.Providers)
+		self.ContextManager = ContextManager(self)
+
+		self.Cluster = None
+		advertised_url = asab.Config.get("cluster", "advertised_url")
+		if len(advertised_url) > 0:
+			if getattr(app, 'ZkContainer', None) is None:
+				L.warning("Cluster mode requires ZooKeeper, it is disabled")
+			else:
+				self.Cluster = ConversationOwnership(self, app, advertised_url)
+
+		self.Opening = {}  # conversation id -> task that opens the conversation, see `open_conversation`
+
+		self.Journal = None
+		journal_path = asab.Config.get("journal", "path")
+		if len(journal_path) > 0:
+			self.Journal = ConversationJournal(self, app, journal_path)
+
+		self.PoolGauges = {}
+		self.SchedulerGauges = {}
+		self.TokenCounters = {}
+		for provider in self.Providers:
+			self.TokenCounters[provider] = self.MetricsService.create_counter(
+				"llm_provider_tokens",
+				tags={"provider": provider.URL},
+				init_values=Usage().to_dict(),
+				help="Tokens processed by the LLM provider, including prompt cache hits and writes",
+			)
+			self.PoolGauges[provider] = self.MetricsService.create_gauge(
+				"llm_provider_pool",
+				tags={"provider": provider.URL},
+				init_values=provider.get_pool_stats(),
+				help="Usage of the HTTP connection pool of the LLM provider",
+			)
+			self.SchedulerGauges[provider] = self.MetricsService.create_gauge(
+				"llm_provider_scheduler",
+				tags={"provider": provider.URL},
+				init_values=provider.Scheduler.get_stats(),
+				help="Running and queued requests of the LLM provider",
+			)
+		self.MonitorGauge = self.MetricsService.create_gauge(
+			"llm_monitors",
+			init_values={"clients": 0, "queued": 0, "queued_max": 0, "lag_max": 0.0},
+			help="Connected clients and their outbound queues; lag is the age of the oldest unsent event in seconds",
+		)
+		self.MonitorCounter = self.MetricsService.create_counter(
+			"llm_monitor_events",
+			init_values={"sent": 0, "merged": 0, "resyncs": 0, "disconnects": 0},
+			help="Events sent to clients and overflows of client outbound queues",
+		)
+		app.PubSub.subscribe("Metrics.flush!", self._on_metrics_flush)
+
+
+	async def initialize(self, app):
+		if self.Journal is not None:
+			try:
+				await self.Journal.initialize()
+			except RuntimeError as e:
+				L.error("Journal of conversations is disabled", struct_data={"error": str(e)})
+				self.Journal = None
+
+		async with asyncio.TaskGroup() as tg:
+			for provider in self.Providers:
+				tg.create_task(provider.initialize())
+
+		self.ModelCatalog.start()
+
+
+	async def finalize(self, app):
+		self.ModelCatalog.stop()
+		for provider in self.Providers:
+			try:
+				await provider.finalize()
+			except Exception:
+				L.exception("Error when finalizing provider", struct_data={"provider": provider.URL})
+		if self.Cluster is not None:
+			await self.Cluster.finalize()
+
+		# Pending deltas are sent (and journaled) before the journal is closed
+		for conversation in list(self.Conversations.Conversations.values()):
+			if conversation.coalescer is None:
+				continue
+			try:
+				await conversation.coalescer.flush()
+			except Exception:
+				L.exception("Error when flushing coalesced deltas", struct_data={"conversation_id": conversation.conversation_id})
+			conversation.coalescer.close()
+
+		if self.Journal is not None:
+			await self.Journal.finalize()
+
+
+	def _on_metrics_flush(self, message_type):
+		for provider, gauge in self.PoolGauges.items():
+			for name, value in provider.get_pool_stats().items():
+				gauge.set(name, value)
+		for provider, gauge in self.SchedulerGauges.items():
+			for name, value in provider.Scheduler.get_stats().items():
+				gauge.set(name, value)
+
+		monitors = list(self.Monitors)
+		self.MonitorGauge.set("clients", len(monitors))
+		self.MonitorGauge.set("queued", sum(len(monitor.Queue) for monitor in monitors))
+		self.MonitorGauge.set("queued_max", max((len(monitor.Queue) for monitor in monitors), default=0))
+		self.MonitorGauge.set("lag_max", max((monitor.get_lag() for monitor in monitors), default=0.0))
 
 
 	def load_providers(self):
+		group_selections = {}
 		for section in asab.Config.sections():
 			if not section.startswith("provider:"):
 				continue
 
-			ptype = asab.Config[section].get('type')
+			config = dict(asab.Config[section])
+			config['name'] = section[len("provider:"):]
+
+			ptype = config.get('type')
 			match ptype:
 				case 'LLMChatProviderV1Response':
-					self.Providers.append(LLMChatProviderV1Response(self, **asab.Config[section]))
+					provider = LLMChatProviderV1Response(self, **config)
 				case 'LLMChatProviderV1Messages':
-					self.Providers.append(LLMChatProviderV1Messages(self, **asab.Config[section]))
+					provider = LLMChatProviderV1Messages(self, **config)
 				case 'LLMChatProviderV1ChatCompletition':
-					self.Providers.append(LLMChatProviderV1ChatCompletition(self, **asab.Config[section]))
+					provider = LLMChatProviderV1ChatCompletition(self, **config)
 				case _:
 					L.warning("Unknown provider type, skipping", struct_data={"type": ptype})
-
-
-	async def create_conversation(self):
-		while True:
+					continue
+
+			self.Providers.append(provider)
+
+			selection = config.get('selection')
+			if selection is not None:
+				group_selections.setdefault(provider.Group, selection)
+
+		# The selection policy is configured per group of providers, the first section in the group that specifies it wins
+		for provider in self.Providers:
+			if provider.Group not in self.Selectors:
+				selection = group_selections.get(provider.Group, asab.Config.get("llm", "selection"))
+				self.Selectors[provider.Group] = create_selector(selection)
+
+
+	def select_provider(self, model: str, conversation: Conversation, exclude: set = frozenset()):
+		'''
+		Select a provider for the model using the selection policy of the provider group.
+		When providers of the model belong to different groups, the policy of the group of the first one is used.
+		Unhealthy providers are used only if there is no healthy one.
+		'''
+		providers = [provider for provider in self.ModelCatalog.get_providers(model) if provider not in exclude]
+		if len(providers) == 0:
+			return None
+		healthy = [provider for provider in providers if provider.is_healthy()]
+		if len(healthy) > 0:
+			providers = healthy
+		return self.Selectors[providers[0].Group].select(providers, conversation)
+
+
+	async def create_conversation(self, tenant: str = None, conversation_id: str = None):
+		while conversation_id is None:
 			conversation_id = 'conversation-' + uuid.uuid4().hex
 			if conversation_id in self.Conversations:
-				continue
-			break
+				conversation_id = None
 
-		L.log(asab.LOG_NOTICE, "New conversation created", struct_data={"conversation_id": conversation_id})
+		L.log(asab.LOG_NOTICE, "New conversation created", struct_data={"conversation_id": conversation_id, "tenant": tenant})
 
 		async with self.LibraryService.open("/AI/Prompts/default.yaml") as item_io:
 			promt_decl = yaml.safe_load(item_io.read().decode("utf-8"))
 
 		conversation = Conversation(
 			conversation_id=conversation_id,
+			tenant=tenant,
 			instructions=promt_decl["instructions"],
 			tools=self.App.ToolService.get_tools()
 		)
-		self.Conversations[conversation.conversation_id] = conversation
+		self.Conversations.add(conversation)
 		return conversation
 
 
@@ -81,11 +289,28 @@ class LLMRouterService(asab.Service):
 
 
 	def restart_conversation(self, conversation: Conversation, key: str) -> None:
-		for i in range(len(conversation.exchanges)):
-			if conversation.exchanges[i].items[0].key == key:
-				del conversation.exchanges[i:]
-				return
-		L.warning("Conversation restart failed", struct_data={"conversation_id": conversation.conversation_id, "key": key})
+		position = conversation.find_item(key)
+		if position is None or position[1] != 0:
+			# The conversation restarts only from the first item of the exchange
+			L.warning("Conversation restart failed", struct_data={"conversation_id": conversation.conversation_id, "key": key})
+			return
+
+		removed = conversation.truncate(position[0])
+		if conversation.snapshot is not None:
+			conversation.snapshot.forget(removed)
+		if conversation.patcher is not None:
+			conversation.patcher.forget(item.key for exchange in removed for item in exchange.items)
+		if conversation.context is not None and conversation.context.Start > position[0]:
+			# The summary covers removed exchanges
+			conversation.context = None
+		conversation.payload_cache.clear()
+		self.Conversations.invalidate(conversation)
+		# Removed items cannot be replayed, resuming clients get a full update
+		conversation.sequence += 1
+		if conversation.replay is not None:
+			conversation.replay.clear()
+		if self.Journal is not None:
+			self.Journal.on_restart(conversation, position[0])
 			
 
 	async def update_instructions(self, conversation: Conversation, item: str, params: dict) -> None:
@@ -96,20 +321,85 @@ class LLMRouterService(asab.Service):
 
 		instructions = promt_decl["instructions"]
 		conversation.instructions = jinja2.Template(instructions).render(params)
+		conversation.payload_cache.clear()
+		self.Conversations.invalidate(conversation)
+		if self.Journal is not None:
+			self.Journal.on_instructions(conversation)
 
 
-	async def get_conversation(self, conversation_id, create=False):
+	async def get_conversation(self, conversation_id, create=False, tenant=None):
 		conversation = self.Conversations.get(conversation_id)
 		if conversation is None and create:
-			conversation = await self.create_conversation(conversation_id)
+			conversation = await self.create_conversation(tenant, conversation_id=conversation_id)
 		return conversation
 
 
+	async def open_conversation(self, tenant: str, conversation_id: str = None) -> tuple[Conversation | None, str | None]:
+		'''
+		Get the conversation of the websocket client: a new one (if `conversation_id` is None), the resident one
+		or the one recovered from the journal.
+		Conversations of websocket clients are journaled, see `ConversationJournal`.
+
+		In the cluster mode, `(None, url)` is returned when another node owns the conversation, the client is to be proxied to `url`.
+		A conversation without an owner is taken over only if it is in the journal of this node (e.g. the node owned it before
+		its restart), otherwise its history is gone with its node and `(None, None)` is returned, the conversation is lost.
+
+		Concurrent opens of the same conversation share one attempt, so it is not recovered or created twice.
+		Raises `ValueError` when `conversation_id` is not a valid id (see `CONVERSATION_ID_PATTERN`).
+		'''
+		if conversation_id is None:
+			conversation = await self.create_conversation(tenant)
+			if self.Cluster is not None:
+				await self.Cluster.claim(conversation.conversation_id)
+			if self.Journal is not None:
+				self.Journal.register(conversation)
+			return conversation, None
+
+		if CONVERSATION_ID_PATTERN.fullmatch(conversation_id) is None:
+			raise ValueError("Invalid conversation id")
+
+		conversation = self.Conversations.get(conversation_id)
+		if conversation is not None:
+			return conversation, None
+
+		task = self.Opening.get(conversation_id)
+		if task is None:
+			# The task is not cancelled with the client that started it, other clients may wait for it
+			task = asyncio.create_task(self._open_conversation(tenant, conversation_id), name="open-{}".format(conversation_id))
+			self.Opening[conversation_id] = task
+			task.add_done_callback(lambda _: self.Opening.pop(conversation_id, None))
+		return await asyncio.shield(task)
+
+
+	async def _open_conversation(self, tenant: str, conversation_id: str) -> tuple[Conversation | None, str | None]:
+		if self.Cluster is not None:
+			owner = await self.Cluster.claim(conversation_id)
+			if owner is not None:
+				return None, owner
+
+		if self.Journal is not None:
+			conversation = await self.Journal.recover(conversation_id, self.App.ToolService.get_tools())
+			if conversation is not None:
+				self.Conversations.add(conversation)
+				return conversation, None
+
+		if self.Cluster is not None:
+			# An empty conversation under the same id would hide the lost history from the client
+			L.warning("Conversation is lost, its history is not available on this node", struct_data={"conversation_id": conversation_id, "tenant": tenant})
+			await self.Cluster.release(conversation_id)
+			return None, None
+
+		conversation = await self.create_conversation(tenant, conversation_id=conversation_id)
+		if self.Journal is not None:
+			self.Journal.register(conversation)
+		return conversation, None
+
+
 	async def create_exchange(self, conversation: Conversation, item: UserMessage) -> None:
 		new_exchange = Exchange()
-		conversation.exchanges.append(new_exchange)
+		conversation.append_exchange(new_exchange)
 
-		new_exchange.items.append(item)
+		new_exchange.append_item(item)
 		await self.send_update(conversation, {
 			"type": "item.appended",
 			"item": item.to_dict(),
@@ -130,7 +420,7 @@ class LLMRouterService(asab.Service):
 			if len(conversation.tasks) == 0 and conversation.chat_requested:
 				# Initialize a new exchange with LLM
 				new_exchange = Exchange()
-				conversation.exchanges.append(new_exchange)
+				conversation.append_exchange(new_exchange)
 				conversation.chat_requested = False
 
 				t = asyncio.create_task(
@@ -162,71 +452,348 @@ class LLMRouterService(asab.Service):
 		model = conversation.get_model()
 		assert model is not None, "Model is not set"
 
-		# Find and select a provider for the model
-		providers = [provider for provider in self.Providers if model in set(model['id'] for model in provider.Models)]
-		assert len(providers) > 0, "No provider found for model"
-		provider = random.choice(providers)
+		await self.ContextManager.prepare(conversation, model)
+
+		items_count = len(exchange.items)
+		excluded = set()
+		for attempt in range(self.RetryAttempts):
+
+			provider = self.select_provider(model, conversation, exclude=excluded)
+			if provider is None and len(excluded) > 0:
+				# All providers of the model failed, wait and try them again
+				await asyncio.sleep(self._retry_delay(model, attempt))
+				excluded.clear()
+				provider = self.select_provider(model, conversation)
+
+			if provider is None:
+				error = LLMProviderError("No provider found for model '{}'".format(model), retryable=False)
+				break
+
+			try:
+				await self._chat_request_hedged(provider, conversation, exchange, model, excluded)
+				return
+
+			except LLMProviderError as e:
+				error = e
+				if not e.Retryable or len(exchange.items) > items_count:
+					# Items have been already streamed to the client, the request cannot be repeated
+					break
+
+				L.warning("Request to LLM provider failed, retrying", struct_data={
+					"conversation_id": conversation.conversation_id,
+					"provider": provider.URL,
+					"attempt": attempt + 1,
+					"error": str(e),
+				})
+				excluded.add(provider)
+
+		L.error("Request to LLM failed", struct_data={"conversation_id": conversation.conversation_id, "model": model, "error": str(error)})
+		await self.send_update(conversation, {
+			"type": "chat.error",
+			"error": str(error),
+		})
 
-		async def print_waiting():
-			while True:
-				await asyncio.sleep(1)
-				# TODO: Indicate waiting for a model in the UI
-				print("Waiting for a model ...")
 
-		waiting_task = asyncio.create_task(print_waiting())
+	def _retry_delay(self, model: str, attempt: int) -> float:
+		'''
+		Exponential backoff with jitter, extended up to the moment when the first provider of the model becomes healthy again (Retry-After).
+		'''
+		delay = self.RetryBackoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+		now = time.monotonic()
+		unhealthy_until = [
+			provider.UnhealthyUntil - now
+			for provider in self.ModelCatalog.get_providers(model)
+			if provider.UnhealthyUntil is not None
+		]
+		if len(unhealthy_until) > 0:
+			delay = max(delay, min(unhealthy_until))
+		return min(delay, self.RetryMaxDelay)
+
+
+	async def _chat_request_hedged(self, provider, conversation: Conversation, exchange: Exchange, model: str, excluded: set) -> None:
+		'''
+		Send the request to the provider.
+		If the first token doesn't arrive within the hedging threshold, send a duplicate request to another provider.
+		The request that streams the first token wins, the other one is cancelled.
+		'''
+		tasks = {}
+		winner = None
+
+		def on_first_token(provider):
+			nonlocal winner
+			if winner is None:
+				winner = provider
+				for other, task in tasks.items():
+					if other is not provider:
+						task.cancel()
+			elif winner is not provider:
+				raise asyncio.CancelledError()
+
+		def start(provider):
+			tasks[provider] = asyncio.create_task(
+				self._chat_request(provider, conversation, exchange, functools.partial(on_first_token, provider)),
+				name=f"conversation-{conversation.conversation_id}-request"
+			)
+
+		start(provider)
 		try:
-			async with provider.Semaphore:
-				waiting_task.cancel()
-				await provider.chat_request(conversation, exchange)
+			if self.HedgeAfter > 0:
+				await asyncio.wait(tasks.values(), timeout=self.HedgeAfter)
+				if winner is None and not tasks[provider].done():
+					hedge_provider = self.select_provider(model, conversation, exclude=excluded | {provider})
+					if hedge_provider is not None:
+						L.log(asab.LOG_NOTICE, "Sending hedged request", struct_data={"conversation_id": conversation.conversation_id, "provider": hedge_provider.URL})
+						start(hedge_provider)
+
+			error = None
+			pending = set(tasks.values())
+			while len(pending) > 0:
+				done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+				for task in done:
+					if task.cancelled():
+						continue
+					e = task.exception()
+					if e is None:
+						return
+					if not isinstance(e, LLMProviderError):
+						raise e
+					error = e
+
+			if error is None:
+				raise asyncio.CancelledError()
+			raise error
+
 		finally:
-			waiting_task.cancel()
-			
+			for task in tasks.values():
+				task.cancel()
+
 
-	async def get_models(self):
-		models = []
+	async def _chat_request(self, provider, conversation: Conversation, exchange: Exchange, on_first_token) -> None:
+		async def on_wait(position, wait_time):
+			await self.send_update(conversation, {
+				"type": "queue.updated",
+				"position": position,  # 0 means that the request left the queue and it is being sent to the LLM
+				"wait_time": round(wait_time, 3),
+			})
 
-		async def collect_models(models, provider):
+		provider.Outstanding += 1
+		try:
 			try:
-				pmodels = await provider.get_models()
-			except Exception as e:
-				L.exception("Error collecting models", struct_data={"provider": provider.__class__.__name__})
-				return
+				await provider.Scheduler.acquire(conversation.tenant, conversation.conversation_id, on_wait=on_wait)
+			except SchedulerQueueFullError:
+				raise LLMProviderError("Request queue of the provider is full")
 
-			if pmodels is not None:
-				models.extend(pmodels)
+			try:
+				await provider.chat_request(conversation, exchange, on_first_token=on_first_token)
+			except LLMProviderError as e:
+				if e.Retryable:
+					provider.mark_failure(e.RetryAfter)
+				raise
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				provider.mark_failure()
+				raise LLMProviderError("Error communicating with LLM provider: {} {}".format(e.__class__.__name__, e)) from e
+			finally:
+				provider.Scheduler.release()
 
-		async with asyncio.TaskGroup() as tg:
-			for provider in self.Providers:
-				tg.create_task(collect_models(models, provider))
+		finally:
+			provider.Outstanding -= 1
 
-		return models
+
+	def record_usage(self, provider, conversation: Conversation, exchange: Exchange) -> None:
+		'''
+		Record the token usage of the request, it is called by the provider when the usage of the exchange is known.
+		'''
+		usage = exchange.usage
+		if usage is None:
+			return
+
+		counter = self.TokenCounters.get(provider)
+		if counter is not None:
+			for name, value in usage.to_dict().items():
+				counter.add(name, value)
+
+		L.log(asab.LOG_NOTICE, "LLM token usage", struct_data={
+			"conversation_id": conversation.conversation_id,
+			"provider": provider.URL,
+			**usage.to_dict(),
+		})
+
+
+	async def get_models(self) -> list[str]:
+		'''
+		Get the list of available models from the cached model catalog.
+		'''
+		return await self.ModelCatalog.get_models()
 
 
 	async def send_update(self, conversation: Conversation, event: dict):
-		async with asyncio.TaskGroup() as tg:
-			for monitor in conversation.monitors:
-				tg.create_task(monitor(event))
+		if self.ItemPatches:
+			if conversation.patcher is None:
+				conversation.patcher = ItemPatcher()
+			event = conversation.patcher.apply(event)
+			if event is None:
+				return
 
+		if self.CoalesceWindow <= 0:
+			await self._send_update(conversation, event)
+			return
+
+		if conversation.coalescer is None:
+			conversation.coalescer = DeltaCoalescer(
+				functools.partial(self._send_update, conversation),
+				window=self.CoalesceWindow,
+				max_size=self.CoalesceSize,
+			)
+		await conversation.coalescer.push(event)
+
+
+	async def _send_update(self, conversation: Conversation, event: dict):
+		self.Conversations.touch(conversation)
+		self.Conversations.on_event(conversation, event)
+		conversation.sequence += 1
+		event['seq'] = conversation.sequence
+
+		if self.Journal is not None:
+			self.Journal.on_event(conversation, event)
+
+		if conversation.snapshot is not None:
+			conversation.snapshot.on_event(event)
+
+		if self.ReplayBufferSize > 0:
+			if conversation.replay is None:
+				conversation.replay = collections.deque(maxlen=self.ReplayBufferSize)
+			conversation.replay.append(event)
+
+		# Monitors only enqueue the event, a slow client doesn't block the LLM stream
+		for monitor in conversation.monitors:
+			monitor.put(event)
+
+
+	async def resume(self, conversation: Conversation, monitor: ConversationMonitor, last_seq: int) -> bool:
+		'''
+		Send events that the client has missed since the event `last_seq`.
+		Returns False if these events are no longer in the replay buffer, the client needs a full update then.
+		'''
+		if conversation.coalescer is not None:
+			await conversation.coalescer.flush()
+
+		if last_seq > conversation.sequence:
+			# The client knows a different history (e.g. the conversation was recreated)
+			return False
+
+		if last_seq == conversation.sequence:
+			return True
+
+		replay = conversation.replay
+		if replay is None or len(replay) == 0 or replay[0]['seq'] > last_seq + 1:
+			return False
+
+		for event in itertools.islice(replay, last_seq + 1 - replay[0]['seq'], None):
+			monitor.put(event)
+		return True
+
+
+	def create_monitor(self, conversation: Conversation, send, close, exchanges: int = None) -> ConversationMonitor:
+		'''
+		Create the outbound queue for a client of the conversation.
+		`send(event)` and `close()` are coroutines that deliver the event to the client and disconnect the client.
+		`exchanges` limits full updates the client receives when it cannot keep up, see `build_full_update()`.
+		The caller adds the monitor to `conversation.monitors` and stops it when the client goes away.
+		'''
+		monitor = ConversationMonitor(
+			send=send,
+			resync=functools.partial(self.build_full_update, conversation, exchanges),
+			close=close,
+			queue_size=self.MonitorQueueSize,
+			overflow=self.MonitorOverflow,
+			counter=self.MonitorCounter,
+		)
+		monitor.start()
+		self.Monitors.add(monitor)
+		return monitor
 
-	async def send_full_update(self, conversation: Conversation, monitor):
-		items = []
-		full_update = {
+
+	async def send_full_update(self, conversation: Conversation, monitor: ConversationMonitor, exchanges: int = None):
+		try:
+			monitor.put(await self.build_full_update(conversation, exchanges))
+		except Exception:
+			L.exception("Error sending full update to monitors", struct_data={"conversation_id": conversation.conversation_id})
+
+
+	async def send_page(self, conversation: Conversation, monitor: ConversationMonitor, before: str, exchanges: int = None) -> None:
+		'''
+		Send items of exchanges that precede the exchange starting with the item `before`.
+		The client uses it to backfill a conversation that it received only partially in the full update.
+		'''
+		if conversation.coalescer is not None:
+			await conversation.coalescer.flush()
+
+		position = conversation.find_item(before)
+		if position is None or position[1] != 0:
+			L.warning("Item not found for page", struct_data={"conversation_id": conversation.conversation_id, "key": before})
+			return
+		i = position[0]
+
+		if exchanges is None:
+			exchanges = self.FullUpdateExchanges
+		start = max(0, i - exchanges) if exchanges > 0 else 0
+
+		monitor.put({
+			"type": "update.page",
+			"before": before,
+			"has_more": start > 0,
+			"items": self._get_snapshot(conversation).get_items(conversation.exchanges[start:i], conversation.patcher),
+		})
+
+
+	async def send_item(self, conversation: Conversation, monitor: ConversationMonitor, key: str) -> None:
+		'''
+		Send the whole item to the client that cannot apply an `item.patched` event.
+		'''
+		if conversation.coalescer is not None:
+			await conversation.coalescer.flush()
+
+		item = conversation.get_item(key)
+		if item is None:
+			L.warning("Item not found for resync", struct_data={"conversation_id": conversation.conversation_id, "key": key})
+			return
+
+		item_dict = item.to_dict()
+		if conversation.patcher is not None:
+			item_dict['version'] = conversation.patcher.get_version(key)
+		monitor.put({
+			"type": "item.updated",
+			"item": item_dict,
+		})
+
+
+	async def build_full_update(self, conversation: Conversation, exchanges: int = None) -> dict:
+		'''
+		Build the full update with items of the last `exchanges` exchanges (all of them if 0).
+		If there are more exchanges, the client requests them by `update.page.requested`.
+		'''
+		# Pending deltas are already part of item contents, they are sent first so that `seq` counts them
+		if conversation.coalescer is not None:
+			await conversation.coalescer.flush()
+
+		if exchanges is None:
+			exchanges = self.FullUpdateExchanges
+		start = max(0, len(conversation.exchanges) - exchanges) if exchanges > 0 else 0
+
+		return {
 			"type": "update.full",
 			"conversation_id": conversation.conversation_id,
 			"created_at": conversation.created_at.isoformat(),
-			"items": items,
+			"seq": conversation.sequence,
+			"has_more": start > 0,
+			"items": self._get_snapshot(conversation).get_items(conversation.exchanges[start:], conversation.patcher),
 		}
 
-		for exchange in conversation.exchanges:
-			for item in exchange.items:
-				match item.__class__:
-					case UserMessage:
-						items.append(item.to_dict())
 
-		try:
-			await monitor(full_update)
-		except Exception:
-			L.exception("Error sending full update to monitors", struct_data={"conversation_id": conversation.conversation_id})
+	def _get_snapshot(self, conversation: Conversation) -> ConversationSnapshot:
+		if conversation.snapshot is None:
+			conversation.snapshot = ConversationSnapshot()
+		return conversation.snapshot
 
 
 	async def create_function_call(self, conversation: Conversation, function_call: FunctionCall):
@@ -246,10 +813,17 @@ class LLMRouterService(asab.Service):
 			match function_call.name:
 
 				case "ping":
+					# Progress sends only the new output, the whole item is sent when the call finishes
+					sent = function_call.content_length
 					async for _ in tool_ping(function_call):
+						delta = function_call.content_since(sent)
+						if len(delta) == 0:
+							continue
+						sent += len(delta)
 						await self.send_update(conversation, {
-							"type": "item.updated",
-							"item": function_call.to_dict(),
+							"type": "item.delta",
+							"key": function_call.key,
+							"delta": delta,
 						})
 
 				case _:
@@ -69,7 +69,7 @@ async def tool_ping(function_call: FunctionCall) -> None:
 					case "stdout" | "stderr":
 						data = task.result()
 						if len(data) > 0:
-							function_call.content += data.decode("utf-8", errors="replace")
+							function_call.append_content(data.decode("utf-8", errors="replace"))
 							yield "progress"
 
 							if task.get_name() == "stdout":
@@ -81,7 +81,7 @@ async def tool_ping(function_call: FunctionCall) -> None:
 						return_code = task.result()
 
 		if return_code != 0:
-			function_call.content += "\nPing command failed with return code: " + str(return_code)	
+			function_call.append_content("\nPing command failed with return code: " + str(return_code))	
 			function_call.error = True
 
 		yield "completed"
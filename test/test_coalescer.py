@@ -0,0 +1,41 @@
+import asyncio
+import unittest
+
+from llmulink.llm.coalescer import DeltaCoalescer
+
+
+class TestDeltaCoalescer(unittest.IsolatedAsyncioTestCase):
+
+	async def test_failed_flush_is_logged(self):
+		'''
+		The failure of the flush by the timer is logged, the task is not left behind.
+		'''
+		async def send(event):
+			raise RuntimeError("send failed")
+
+		coalescer = DeltaCoalescer(send, window=0.01, max_size=1000)
+		await coalescer.push({"type": "item.delta", "key": "message", "delta": "Hello"})
+		with self.assertLogs("llmulink.llm.coalescer", level="ERROR"):
+			await asyncio.sleep(0.05)
+		self.assertIsNone(coalescer.FlushTask)
+
+
+	async def test_close(self):
+		'''
+		Pending deltas of a closed coalescer are discarded, the timer doesn't send them.
+		'''
+		sent = []
+
+		async def send(event):
+			sent.append(event)
+
+		coalescer = DeltaCoalescer(send, window=0.01, max_size=1000)
+		await coalescer.push({"type": "item.delta", "key": "message", "delta": "Hello"})
+		coalescer.close()
+		await asyncio.sleep(0.05)
+		self.assertEqual(sent, [])
+		self.assertIsNone(coalescer.Timer)
+
+
+if __name__ == '__main__':
+	unittest.main()
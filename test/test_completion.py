@@ -0,0 +1,45 @@
+import unittest
+
+from llmulink.llm.completion import ChatCompletion
+from llmulink.llm.datamodel import Conversation
+
+
+class TestChatCompletion(unittest.IsolatedAsyncioTestCase):
+
+	def _load(self, messages: list):
+		completion = ChatCompletion(None, "model")
+		completion.Conversation = Conversation(conversation_id="conversation-1", instructions="")
+		return completion._load_messages(messages)
+
+
+	async def test_invalid_messages(self):
+		'''
+		Malformed messages are rejected with `ValueError` (the client receives 400), not with an internal error.
+		'''
+		for messages in [
+			["hi"],
+			[{"role": "user", "content": 42}],
+			[{"role": "user", "content": ["hi"]}],
+			[{"role": "user", "content": [{"type": "text", "text": 42}]}],
+			[{"role": "user", "content": "hi"}, {"role": "assistant", "tool_calls": "call"}, {"role": "user", "content": "hi"}],
+			[{"role": "user", "content": "hi"}, {"role": "assistant", "tool_calls": ["call"]}, {"role": "user", "content": "hi"}],
+			[{"role": "user", "content": "hi"}, {"role": "assistant", "tool_calls": [{"id": "c1", "function": {"arguments": {}}}]}, {"role": "user", "content": "hi"}],
+			[{"role": "user", "content": "hi"}, {"role": "tool", "tool_call_id": ["c1"]}, {"role": "user", "content": "hi"}],
+		]:
+			with self.subTest(messages=messages):
+				with self.assertRaises(ValueError):
+					self._load(messages)
+
+
+	async def test_valid_messages(self):
+		message = self._load([
+			{"role": "user", "content": "hi"},
+			{"role": "assistant", "tool_calls": [{"id": "c1", "function": {"name": "ping", "arguments": "{}"}}]},
+			{"role": "tool", "tool_call_id": "c1", "content": "pong"},
+			{"role": "user", "content": [{"type": "text", "text": "again"}]},
+		])
+		self.assertEqual(message.content, "again")
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,44 @@
+import types
+import unittest
+
+import asab
+
+from llmulink.llm.context import ContextManager
+from llmulink.llm.datamodel import Conversation, Exchange, UserMessage, AssistentReasoning, AssistentMessage
+
+
+class _Counter():
+	def add(self, name, value):
+		pass
+
+
+class TestContextManager(unittest.IsolatedAsyncioTestCase):
+
+	async def test_reasoning_is_not_counted(self):
+		'''
+		Long reasoning traces are not sent to the LLM, they don't trigger the compaction.
+		'''
+		asab.Config["llm"]["context_budgets"] = "model 5000"
+		asab.Config["llm"]["context_reserve"] = "0"
+		router = types.SimpleNamespace(
+			MetricsService=types.SimpleNamespace(create_counter=lambda *args, **kwargs: _Counter()),
+			Conversations=types.SimpleNamespace(invalidate=lambda conversation: None),
+		)
+		manager = ContextManager(router)
+
+		conversation = Conversation(conversation_id="conversation-1", instructions="Be brief.")
+		for i in range(5):
+			exchange = Exchange()
+			conversation.append_exchange(exchange)
+			exchange.append_item(UserMessage(role='user', content="Question {}".format(i), model='model'))
+			exchange.append_item(AssistentReasoning(content="thinking " * 2000, status='completed'))
+			exchange.append_item(AssistentMessage(content="Answer {}".format(i), status='completed', role='assistant'))
+
+		self.assertLess(manager.estimate(conversation), 200)
+		await manager.prepare(conversation, "model")
+		self.assertEqual(conversation.context.Start, 0)
+		self.assertEqual(len(conversation.context.Collapsed), 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
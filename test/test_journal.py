@@ -0,0 +1,115 @@
+import types
+import tempfile
+import unittest
+
+import asab
+
+from llmulink.llm.codec import create_codec
+from llmulink.llm.journal import ConversationJournal
+from llmulink.llm.datamodel import Conversation, Exchange, UserMessage
+
+
+class _Counter():
+	def add(self, name, value):
+		pass
+
+
+class TestConversationJournal(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.Directory = tempfile.TemporaryDirectory()
+		# Every batch seals its segment
+		asab.Config["journal"]["segment_size"] = "1"
+		asab.Config["journal"]["fsync"] = "false"
+		self.Journal = self._create_journal()
+		await self.Journal.initialize()
+
+
+	def _create_journal(self) -> ConversationJournal:
+		router = types.SimpleNamespace(JSONCodec=create_codec("json"))
+		app = types.SimpleNamespace(
+			MetricsService=types.SimpleNamespace(create_counter=lambda *args, **kwargs: _Counter()),
+			PubSub=types.SimpleNamespace(subscribe=lambda *args: None),
+		)
+		return ConversationJournal(router, app, self.Directory.name)
+
+
+	async def asyncTearDown(self):
+		await self.Journal.finalize()
+		self.Directory.cleanup()
+
+
+	async def _write(self, conversation_id: str) -> None:
+		conversation = Conversation(conversation_id=conversation_id, instructions="Be brief.")
+		self.Journal.register(conversation)
+		exchange = Exchange()
+		conversation.append_exchange(exchange)
+		item = UserMessage(role='user', content="Hello", model='model')
+		exchange.append_item(item)
+		conversation.sequence += 1
+		self.Journal.on_event(conversation, {"type": "item.appended", "item": item.to_dict(), "seq": conversation.sequence})
+		await self.Journal.flush()
+
+
+	def _get_last_active(self, conversation_id: str) -> float:
+		return next(s.Index[conversation_id][2] for s in self.Journal.Segments.values() if conversation_id in s.Index)
+
+
+	async def test_compaction_keeps_last_activity(self):
+		'''
+		The rewrite of a conversation by the compaction doesn't extend its retention.
+		'''
+		await self._write("conversation-1")
+		last_active = self._get_last_active("conversation-1")
+		await self.Journal.compact()
+		self.assertEqual(self._get_last_active("conversation-1"), last_active)
+
+		# The conversation has been idle for longer than the retention since its last record
+		for segment in self.Journal.Segments.values():
+			if "conversation-1" in segment.Index:
+				segment.Index["conversation-1"][2] -= 100
+		self.Journal.Retention = 50
+		await self._write("conversation-2")
+		await self.Journal.compact()
+
+		self.assertNotIn("conversation-1", self.Journal.Known)
+		self.assertIsNone(await self.Journal.recover("conversation-1", []))
+		self.assertIsNotNone(await self.Journal.recover("conversation-2", []))
+
+
+	async def test_written_during_compaction(self):
+		'''
+		An expired conversation that receives an event while sealed segments are rewritten is kept whole.
+		'''
+		await self._write("conversation-1")
+		for segment in self.Journal.Segments.values():
+			if "conversation-1" in segment.Index:
+				segment.Index["conversation-1"][2] -= 100
+		self.Journal.Retention = 50
+
+		compact = self.Journal._compact
+
+		def compact_and_write(*args):
+			result = compact(*args)
+			item = UserMessage(role='user', content="Again", model='model')
+			self.Journal.Pending.append({"c": "conversation-1", "t": "event", "x": 0, "e": {"type": "item.appended", "item": item.to_dict(), "seq": 2}})
+			return result
+
+		self.Journal._compact = compact_and_write
+		await self.Journal.compact()
+
+		self.assertIn("conversation-1", self.Journal.Known)
+		conversation = await self.Journal.recover("conversation-1", [])
+		self.assertEqual([item.content for item in conversation.exchanges[0].items], ["Hello", "Again"])
+
+
+	async def test_shared_path(self):
+		'''
+		The directory of the journal cannot be used by two journals at once.
+		'''
+		with self.assertRaises(RuntimeError):
+			await self._create_journal().initialize()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,47 @@
+import asyncio
+import unittest
+
+from llmulink.llm.monitor import ConversationMonitor
+
+
+class TestConversationMonitor(unittest.IsolatedAsyncioTestCase):
+
+	async def test_resync_drops_events_put_while_building(self):
+		'''
+		Deltas flushed while the full update is built are already in it, the client doesn't receive them again.
+		'''
+		sent = []
+		blocked = asyncio.Event()
+		unblock = asyncio.Event()
+
+		async def send(event):
+			if event.get('key') == 'first':
+				blocked.set()
+				await unblock.wait()
+			sent.append(event)
+
+		async def resync():
+			# The coalescer flushes its pending delta into the monitor before the full update is built
+			monitor.put({"type": "item.delta", "key": "message", "delta": "pending"})
+			return {"type": "update.full", "items": [{"key": "message", "content": "text pending"}]}
+
+		async def close():
+			pass
+
+		monitor = ConversationMonitor(send=send, resync=resync, close=close, queue_size=2, overflow='resync')
+		monitor.start()
+		try:
+			monitor.put({"type": "item.appended", "key": "first"})
+			await blocked.wait()
+			for i in range(3):
+				monitor.put({"type": "item.appended", "key": "item-{}".format(i)})
+			unblock.set()
+			await asyncio.sleep(0.05)
+		finally:
+			await monitor.stop()
+
+		self.assertEqual([event['type'] for event in sent], ['item.appended', 'update.full'])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,88 @@
+import types
+import unittest
+
+from llmulink.llm.codec import create_codec
+from llmulink.llm.datamodel import Conversation, Exchange
+from llmulink.llm.provider.provider_abc import LLMProviderError
+from llmulink.llm.provider.v1messages import LLMChatProviderV1Messages, _MessageStream
+from llmulink.llm.provider.v1chatcompletition import LLMChatProviderV1ChatCompletition, _ChatCompletionStream
+
+
+async def _send_update(conversation, event):
+	pass
+
+
+def _create_service():
+	return types.SimpleNamespace(JSONCodec=create_codec("json"), send_update=_send_update)
+
+
+def _create_exchange(conversation_id: str) -> tuple[Conversation, Exchange]:
+	conversation = Conversation(conversation_id=conversation_id, instructions="Be brief.")
+	exchange = Exchange()
+	conversation.append_exchange(exchange)
+	return conversation, exchange
+
+
+class TestConcurrentStreams(unittest.IsolatedAsyncioTestCase):
+	'''
+	Two responses streamed by one provider at once don't mix their items.
+	'''
+
+	async def test_messages(self):
+		provider = LLMChatProviderV1Messages(_create_service(), url="http://127.0.0.1:1")
+		streams = {}
+		for conversation_id in ("a", "b"):
+			conversation, exchange = _create_exchange(conversation_id)
+			streams[conversation_id] = (conversation, exchange, _MessageStream())
+			await provider._on_llm_event(conversation, exchange, streams[conversation_id][2], 'content_block_start', {
+				"index": 0, "content_block": {"type": "text", "text": ""},
+			})
+
+		for conversation_id in ("a", "b"):
+			conversation, exchange, stream = streams[conversation_id]
+			await provider._on_llm_event(conversation, exchange, stream, 'content_block_delta', {
+				"index": 0, "delta": {"type": "text_delta", "text": conversation_id},
+			})
+
+		for conversation_id, (conversation, exchange, stream) in streams.items():
+			self.assertEqual(exchange.items[0].content, conversation_id)
+
+
+	async def test_chat_completions(self):
+		provider = LLMChatProviderV1ChatCompletition(_create_service(), url="http://127.0.0.1:1")
+		streams = {}
+		for conversation_id in ("a", "b"):
+			conversation, exchange = _create_exchange(conversation_id)
+			streams[conversation_id] = (conversation, exchange, _ChatCompletionStream())
+			await provider._on_llm_chunk(conversation, exchange, streams[conversation_id][2], {
+				"choices": [{"index": 0, "delta": {"role": "assistant", "content": "<"}}],
+			})
+
+		for conversation_id in ("a", "b"):
+			conversation, exchange, stream = streams[conversation_id]
+			await provider._on_llm_chunk(conversation, exchange, stream, {
+				"choices": [{"index": 0, "delta": {"content": conversation_id}}],
+			})
+
+		for conversation_id, (conversation, exchange, stream) in streams.items():
+			self.assertEqual([item.content for item in exchange.items], ["<" + conversation_id])
+
+
+class TestStreamedErrors(unittest.IsolatedAsyncioTestCase):
+
+	async def test_messages_error_event(self):
+		'''
+		An error event in the stream (HTTP 200) fails the request, overloaded API is worth a retry.
+		'''
+		provider = LLMChatProviderV1Messages(_create_service(), url="http://127.0.0.1:1")
+		conversation, exchange = _create_exchange("a")
+		for error_type, retryable in (("overloaded_error", True), ("invalid_request_error", False)):
+			with self.assertRaises(LLMProviderError) as context:
+				await provider._on_llm_event(conversation, exchange, _MessageStream(), 'error', {
+					"type": "error", "error": {"type": error_type, "message": "..."},
+				})
+			self.assertEqual(context.exception.Retryable, retryable)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,56 @@
+import asyncio
+import unittest
+
+from llmulink.llm.scheduler import RequestScheduler
+
+
+class TestRequestScheduler(unittest.IsolatedAsyncioTestCase):
+
+	async def test_cancel_in_final_on_wait(self):
+		'''
+		The slot granted to the waiter is given back when the task is cancelled in `on_wait(0, ...)`.
+		'''
+		scheduler = RequestScheduler(concurrency=1, queue_size=10, notify_interval=0.01)
+		await scheduler.acquire("tenant", "conversation-1")
+
+		granted = asyncio.Event()
+
+		async def on_wait(position, wait_time):
+			if position == 0:
+				granted.set()
+				await asyncio.sleep(10)
+
+		task = asyncio.create_task(scheduler.acquire("tenant", "conversation-2", on_wait))
+		await asyncio.sleep(0.05)
+		scheduler.release()
+		await granted.wait()
+		self.assertEqual(scheduler.Running, 1)
+
+		task.cancel()
+		with self.assertRaises(asyncio.CancelledError):
+			await task
+
+		self.assertEqual(scheduler.Running, 0)
+		self.assertEqual(scheduler.Queued, 0)
+
+
+	async def test_on_wait_error(self):
+		'''
+		The waiter is removed from the queue when `on_wait` fails, a later release doesn't grant it a slot.
+		'''
+		scheduler = RequestScheduler(concurrency=1, queue_size=10, notify_interval=0.01)
+		await scheduler.acquire("tenant", "conversation-1")
+
+		async def on_wait(position, wait_time):
+			raise ConnectionResetError()
+
+		with self.assertRaises(ConnectionResetError):
+			await scheduler.acquire("tenant", "conversation-2", on_wait)
+
+		self.assertEqual(scheduler.Queued, 0)
+		scheduler.release()
+		self.assertEqual(scheduler.Running, 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
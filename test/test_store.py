@@ -0,0 +1,75 @@
+import types
+import unittest
+
+from llmulink.llm import store
+from llmulink.llm.store import ConversationStore
+from llmulink.llm.datamodel import Conversation, Exchange, AssistentMessage
+
+
+class _Metric():
+	def add(self, name, value):
+		pass
+
+	def set(self, name, value):
+		pass
+
+
+def _create_store() -> ConversationStore:
+	app = types.SimpleNamespace(
+		MetricsService=types.SimpleNamespace(
+			create_gauge=lambda *args, **kwargs: _Metric(),
+			create_counter=lambda *args, **kwargs: _Metric(),
+		),
+		PubSub=types.SimpleNamespace(subscribe=lambda *args: None, publish=lambda *args: None),
+	)
+	return ConversationStore(app)
+
+
+class TestConversationStore(unittest.TestCase):
+
+	def test_size_follows_events(self):
+		'''
+		Sizes are updated by events, the sweep measures only invalidated conversations.
+		'''
+		conversations = _create_store()
+		conversation = Conversation(conversation_id="conversation-1", instructions="Be brief.")
+		conversations.add(conversation)
+		self.assertEqual(conversations.Bytes, len("Be brief."))
+
+		exchange = Exchange()
+		conversation.append_exchange(exchange)
+		item = AssistentMessage(content='Hello', status='in_progress', role='assistant')
+		exchange.append_item(item)
+		conversations.on_event(conversation, {"type": "item.appended", "item": item.to_dict()})
+		item.append_content(" world")
+		conversations.on_event(conversation, {"type": "item.delta", "key": item.key, "delta": " world"})
+		item.append_content("!")
+		conversations.on_event(conversation, {"type": "item.patched", "key": item.key, "append": {"content": [11, "!"]}})
+		conversations.grow(conversation, 100)
+
+		expected = len("Be brief.") + store._ITEM_OVERHEAD + len("Hello world!") + 100
+		self.assertEqual(conversations.Sizes["conversation-1"], expected)
+		self.assertEqual(conversations.Bytes, expected)
+
+		conversation.instructions = "Be verbose."
+		conversation.payload_cache.clear()
+		conversations.invalidate(conversation)
+		conversations.sweep()
+		self.assertEqual(conversations.Bytes, store._estimate_size(conversation))
+
+		conversations.remove("conversation-1")
+		self.assertEqual(conversations.Bytes, 0)
+
+
+	def test_evict_over_bytes(self):
+		conversations = _create_store()
+		conversations.MaxBytes = 25
+		for i in range(3):
+			conversations.add(Conversation(conversation_id="conversation-{}".format(i), instructions="x" * 10))
+		conversations.sweep()
+		self.assertEqual(list(conversations.Conversations), ["conversation-1", "conversation-2"])
+		self.assertEqual(conversations.Bytes, 20)
+
+
+if __name__ == '__main__':
+	unittest.main()